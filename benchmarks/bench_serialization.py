@@ -0,0 +1,61 @@
+"""
+Serialization Benchmark
+
+Compares rows/sec for GET /products with the marshalled ORM path and the
+fast column tuple path. Runs against a throwaway SQLite database, never
+the DATABASE_URI of the environment, because it deletes every Product.
+Set BENCH_DATABASE_URI to run it against another database on purpose.
+
+    python -m benchmarks.bench_serialization --rows 10000 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+DB_FILE = os.path.join(tempfile.gettempdir(), "bench_serialization.db")
+os.environ["DATABASE_URI"] = os.getenv("BENCH_DATABASE_URI", f"sqlite:///{DB_FILE}")
+
+# pylint: disable=wrong-import-position
+from service import app  # noqa: E402
+from service.models import Product  # noqa: E402
+from tests.factories import ProductFactory  # noqa: E402
+
+
+def seed(rows: int):
+    """Replaces the catalog with rows fake Products"""
+    Product.bulk_delete()
+    Product.bulk_create(ProductFactory.build_batch(rows))
+
+
+def measure(client, fast: bool, repeat: int) -> float:
+    """Returns the best time in seconds to list every Product"""
+    app.config["FAST_SERIALIZATION"] = fast
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get("/products")
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """Runs the benchmark for each row count"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    client = app.test_client()
+    print(f"{'rows':>8} {'marshalled rows/s':>18} {'fast rows/s':>12} {'speedup':>8}")
+    for rows in args.rows:
+        seed(rows)
+        slow = measure(client, False, args.repeat)
+        fast = measure(client, True, args.repeat)
+        print(f"{rows:>8} {rows / slow:>18,.0f} {rows / fast:>12,.0f} {slow / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+WSGI vs ASGI Benchmark
+
+Starts the service under gunicorn (service:app) and under uvicorn
+(service.asgi:application) with the same database and number of workers,
+then drives the list and get workloads of benchmarks.load at a high
+concurrency against each and prints both reports side by side.
+
+    python -m benchmarks.compare_servers --concurrency 64 --requests 2000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks import load
+
+# the servers share this database, and fake_product() imports the service here too
+DB_FILE = os.path.join(tempfile.gettempdir(), "bench_servers.db")
+# the throwaway database is reset before each server, any other one only with --reset
+OWN_DATABASE = "DATABASE_URI" not in os.environ
+os.environ.setdefault("DATABASE_URI", f"sqlite:///{DB_FILE}")
+
+SERVERS = {
+    "wsgi": ["gunicorn", "--bind", "127.0.0.1:{port}", "--workers", "{workers}", "service:app"],
+    "asgi": [
+        "uvicorn", "--host", "127.0.0.1", "--port", "{port}", "--workers", "{workers}",
+        "--no-access-log", "service.asgi:application",
+    ],
+}
+
+
+def start(name, port, workers, env):
+    """Starts a server and waits until /health answers"""
+    command = [part.format(port=port, workers=workers) for part in SERVERS[name]]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1):
+                return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{name} server did not start: {' '.join(command)}")
+
+
+def main(argv=None):
+    """Runs the comparison from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per workload")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1, help="server processes of each kind")
+    parser.add_argument("--workloads", nargs="+", choices=["list", "get", "filter"], default=["list", "get"])
+    parser.add_argument("--output", help="write the JSON reports to this file")
+    parser.add_argument("--reset", action="store_true", help="delete every Product of DATABASE_URI before seeding")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, SLOW_REQUEST_MS="0")
+
+    reports = {}
+    for port, name in enumerate(SERVERS, start=8081):
+        process, url = start(name, port, args.workers, env)
+        try:
+            reports[name] = load.run(
+                load.HttpClient(url), args.workloads, args.products, args.requests, args.concurrency,
+                args.reset or OWN_DATABASE,
+            )
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"{'workload':<10} {'server':<6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for workload in args.workloads:
+        for name, report in reports.items():
+            result = report["workloads"][workload]
+            print(
+                f"{workload:<10} {name:<6} {result['throughput']:>9} {result['p50_ms']:>9} "
+                f"{result['p99_ms']:>9} {result['errors']:>7}"
+            )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(reports, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Load Test Harness
+
+Seeds the catalog with fake Products and drives the REST API with list,
+get, filter, create, like and update workloads at a given concurrency.
+Latency histograms and throughput are written as JSON, and a run can be
+compared against a stored baseline to catch performance regressions.
+
+Without --url the requests go through the Flask test client in this
+process, using DATABASE_URI (a throwaway SQLite file by default). With
+--url they go over HTTP to a running service.
+
+Seeding refuses a catalog that already has Products unless --reset is
+given, which deletes every one of them first. The throwaway SQLite file is
+always reset.
+
+    python -m benchmarks.load --products 1000 --requests 2000 --concurrency 8
+    python -m benchmarks.load --output benchmarks/baseline.json
+    python -m benchmarks.load --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# upper bounds in milliseconds of the latency histogram buckets
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+CATEGORIES = ["Electronic", "Gun", "Toy"]
+SEED_CHUNK = 500
+
+WORKLOADS = {}
+
+
+def workload(name):
+    """Registers a function that sends one request and returns its status code"""
+    def register(function):
+        WORKLOADS[name] = function
+        return function
+    return register
+
+
+######################################################################
+#  C L I E N T S
+######################################################################
+class AppClient:
+    """Sends requests through the Flask test client of this process"""
+
+    def __init__(self):
+        # pylint: disable=import-outside-toplevel
+        from service import app
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        """Sends one request and returns (status code, decoded JSON or None, headers)"""
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True), response.headers
+
+
+class HttpClient:
+    """Sends requests over HTTP to a running service"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        """Sends one request and returns (status code, decoded JSON or None, headers)"""
+        # pylint: disable=import-outside-toplevel
+        import requests
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        if path.startswith(self.url):
+            path = path[len(self.url):]
+        response = session.request(method, self.url + path, json=body, timeout=30)
+        try:
+            return response.status_code, response.json(), response.headers
+        except ValueError:
+            return response.status_code, None, response.headers
+
+
+######################################################################
+#  W O R K L O A D S
+######################################################################
+def fake_product():
+    """Returns the JSON body of a fake Product"""
+    # pylint: disable=import-outside-toplevel
+    from tests.factories import ProductFactory
+    data = ProductFactory.build().serialize()
+    del data["id"]
+    del data["version"]
+    return data
+
+
+@workload("list")
+def list_products(client, ids):  # pylint: disable=unused-argument
+    """Lists the first page of Products"""
+    return client.request("GET", "/products?limit=100")[0]
+
+
+@workload("get")
+def get_product(client, ids):
+    """Reads one Product"""
+    return client.request("GET", f"/products/{random.choice(ids)}")[0]
+
+
+@workload("filter")
+def filter_products(client, ids):  # pylint: disable=unused-argument
+    """Lists the first page of a category"""
+    return client.request("GET", f"/products?category={random.choice(CATEGORIES)}&limit=100")[0]
+
+
+@workload("create")
+def create_product(client, ids):  # pylint: disable=unused-argument
+    """Creates a Product"""
+    return client.request("POST", "/products", fake_product())[0]
+
+
+@workload("like")
+def like_product(client, ids):
+    """Likes one Product"""
+    return client.request("PUT", f"/products/{random.choice(ids)}/like")[0]
+
+
+@workload("update")
+def update_product(client, ids):
+    """Replaces one Product with new fake data"""
+    return client.request("PUT", f"/products/{random.choice(ids)}", fake_product())[0]
+
+
+######################################################################
+#  R U N N E R
+######################################################################
+def seed(client, count, reset=False):
+    """Fills an empty catalog with count fake Products and returns their ids
+
+    With reset the Products already in the catalog are deleted first,
+    otherwise a catalog that has any is refused
+    """
+    if reset:
+        client.request("DELETE", "/products?all=true")
+    elif client.request("GET", "/products?limit=1")[1]:
+        raise RuntimeError("The catalog already has Products, pass --reset to delete them")
+    ids = []
+    for start in range(0, count, SEED_CHUNK):
+        batch = [fake_product() for _ in range(min(SEED_CHUNK, count - start))]
+        status = client.request("POST", "/products/bulk", batch)[0]
+        if status != 201:
+            raise RuntimeError(f"Seeding failed with status {status}")
+    url = "/products?limit=1000"
+    while url:
+        _, page, headers = client.request("GET", url)
+        ids.extend(product["id"] for product in page)
+        link = headers.get("Link")
+        url = link[1:link.index(">")] if link else None
+    return ids
+
+
+def summarize(latencies, errors, elapsed):
+    """Returns the histogram, percentiles and throughput of one workload"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    histogram = {}
+    index = 0
+    for bound in BUCKETS_MS + [None]:
+        start = index
+        while index < count and (bound is None or latencies[index] <= bound):
+            index += 1
+        histogram[f"le_{bound}" if bound else "inf"] = index - start
+
+    def percentile(fraction):
+        return round(latencies[min(count - 1, int(fraction * count))], 3) if count else None
+
+    return {
+        "requests": count,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(count / elapsed, 1) if elapsed else None,
+        "mean_ms": round(sum(latencies) / count, 3) if count else None,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1], 3) if count else None,
+        "histogram_ms": histogram,
+    }
+
+
+def run_workload(client, name, ids, requests, concurrency):
+    """Sends requests of one workload from concurrency threads"""
+    function = WORKLOADS[name]
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = function(client, ids)
+            except Exception:  # pylint: disable=broad-except
+                status = None
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if status is None or status >= 400:
+                    errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def run(client, workloads, products, requests, concurrency, reset=False):
+    """Seeds the catalog, runs each workload and returns the report"""
+    ids = seed(client, products, reset)
+    report = {
+        "products": products,
+        "requests": requests,
+        "concurrency": concurrency,
+        "workloads": {},
+    }
+    for name in workloads:
+        report["workloads"][name] = run_workload(client, name, ids, requests, concurrency)
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Returns a message for every workload that regressed against baseline
+
+    A workload regresses when its throughput drops, or its p99 latency
+    grows, by more than tolerance (a fraction) of the baseline value
+    """
+    regressions = []
+    for name, result in report["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            continue
+        if base["throughput"] and result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput']}/s is below baseline {base['throughput']}/s"
+            )
+        if base["p99_ms"] and result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']}ms is above baseline {base['p99_ms']}ms")
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors, baseline had {base['errors']}")
+    return regressions
+
+
+def main(argv=None):
+    """Runs the load test from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running service, e.g. http://localhost:8000")
+    parser.add_argument("--products", type=int, default=1000, help="number of Products to seed")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per workload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workloads", nargs="+", choices=sorted(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="compare against the JSON report in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression as a fraction")
+    parser.add_argument("--reset", action="store_true", help="delete every Product of the catalog before seeding")
+    args = parser.parse_args(argv)
+
+    reset = args.reset
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        if "DATABASE_URI" not in os.environ:
+            db_file = os.path.join(tempfile.gettempdir(), "bench_load.db")
+            os.environ["DATABASE_URI"] = f"sqlite:///{db_file}"
+            reset = True
+        client = AppClient()
+
+    report = run(client, args.workloads, args.products, args.requests, args.concurrency, reset)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
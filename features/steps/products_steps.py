@@ -30,22 +30,22 @@ from compare import expect
 @given('the following products')
 def step_impl(context):
     """ Delete all products and load new ones """
-    # List all of the products and delete them one by one
+    # Delete all of the products with one request
     rest_endpoint = f"{context.BASE_URL}/products"
-    context.resp = requests.get(rest_endpoint)
+    context.resp = requests.delete(rest_endpoint, params={"all": "true"})
     expect(context.resp.status_code).to_equal(200)
-    for product in context.resp.json():
-        context.resp = requests.delete(f"{rest_endpoint}/{product['id']}")
-        expect(context.resp.status_code).to_equal(204)
 
-    # load the database with new products
-    for row in context.table:
-        payload = {
+    # load the database with new products in a single request
+    payload = [
+        {
             "name": row['name'],
             "category": row['category'],
             "description": row['description'],
             "price": row['price'],
             "like": row['like'],
         }
-        context.resp = requests.post(rest_endpoint, json=payload)
-        expect(context.resp.status_code).to_equal(201)
+        for row in context.table
+    ]
+    context.resp = requests.post(f"{rest_endpoint}/bulk", json=payload)
+    expect(context.resp.status_code).to_equal(201)
+    expect(context.resp.json()["created"]).to_equal(len(payload))
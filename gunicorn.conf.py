@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration
+
+Keeps the Prometheus metrics of every worker in PROMETHEUS_MULTIPROC_DIR
+so /metrics reports the whole server, not just the worker that answered.
+"""
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Starts from an empty metrics directory, old samples would be added in"""
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
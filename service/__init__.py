@@ -7,7 +7,7 @@ and SQL database
 import sys
 from flask import Flask
 from service import config
-from .common import log_handlers
+from .common import log_handlers, instrumentation, compression
 
 # Create Flask application
 app = Flask(__name__)
@@ -16,10 +16,16 @@ app.config.from_object(config)
 # pylint: disable=wrong-import-position, wrong-import-order
 from service import routes         # noqa: E402, E261
 # pylint: disable=wrong-import-position
-from .common import error_handlers, cli_commands  # noqa: F401 E402
+from .common import error_handlers, cli_commands, metrics, idempotency, replicas  # noqa: F401 E402
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
+instrumentation.init_instrumentation(app)
+metrics.init_metrics(app)
+idempotency.init_idempotency(app)
+replicas.init_replicas(app)
+# hooks run in reverse, so compression runs before the timing hook reports it
+compression.init_compression(app)
 
 app.logger.info(70 * "*")
 app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
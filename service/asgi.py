@@ -0,0 +1,236 @@
+"""
+ASGI Entry Point
+
+Serves the same API as service:app from an ASGI server, with the list and
+read endpoints running as async handlers on an async database engine
+(asyncpg for Postgres, aiosqlite for SQLite). Every other request, and any
+read the async handlers can't answer themselves (errors, HEAD, not found),
+goes to the Flask app on a worker thread, so behavior stays the same. The
+async handlers run inside a Flask request context between the app's
+request hooks, so they are timed, counted in the metrics and compressed
+like every other response.
+
+    uvicorn service.asgi:application --host 0.0.0.0 --port 8080
+
+The async handlers parse their arguments and build their queries with the
+same code as the Flask routes, then only run them asynchronously.
+"""
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from flask import Response, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import quote_etag
+from service import app
+from service.models import CatalogVersion, DataValidationError, Product
+from service.common import pooling
+from service.common.encoders import get_encoder
+from service.common.instrumentation import timer
+from service.common.replicas import request_replica
+from service import routes
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+PRODUCT_COLUMNS = list(Product.__table__.columns)
+PRODUCT_KEYS = [column.key for column in PRODUCT_COLUMNS]
+
+
+######################################################################
+# A S Y N C   D A T A B A S E
+######################################################################
+def async_uri(uri: str) -> str:
+    """Returns uri with the async driver of its database"""
+    url = make_url(uri)
+    return str(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]))
+
+
+def async_engine_options(config) -> dict:
+    """Returns the engine options of pooling.engine_options() for the async drivers"""
+    options = pooling.engine_options(config)
+    if "connect_args" in options:
+        # asyncpg takes server settings instead of libpq options
+        options["connect_args"] = {
+            "server_settings": {"statement_timeout": str(config["DB_STATEMENT_TIMEOUT_MS"])}
+        }
+    return options
+
+
+class AsyncDatabase:
+    """Async engines for the primary database and its read replicas"""
+
+    def __init__(self, config):
+        self.config = config
+        self.engines = {}
+
+    def engine(self, bind_key=None):
+        """Returns the async engine of a replica bind key, or of the primary for None"""
+        if bind_key not in self.engines:
+            if bind_key is None:
+                uri = self.config["SQLALCHEMY_DATABASE_URI"]
+            else:
+                uri = self.config["SQLALCHEMY_BINDS"][bind_key]
+            self.engines[bind_key] = create_async_engine(async_uri(uri), **async_engine_options(self.config))
+        return self.engines[bind_key]
+
+    async def fetch(self, statement, replica=True) -> list:
+        """Runs a SELECT on a replica (when allowed) or the primary and returns its rows"""
+        bind_key = request_replica() if replica else None
+        async with AsyncSession(self.engine(bind_key)) as session:
+            result = await session.execute(statement)
+            return result.all()
+
+    async def dispose(self):
+        """Closes the connections of every engine"""
+        for engine in self.engines.values():
+            await engine.dispose()
+        self.engines.clear()
+
+
+database = AsyncDatabase(app.config)
+wsgi = WsgiToAsgi(app)
+
+
+######################################################################
+# H A N D L E R S
+######################################################################
+class Fallback(Exception):
+    """Raised by a handler to let the Flask app answer the request"""
+
+
+def request_context(scope):
+    """Returns a Flask request context for the ASGI scope"""
+    headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+    host = headers.get("host") or "%s:%s" % tuple(scope.get("server") or ("localhost", 80))
+    return app.test_request_context(
+        scope["path"],
+        base_url=f'{scope.get("scheme", "http")}://{host}{scope.get("root_path", "")}',
+        query_string=scope["query_string"],
+        headers=headers,
+    )
+
+
+async def list_products():
+    """Lists Products like GET /products"""
+    try:
+        args = routes.product_args.parse_args()
+        args["fields"] = routes.requested_fields(args)
+        if args["ids"] is not None:
+            # lookups go through the product cache
+            raise Fallback()
+        if args["q"] and not Product.search_in_database():
+            # the in-process search index reads the database synchronously
+            raise Fallback()
+    except (HTTPException, DataValidationError, ValueError) as error:
+        raise Fallback() from error
+    version, likes = (await database.fetch(CatalogVersion.stamp_query()))[0]
+    etag = routes.list_etag(args, [version, likes, routes.like_buffer.stamp()])
+    if request.if_none_match.contains_weak(etag):
+        return routes.not_modified(etag)
+
+    try:
+        query, limit = routes.list_query(args)
+    except (HTTPException, DataValidationError, ValueError) as error:
+        raise Fallback() from error
+    fetch = routes.fetched_fields(args) or PRODUCT_KEYS
+    statement = query.with_entities(*(column for column in PRODUCT_COLUMNS if column.key in fetch)).statement
+
+    results = Product.add_pending_likes([dict(zip(fetch, row)) for row in await database.fetch(statement)])
+    page = routes.page_of(results, limit, args)
+    page["results"] = routes.project(page["results"], args["fields"])
+    headers = {"ETag": quote_etag(etag), "Vary": "X-Fields"}
+    if page["next"] is not None:
+        headers["Link"] = f'<{routes.next_page_url(page["next"])}>; rel="next"'
+    return json_response(page["results"], headers)
+
+
+async def get_product(product_id):
+    """Reads a Product like GET /products/{id}"""
+    try:
+        fields = routes.requested_fields(routes.fields_args.parse_args())
+    except (HTTPException, DataValidationError, ValueError) as error:
+        raise Fallback() from error
+    statement = select(*PRODUCT_COLUMNS).where(Product.id == product_id)
+    rows = await database.fetch(statement)
+    if not rows:
+        raise Fallback()
+    message = Product.add_pending_likes([dict(zip(PRODUCT_KEYS, rows[0]))])[0]
+    etag = routes.product_etag(message, fields)
+    if request.if_none_match.contains_weak(etag):
+        return routes.not_modified(etag)
+    message = routes.project([message], fields)[0]
+    return json_response(message, {"ETag": quote_etag(etag), "Vary": "X-Fields"})
+
+
+def json_response(data, headers) -> Response:
+    """Returns a 200 JSON response of data encoded like the FAST_SERIALIZATION routes"""
+    encode = get_encoder(app.config["JSON_ENCODER"])
+    with timer("encode"):
+        body = encode(data)
+    return Response(body, mimetype="application/json", headers=headers)
+
+
+async def run_handler(scope, send, function, args):
+    """Runs a handler in a Flask request context with the app's request hooks around it
+
+    The hooks time, count and compress the response like they do for the
+    Flask routes. A Fallback leaves the request to the Flask app
+    """
+    with request_context(scope):
+        response = app.preprocess_request()
+        if response is None:
+            response = await function(*args)
+        response = app.process_response(response)
+    await respond(send, response)
+
+
+async def respond(send, response):
+    """Sends a complete Flask response"""
+    body = response.get_data()
+    headers = [(key, value) for key, value in response.headers.items() if key != "Content-Length"]
+    headers.append(("Content-Length", str(len(body))))
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def route(scope):
+    """Returns the async handler and its arguments for a request, or None for the Flask app"""
+    if scope["method"] != "GET":
+        return None
+    parts = scope["path"].strip("/").split("/")
+    if parts == ["products"]:
+        return list_products, ()
+    if len(parts) == 2 and parts[0] == "products" and parts[1].isdigit():
+        return get_product, (int(parts[1]),)
+    return None
+
+
+async def lifespan(receive, send):
+    """Closes the database connections when the server shuts down"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await database.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    handler = route(scope) if scope["type"] == "http" else None
+    if handler is not None:
+        function, args = handler
+        try:
+            await run_handler(scope, send, function, args)
+            return
+        except Fallback:
+            pass
+    await wsgi(scope, receive, send)
@@ -0,0 +1,430 @@
+"""
+Cache
+
+Caches serialized Products and list results in front of the database.
+The Cache class talks to a pluggable backend: LRUCache keeps entries in
+this process, RedisBackend shares them between every gunicorn worker and
+replica through a Redis compatible server.
+
+Entries are stamped with the version of their namespace and of their own
+key when they are loaded. Writes bump the versions instead of hunting down
+every affected key, so an entry is only served while its stamp is current.
+
+In memory, lists get their own smaller LRU: a page can hold up to
+PAGE_SIZE_MAX Products, so counting it as one entry next to single
+Products would let a few hundred pages fill the pod's memory.
+"""
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger("flask.app")
+
+
+class CacheError(Exception):
+    """Used when the cache backend cannot be reached or returns an error"""
+
+
+######################################################################
+#  B A C K E N D S
+######################################################################
+class LRUCache:
+    """Bounded least-recently-used cache whose entries expire after ttl seconds"""
+
+    name = "memory"
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize: int, ttl: float):
+        """Resizes the cache and changes the expiry, dropping every entry"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._data.clear()
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default on a miss"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def get_many(self, keys) -> list:
+        """Returns the values cached for keys, None for every miss"""
+        with self._lock:
+            return [self._lookup(key) for key in keys]
+
+    def set(self, key, value, ttl: float = None):
+        """Caches value under key, evicting the least recently used entry when full"""
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def set_many(self, items: dict, ttl: float = None):
+        """Caches every value of items under its key"""
+        with self._lock:
+            for key, value in items.items():
+                self._store(key, value, ttl)
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Caches value under key only if it is missing, returns True if it was stored"""
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def add_many(self, items: dict, ttl: float = None) -> list:
+        """Caches every value of items whose key is missing, returns which ones were stored"""
+        with self._lock:
+            added = []
+            for key, value in items.items():
+                added.append(self._lookup(key) is None)
+                if added[-1]:
+                    self._store(key, value, ttl)
+            return added
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters and the current size"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+    def _store(self, key, value, ttl):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+
+class RedisBackend:
+    """Minimal client for a Redis compatible server, values are stored as JSON"""
+
+    name = "redis"
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: float = 60, timeout: float = 0.5):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.database = int(parsed.path.strip("/") or 0)
+        self.password = parsed.password
+        self.ttl = ttl
+        self.timeout = timeout
+        self._socket = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default on a miss"""
+        value = self.get_many([key])[0]
+        return default if value is None else value
+
+    def get_many(self, keys) -> list:
+        """Returns the values cached for keys, None for every miss"""
+        return [None if raw is None else json.loads(raw) for raw in self.execute("MGET", *keys)]
+
+    def set(self, key, value, ttl: float = None):
+        """Caches value under key for ttl seconds"""
+        milliseconds = int((self.ttl if ttl is None else ttl) * 1000)
+        self.execute("SET", key, json.dumps(value), "PX", milliseconds)
+
+    def set_many(self, items: dict, ttl: float = None):
+        """Caches every value of items under its key for ttl seconds, in one round trip"""
+        milliseconds = int((self.ttl if ttl is None else ttl) * 1000)
+        self.execute_many([("SET", key, json.dumps(value), "PX", milliseconds) for key, value in items.items()])
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Caches value under key only if it is missing, without expiry unless ttl is given"""
+        expiry = () if ttl is None else ("PX", int(ttl * 1000))
+        return self.execute("SET", key, json.dumps(value), "NX", *expiry) is not None
+
+    def add_many(self, items: dict, ttl: float = None) -> list:
+        """Caches every value of items whose key is missing in one round trip, returns which ones were stored"""
+        expiry = () if ttl is None else ("PX", int(ttl * 1000))
+        replies = self.execute_many([("SET", key, json.dumps(value), "NX", *expiry) for key, value in items.items()])
+        return [reply is not None for reply in replies]
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        if keys:
+            self.execute("DEL", *keys)
+
+    def clear(self):
+        """Removes every entry from the selected database"""
+        self.execute("FLUSHDB")
+
+    def stats(self) -> dict:
+        """Returns where the shared cache lives"""
+        return {"address": "%s:%s/%s" % (self.address + (self.database,))}
+
+    def execute(self, *args):
+        """Sends one command and returns its reply, reconnecting once if needed"""
+        return self.execute_many([args])[0]
+
+    def execute_many(self, commands) -> list:
+        """Pipelines commands and returns their replies, reconnecting once if needed"""
+        if not commands:
+            return []
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    return self._pipeline(commands)
+                except OSError as error:
+                    self._close()
+                    if attempt == 2:
+                        raise CacheError(f"Cache server {self.address} unavailable: {error}") from error
+        return []  # pragma: no cover
+
+    def _pipeline(self, commands) -> list:
+        """Sends commands at once and reads their replies, raising the first error reply"""
+        if self._socket is None:
+            self._connect()
+        self._socket.sendall(b"".join(_encode_command(args) for args in commands))
+        replies = []
+        for _ in commands:
+            # read every reply before raising so the connection stays in step
+            try:
+                replies.append(self._read_reply())
+            except CacheError as error:
+                replies.append(error)
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+        return replies
+
+    def _connect(self):
+        self._socket = socket.create_connection(self.address, timeout=self.timeout)
+        self._reader = self._socket.makefile("rb")
+        if self.password:
+            self._socket.sendall(_encode_command(("AUTH", self.password)))
+            self._read_reply()
+        if self.database:
+            self._socket.sendall(_encode_command(("SELECT", self.database)))
+            self._read_reply()
+
+    def _close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._reader = None
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by the cache server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise CacheError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise CacheError(f"Unexpected reply from the cache server: {line!r}")
+
+
+def _encode_command(args) -> bytes:
+    """Encodes a command in the Redis serialization protocol"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def create_backend(config: dict):
+    """Builds the cache backend selected by CACHE_BACKEND in the app config"""
+    ttl = config.get("PRODUCT_CACHE_TTL", 60)
+    if config.get("CACHE_BACKEND", "memory") == "redis":
+        return RedisBackend(config.get("CACHE_URL", "redis://localhost:6379/0"), ttl)
+    return LRUCache(config.get("PRODUCT_CACHE_SIZE", 1024), ttl)
+
+
+def create_list_backend(config: dict):
+    """Builds the separate LRU for cached lists in memory, None when lists share the Redis backend"""
+    if config.get("CACHE_BACKEND", "memory") == "redis":
+        return None
+    return LRUCache(config.get("LIST_CACHE_SIZE", 32), config.get("PRODUCT_CACHE_TTL", 60))
+
+
+######################################################################
+#  C A C H E
+######################################################################
+class Cache:
+    """Read-through cache with version-stamp invalidation over any backend"""
+
+    # seconds a namespace version lives, entries outlive a missing one anyway
+    VERSION_TTL = 30 * 24 * 3600
+
+    def __init__(self, backend=None, prefix: str = "products:", list_backend=None):
+        self.backend = backend or LRUCache()
+        self.list_backend = list_backend
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def configure(self, backend, list_backend=None):
+        """Switches to new backends and resets the counters, lists share backend unless list_backend is given"""
+        self.backend = backend
+        self.list_backend = list_backend
+        self.hits = self.misses = self.errors = 0
+
+    def fetch(self, key, loader, namespace: str = "products"):
+        """Returns the value cached for key, calling loader() to fill a miss
+
+        The entry is stamped with the versions of the namespace and of the key
+        read before loading. Writes bump one or the other after they commit, so
+        a write that lands while loader() runs leaves the entry already stale.
+        Nothing is cached when loader() returns None, and any backend error
+        falls back to loader() so the cache can never take the service down.
+        """
+        return self.fetch_many([key], lambda keys: {key: loader()}, namespace).get(key)
+
+    def fetch_many(self, keys, loader, namespace: str = "products") -> dict:
+        """Returns the values cached for keys, calling loader(missing_keys) once for the misses
+
+        loader returns a dictionary of the values it found by key. Like fetch(),
+        loaded entries are stamped with the versions read before loading and
+        keys that are not found anywhere are left out of the result
+        """
+        keys = list(dict.fromkeys(keys))
+        backend = self._backend(namespace)
+        try:
+            stamps, entries = self._read(backend, namespace, keys)
+        except CacheError as error:
+            self._failed(error)
+            return {key: value for key, value in loader(keys).items() if value is not None}
+        found = {}
+        for key, stamp, entry in zip(keys, stamps, entries):
+            if entry is not None and entry[0] == stamp:
+                found[key] = entry[1]
+        self.hits += len(found)
+        missing = [key for key in keys if key not in found]
+        self.misses += len(missing)
+        if missing:
+            loaded = {key: value for key, value in loader(missing).items() if value is not None}
+            stamp_of = dict(zip(keys, stamps))
+            try:
+                backend.set_many({self._key(key): [stamp_of[key], value] for key, value in loaded.items()})
+            except CacheError as error:
+                self._failed(error)
+            found.update(loaded)
+        return found
+
+    def delete(self, *keys, lists: bool = True):
+        """Invalidates the entries for keys and, unless lists is False, every cached list"""
+        try:
+            # a new key version also outdates what a read in flight is about to store
+            self.backend.set_many({self._key("stamp", key): uuid.uuid4().hex for key in keys})
+            self.backend.delete(*(self._key(key) for key in keys))
+        except CacheError as error:
+            self._failed(error)
+        if lists:
+            self.invalidate("lists")
+
+    def invalidate(self, *namespaces):
+        """Makes every entry in namespaces stale by giving them a new version"""
+        for namespace in namespaces:
+            try:
+                self._backend(namespace).set(self._key("version", namespace), uuid.uuid4().hex, ttl=self.VERSION_TTL)
+            except CacheError as error:
+                self._failed(error)
+
+    def clear(self):
+        """Invalidates every cached Product and list"""
+        self.invalidate("products", "lists")
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters of this process"""
+        stats = {"backend": self.backend.name, "hits": self.hits, "misses": self.misses, "errors": self.errors}
+        stats.update({key: value for key, value in self.backend.stats().items() if key not in ("hits", "misses")})
+        if self.list_backend is not None:
+            stats["lists"] = self.list_backend.stats()
+        return stats
+
+    def _backend(self, namespace: str):
+        if namespace == "lists" and self.list_backend is not None:
+            return self.list_backend
+        return self.backend
+
+    def _read(self, backend, namespace: str, keys) -> tuple:
+        """Returns the current stamp and the cached entry of every key, in one round trip once versions exist"""
+        version_key = self._key("version", namespace)
+        stamp_keys = [self._key("stamp", key) for key in keys]
+        version, *values = backend.get_many([version_key] + stamp_keys + [self._key(key) for key in keys])
+        key_versions, entries = values[:len(keys)], values[len(keys):]
+        if version is None:
+            version = self._start(backend, [version_key], self.VERSION_TTL)[0]
+        unset = [stamp_key for stamp_key, key_version in zip(stamp_keys, key_versions) if key_version is None]
+        if unset:
+            started = dict(zip(unset, self._start(backend, unset, backend.ttl)))
+            key_versions = [key_version or started[stamp_key] for stamp_key, key_version in zip(stamp_keys, key_versions)]
+        return [[version, key_version] for key_version in key_versions], entries
+
+    @staticmethod
+    def _start(backend, version_keys, ttl: float) -> list:
+        """Gives version_keys a first version unless another process did, returns the versions in place"""
+        proposed = {version_key: uuid.uuid4().hex for version_key in version_keys}
+        added = backend.add_many(proposed, ttl)
+        taken = [version_key for version_key, was_added in zip(version_keys, added) if not was_added]
+        current = dict(zip(taken, backend.get_many(taken))) if taken else {}
+        return [current.get(version_key) or proposed[version_key] for version_key in version_keys]
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    def _failed(self, error):
+        self.errors += 1
+        logger.warning("Cache unavailable: %s", error)
@@ -3,6 +3,7 @@ Flask CLI Command Extensions
 """
 from service import app
 from service.models import db
+from service.common import migrations
 
 
 ######################################################################
@@ -17,4 +18,19 @@ def create_db():
     """
     db.drop_all()
     db.create_all()
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+    migrations.stamp(db.engine)
+
+
+######################################################################
+# Command to apply pending schema migrations to an existing database
+# Usage: flask db-upgrade
+######################################################################
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """
+    Applies pending schema migrations without dropping any data.
+    """
+    upgraded = migrations.upgrade(db.engine)
+    app.logger.info("Applied migrations: %s", upgraded or "none")
+    print(f"Database is at schema version {migrations.current_version(db.engine)}")
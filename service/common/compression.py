@@ -0,0 +1,181 @@
+"""
+Response Compression
+
+Compresses JSON and NDJSON responses with the best encoding a client
+accepts: zstd and brotli when their packages are installed, gzip always.
+Small bodies (under COMPRESSION_MIN_SIZE) go out as they are.
+
+Streamed responses such as /products/export are compressed chunk by chunk
+and flushed after every chunk, so they stay streamed. Complete responses
+with an ETag are compressed once: the bytes are cached under the ETag and
+the encoding, and an ETag always names the same body, so the entry never
+needs invalidating. Like most servers, a compressed response weakens its
+ETag, which If-None-Match and If-Match still match because the routes
+compare weakly.
+"""
+import zlib
+from flask import current_app, request
+from werkzeug.http import quote_etag, unquote_etag
+from werkzeug.datastructures import Accept
+from .cache import LRUCache
+from .instrumentation import timer
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+# compressed bodies by (path, ETag, encoding, level)
+compressed_cache = LRUCache(maxsize=256, ttl=3600)
+
+
+######################################################################
+#  C O D E C S
+######################################################################
+class GzipCodec:
+    """gzip through zlib"""
+
+    name = "gzip"
+
+    @staticmethod
+    def compress(data: bytes, level: int) -> bytes:
+        """Returns data compressed in one go"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def stream(chunks, level: int):
+        """Compresses an iterable of byte chunks, flushing after each one"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class BrotliCodec:
+    """brotli, when the brotli package is installed"""
+
+    name = "br"
+
+    @staticmethod
+    def compress(data: bytes, level: int) -> bytes:
+        """Returns data compressed in one go"""
+        return brotli.compress(data, quality=level)
+
+    @staticmethod
+    def stream(chunks, level: int):
+        """Compresses an iterable of byte chunks, flushing after each one"""
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+
+class ZstdCodec:
+    """zstd, when the zstandard package is installed"""
+
+    name = "zstd"
+
+    @staticmethod
+    def compress(data: bytes, level: int) -> bytes:
+        """Returns data compressed in one go"""
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    @staticmethod
+    def stream(chunks, level: int):
+        """Compresses an iterable of byte chunks, flushing after each one"""
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        yield compressor.flush()
+
+
+CODECS = {"gzip": GzipCodec}
+if brotli is not None:
+    CODECS["br"] = BrotliCodec
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCodec
+
+
+def negotiate(accept: Accept, preferred) -> str:
+    """Returns the encoding of preferred (best first) the client accepts most, or None"""
+    best, best_quality = None, 0
+    for name in preferred:
+        quality = accept.quality(name) if name in CODECS else 0
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def level(config, encoding: str) -> int:
+    """Returns the configured compression level of an encoding"""
+    return config[f"COMPRESSION_LEVEL_{encoding.upper()}"]
+
+
+def compress_body(data: bytes, encoding: str, compression_level: int, key=None) -> bytes:
+    """Compresses a complete body, reusing the cached bytes of key (path, ETag) if any"""
+    if key is None:
+        return CODECS[encoding].compress(data, compression_level)
+    key = (*key, encoding, compression_level)
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = CODECS[encoding].compress(data, compression_level)
+        compressed_cache.set(key, compressed)
+    return compressed
+
+
+def weak_etag(etag: str) -> str:
+    """Returns a quoted ETag header value as a weak one"""
+    value, _ = unquote_etag(etag)
+    return quote_etag(value, weak=True)
+
+
+######################################################################
+#  F L A S K   H O O K S
+######################################################################
+def init_compression(app):
+    """Sizes the compressed cache and installs the response hook on app"""
+    compressed_cache.configure(app.config["COMPRESSION_CACHE_SIZE"], compressed_cache.ttl)
+    app.after_request(compress_response)
+
+
+def preferred_encodings(config) -> list:
+    """Returns the configured encodings, best first"""
+    return [name.strip() for name in config["COMPRESSION_ENCODINGS"].split(",") if name.strip()]
+
+
+def compress_response(response):
+    """Compresses response with the encoding negotiated from Accept-Encoding"""
+    config = current_app.config
+    if (not config["COMPRESSION"] or response.status_code != 200 or request.method == "HEAD"
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(request.accept_encodings, preferred_encodings(config))
+    if encoding is None:
+        return response
+    compression_level = level(config, encoding)
+
+    if response.is_streamed:
+        response.response = CODECS[encoding].stream(response.iter_encoded(), compression_level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESSION_MIN_SIZE"]:
+            return response
+        etag = response.headers.get("ETag")
+        key = (request.path, unquote_etag(etag)[0]) if etag else None
+        with timer("compress"):
+            response.set_data(compress_body(data, encoding, compression_level, key))
+    response.headers["Content-Encoding"] = encoding
+    if "ETag" in response.headers:
+        response.headers["ETag"] = weak_etag(response.headers["ETag"])
+    return response
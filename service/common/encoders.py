@@ -0,0 +1,37 @@
+"""
+JSON Encoders
+
+Pluggable encoders that turn plain Python data straight into JSON bytes
+for the fast serialization path. orjson is used when it is installed,
+otherwise the standard library with compact separators.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _encode_json(data) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+ENCODERS = {"json": _encode_json}
+if orjson is not None:
+    ENCODERS["orjson"] = orjson.dumps
+
+
+def register_encoder(name: str, encoder):
+    """Adds an encoder that takes Python data and returns JSON bytes"""
+    ENCODERS[name] = encoder
+
+
+def get_encoder(name: str = "auto"):
+    """Returns the encoder called name, "auto" picks the fastest one installed"""
+    if name == "auto":
+        name = "orjson" if "orjson" in ENCODERS else "json"
+    try:
+        return ENCODERS[name]
+    except KeyError as error:
+        raise ValueError(f"Unknown JSON encoder: {name}") from error
@@ -18,7 +18,7 @@
 Module: error_handlers
 """
 from flask import jsonify
-from service.models import DataValidationError, DatabaseConnectionError
+from service.models import DataValidationError, DatabaseConnectionError, DataConflictError
 from service import app
 from . import status
 
@@ -42,6 +42,19 @@ def request_validation_error(error):
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+
+@app.errorhandler(DataConflictError)
+def data_conflict_error(error):
+    """ Handles concurrent updates of the same Product """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
+
 @app.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
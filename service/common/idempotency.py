@@ -0,0 +1,165 @@
+"""
+Idempotency Keys
+
+Lets clients retry POST /products and PUT /products/{id}/like after a
+timeout without creating a second Product or counting a second like. A
+request with an Idempotency-Key header claims the key before the handler
+runs and stores its response under the key afterwards; a retry with the same
+key gets the stored response back, marked Idempotent-Replayed, without
+running the handler again.
+
+Responses are kept for IDEMPOTENCY_TTL seconds in an in-process LRU and,
+with IDEMPOTENCY_BACKEND=redis, in the shared cache server, so a retry that
+lands on another worker or replica is replayed too. A retry that arrives
+while the first request is still running gets a 409, and a key reused for a
+different request is a 400. Requests that fail (an exception or a 5xx)
+release their key so the retry runs.
+"""
+import hashlib
+import logging
+from functools import wraps
+from flask import request, Response
+from flask_restx.utils import unpack
+from service.models import DataValidationError, DataConflictError
+from .cache import CacheError, LRUCache, RedisBackend
+
+logger = logging.getLogger("flask.app")
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+# response headers that are replayed along with the body
+REPLAYED_HEADERS = ("Content-Type", "Location", "ETag")
+
+
+class IdempotencyStore:
+    """Responses by idempotency key, in this process and optionally in a shared backend"""
+
+    def __init__(self, ttl: float = 86400, lock_ttl: float = 30, maxsize: int = 10000, shared=None):
+        """
+        Args:
+            ttl (float): seconds a response is replayed for
+            lock_ttl (float): seconds a running request holds its key, in case its worker dies
+            maxsize (int): responses kept in this process
+            shared: RedisBackend shared by every worker, None keeps keys in this process only
+        """
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.shared = shared
+
+    def configure(self, ttl: float, lock_ttl: float, maxsize: int, shared=None):
+        """Changes the lifetimes, size and shared backend, dropping every key"""
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.local.configure(maxsize, ttl)
+        self.shared = shared
+
+    def reserve(self, key: str, fingerprint: str):
+        """Claims key for a request, returns None if it was free or the record already under it"""
+        record = self.local.get(key)
+        if record is not None:
+            return record
+        running = {"fingerprint": fingerprint, "status": None}
+        if self._run("add", key, running, self.lock_ttl):
+            return None
+        # the key may expire between the two calls, it is then still treated as taken
+        record = self._run("get", key) or running
+        if record["status"] is not None:
+            self.local.set(key, record, self.ttl)
+        return record
+
+    def complete(self, key: str, fingerprint: str, response):
+        """Stores the response of the request that claimed key"""
+        record = {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers},
+            "body": response.get_data(as_text=True),
+        }
+        self.local.set(key, record, self.ttl)
+        if self.shared is not None:
+            self._run("set", key, record, self.ttl)
+
+    def release(self, key: str):
+        """Frees key so the request can be retried"""
+        self.local.delete(key)
+        if self.shared is not None:
+            self._run("delete", key)
+
+    def clear(self):
+        """Forgets every key kept in this process"""
+        self.local.clear()
+
+    def _run(self, operation: str, *args):
+        """Calls operation on the shared backend, or on this process when there is none or it is down"""
+        if self.shared is not None:
+            try:
+                return getattr(self.shared, operation)(*args)
+            except CacheError as error:
+                logger.warning("Idempotency keys are kept in this process only: %s", error)
+        return getattr(self.local, operation)(*args)
+
+
+store = IdempotencyStore()
+
+
+def init_idempotency(app):
+    """Configures the store from the app config"""
+    config = app.config
+    shared = None
+    if config["IDEMPOTENCY_BACKEND"] == "redis":
+        shared = RedisBackend(config["CACHE_URL"], config["IDEMPOTENCY_TTL"])
+    store.configure(config["IDEMPOTENCY_TTL"], config["IDEMPOTENCY_LOCK_TTL"], config["IDEMPOTENCY_CACHE_SIZE"], shared)
+
+
+def fingerprint_request() -> str:
+    """Returns a hash of what makes the current request, to spot a key reused for another one"""
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.query_string.decode(), request.get_data(as_text=True)):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def replay(record: dict, fingerprint: str) -> Response:
+    """Returns the stored response of a record, or raises if it cannot be replayed"""
+    if record["fingerprint"] != fingerprint:
+        raise DataValidationError(f"{HEADER} was already used for a different request")
+    if record["status"] is None:
+        raise DataConflictError(f"A request with this {HEADER} is still in progress, retry later")
+    response = Response(record["body"], record["status"], record["headers"])
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(method):
+    """Decorates a Resource method so requests with an Idempotency-Key run at most once"""
+
+    @wraps(method)
+    def wrapper(resource, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return method(resource, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise DataValidationError(f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+        key = ":".join(("idempotency", request.method, request.path, key))
+        fingerprint = fingerprint_request()
+        record = store.reserve(key, fingerprint)
+        if record is not None:
+            logger.info("Replaying the response for %s %s", request.method, request.path)
+            return replay(record, fingerprint)
+
+        try:
+            response = method(resource, *args, **kwargs)
+            if not isinstance(response, Response):
+                response = resource.api.make_response(*unpack(response))
+        except Exception:
+            store.release(key)
+            raise
+        if response.status_code >= 500:
+            store.release(key)
+        else:
+            store.complete(key, fingerprint, response)
+        return response
+
+    return wrapper
@@ -0,0 +1,139 @@
+"""
+Request Instrumentation
+
+Times every request and the SQL it runs using Flask request hooks and
+SQLAlchemy engine events. The breakdown is returned in a Server-Timing
+header and logged through log_handlers, with a warning for requests over
+SLOW_REQUEST_MS and for SELECTs repeated often enough to look like N+1.
+
+Code can time its own phases with timer(), for example around
+serialization. Phases run their own SQL so they overlap with "db".
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import log_handlers
+
+
+class RequestTiming:
+    """The latency, SQL and phase timings of one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_ms = 0.0
+        self.statements = Counter()
+        self.phases = {}
+
+    def elapsed_ms(self) -> float:
+        """Returns the milliseconds since the request started"""
+        return (time.perf_counter() - self.start) * 1000
+
+    def add_phase(self, name: str, duration_ms: float):
+        """Adds time to a named phase"""
+        self.phases[name] = self.phases.get(name, 0.0) + duration_ms
+
+    def repeated_selects(self, threshold: int) -> list:
+        """Returns (count, statement) for SELECTs run at least threshold times"""
+        if threshold <= 0:
+            return []
+        return [
+            (count, statement)
+            for statement, count in self.statements.most_common()
+            if count >= threshold and statement.lstrip().upper().startswith("SELECT")
+        ]
+
+    def server_timing(self, total_ms: float) -> str:
+        """Returns the Server-Timing header value"""
+        metrics = [f'db;dur={self.query_ms:.1f};desc="{self.queries} queries"']
+        metrics.extend(f"{name};dur={duration:.1f}" for name, duration in self.phases.items())
+        metrics.append(f"total;dur={total_ms:.1f}")
+        return ", ".join(metrics)
+
+
+def init_instrumentation(app):
+    """Installs the request hooks on app and the SQL hooks on every engine"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+def current_timing():
+    """Returns the RequestTiming of the current request, if there is one"""
+    if has_request_context():
+        return g.get("timing")
+    return None
+
+
+@contextmanager
+def timer(name: str):
+    """Times the enclosed block as a phase of the current request"""
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add_phase(name, (time.perf_counter() - start) * 1000)
+
+
+######################################################################
+# Flask hooks
+######################################################################
+def start_request():
+    """Starts timing the request"""
+    g.timing = RequestTiming()
+
+
+def finish_request(response):
+    """Adds the Server-Timing header and logs the request"""
+    timing = g.pop("timing", None)
+    if timing is None:
+        return response
+    total_ms = timing.elapsed_ms()
+    response.headers.add("Server-Timing", timing.server_timing(total_ms))
+
+    config = current_app.config
+    logger = current_app.logger
+    log_handlers.log_request_timing(
+        logger,
+        f"{request.method} {request.path}",
+        request.endpoint,
+        response.status_code,
+        total_ms,
+        timing.queries,
+        timing.query_ms,
+        config["SLOW_REQUEST_MS"],
+    )
+    for count, statement in timing.repeated_selects(config["N_PLUS_ONE_THRESHOLD"]):
+        logger.warning("Possible N+1 in %s: %d x %s", request.endpoint, count, " ".join(statement.split()))
+    return response
+
+
+######################################################################
+# SQLAlchemy engine events
+######################################################################
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    """Notes when a statement starts"""
+    if current_timing() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    """Adds the statement to the current request"""
+    timing = current_timing()
+    starts = conn.info.get("query_start")
+    if timing is None or not starts:
+        return
+    timing.queries += 1
+    timing.query_ms += (time.perf_counter() - starts.pop()) * 1000
+    timing.statements[statement] += 1
@@ -0,0 +1,260 @@
+"""
+Like Buffer
+
+Write-behind buffer that coalesces likes per product in memory and
+hands them to a flush function every few milliseconds, so a burst of
+likes on a popular product costs one UPDATE instead of one per like
+
+With a journal directory every like is also appended to a local SQLite
+file in WAL mode before it is acknowledged, and removed once it has been
+flushed, so likes survive a worker crash or restart. Each worker writes its
+own journal and holds a lock on it; a worker that can take the lock of
+another journal knows its owner is gone and adopts the likes left in it.
+Likes are written at least once: a crash between the flush and the journal
+cleanup writes that batch again.
+"""
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+
+logger = logging.getLogger("flask.app")
+
+# seconds between looks for the journals of workers that have gone
+RECOVERY_INTERVAL = 1.0
+
+
+class LikeJournal:
+    """Local append-only SQLite file of the likes not yet flushed"""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"likes-{uuid.uuid4().hex}.db")
+        self._lock_file = open(self.path + ".lock", "w")  # pylint: disable=consider-using-with
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._connection = self.connect(self.path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS likes "
+            "(seq INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, amount INTEGER NOT NULL)"
+        )
+
+    @staticmethod
+    def connect(path: str):
+        """Opens a journal in WAL mode, which survives the process dying mid-write"""
+        connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def append(self, product_id: int, amount: int) -> int:
+        """Writes a like and returns its sequence number"""
+        return self._connection.execute(
+            "INSERT INTO likes (product_id, amount) VALUES (?, ?)", (product_id, amount)
+        ).lastrowid
+
+    def acknowledge(self, seq: int):
+        """Removes every like up to seq once it has been flushed"""
+        self._connection.execute("DELETE FROM likes WHERE seq <= ?", (seq,))
+
+    def close(self):
+        """Closes and removes an empty journal"""
+        empty = self._connection.execute("SELECT count(*) FROM likes").fetchone()[0] == 0
+        self._connection.close()
+        if empty:
+            for suffix in ("", "-wal", "-shm", ".lock"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+        self._lock_file.close()
+
+    @classmethod
+    def adopt(cls, directory: str, own_path: str = None):
+        """Yields (path, {product_id: delta}) for every journal whose owner is gone
+
+        The caller takes over the likes and then calls discard(path)
+        """
+        for path in sorted(glob.glob(os.path.join(directory, "likes-*.db"))):
+            if path == own_path:
+                continue
+            with open(path + ".lock", "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # its worker is still running
+                if not os.path.exists(path):
+                    # another worker adopted it while this one waited for the lock
+                    cls.discard(path)
+                    continue
+                connection = cls.connect(path)
+                rows = connection.execute("SELECT product_id, sum(amount) FROM likes GROUP BY product_id").fetchall()
+                connection.close()
+                yield path, dict(rows)
+
+    @staticmethod
+    def discard(path: str):
+        """Removes an adopted journal"""
+        for suffix in ("", "-wal", "-shm", ".lock"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+class LikeBuffer:
+    """Coalesces likes per product and flushes them on a background thread"""
+
+    def __init__(self, flush, interval_ms: int = 0, journal_dir: str = None, max_lag_ms: int = 0):
+        """
+        Args:
+            flush (callable): called with a dict of {product_id: delta} to persist
+            interval_ms (int): milliseconds between flushes, 0 disables the buffer
+            journal_dir (str): directory of the durable journals, None keeps likes in memory only
+            max_lag_ms (int): flush on the liking request once the oldest buffered like
+                is this old, 0 leaves it to the background thread
+        """
+        self._flush = flush
+        self.interval_ms = interval_ms
+        self.journal_dir = journal_dir
+        self.max_lag_ms = max_lag_ms
+        self._journal = None
+        self._seq = 0
+        # names this process in stamp(), set on start() so forked workers differ
+        self._id = None
+        self._added = 0
+        self._oldest = None
+        self._pending = Counter()
+        # likes handed to the flush function and not committed yet, still counted by pending()
+        self._inflight = Counter()
+        self._lock = threading.Lock()
+        # one flush at a time, so a batch never acknowledges the journal rows of one still being written
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        """True when likes should be buffered instead of written directly"""
+        return self.interval_ms > 0
+
+    def add(self, product_id: int, amount: int = 1):
+        """Buffers amount likes for a product, in the journal first when there is one"""
+        self.start()
+        with self._lock:
+            if self._journal is not None:
+                self._seq = self._journal.append(int(product_id), amount)
+            self._pending[int(product_id)] += amount
+            self._added += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+        if self.max_lag_ms and self.lag_ms() > self.max_lag_ms:
+            logger.warning("Likes are %.0fms behind, flushing on the request", self.lag_ms())
+            self.flush()
+
+    def pending(self, product_id: int) -> int:
+        """Returns the likes buffered for a product but not yet flushed"""
+        with self._lock:
+            return self._pending.get(int(product_id), 0) + self._inflight.get(int(product_id), 0)
+
+    def stamp(self):
+        """Returns a tag that changes with every buffered like, None when none are waiting to be written"""
+        with self._lock:
+            if not (self._pending or self._inflight):
+                return None
+            return f"{self._id}.{self._added}"
+
+    def lag_ms(self) -> float:
+        """Returns the age of the oldest buffered like in milliseconds, 0 when there are none"""
+        oldest = self._oldest
+        return (time.monotonic() - oldest) * 1000 if oldest is not None else 0.0
+
+    def stats(self) -> dict:
+        """Returns the buffered likes and how far behind they are"""
+        with self._lock:
+            pending = {"products": len(self._pending), "likes": sum(self._pending.values())}
+        return dict(pending, lag_ms=round(self.lag_ms(), 1), journal=self._journal is not None)
+
+    def flush(self) -> int:
+        """Writes all buffered likes and returns the number of products flushed"""
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._pending = dict(self._pending), Counter()
+                seq, oldest, self._oldest = self._seq, self._oldest, None
+                self._inflight.update(deltas)
+            if not deltas:
+                return 0
+            try:
+                self._flush(deltas)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not flush likes for %s products, will retry", len(deltas))
+                with self._lock:
+                    self._inflight.subtract(deltas)
+                    self._inflight = +self._inflight
+                    self._pending.update(deltas)
+                    self._oldest = oldest
+                return 0
+            with self._lock:
+                # readers now find the likes in the database
+                self._inflight.subtract(deltas)
+                self._inflight = +self._inflight
+                if self._journal is not None:
+                    self._journal.acknowledge(seq)
+            return len(deltas)
+
+    def start(self):
+        """Starts the background flusher once, after any gunicorn fork"""
+        if self._thread is not None or not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._id = uuid.uuid4().hex
+            if self.journal_dir:
+                self._journal = LikeJournal(self.journal_dir)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="like-buffer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+        self._guarded("recover")
+
+    def recover(self) -> int:
+        """Takes over the likes left in the journals of workers that are gone"""
+        if self._journal is None:
+            return 0
+        adopted = 0
+        for path, deltas in LikeJournal.adopt(self.journal_dir, self._journal.path):
+            logger.info("Recovering likes for %s products from %s", len(deltas), path)
+            for product_id, amount in deltas.items():
+                self.add(product_id, amount)
+            LikeJournal.discard(path)
+            adopted += len(deltas)
+        return adopted
+
+    def stop(self):
+        """Stops the background flusher and writes whatever is still buffered"""
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _run(self):
+        recovered_at = time.monotonic()
+        while not self._stop.wait(self.interval_ms / 1000):
+            self._guarded("flush")
+            if time.monotonic() - recovered_at >= RECOVERY_INTERVAL:
+                recovered_at = time.monotonic()
+                self._guarded("recover")
+
+    def _guarded(self, step: str):
+        """Runs the step method, logging any error so the background thread keeps going"""
+        try:
+            getattr(self, step)()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Like buffer %s failed, will retry", step)
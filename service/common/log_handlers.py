@@ -34,3 +34,20 @@ def init_logging(app, logger_name: str):
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
     app.logger.info("Logging handler established")
+
+
+def log_request_timing(logger, request_line, endpoint, status_code, total_ms, queries, query_ms, slow_ms):
+    # pylint: disable=too-many-arguments
+    """Logs the latency and SQL of a request, as a warning when it took slow_ms or longer"""
+    slow = slow_ms > 0 and total_ms >= slow_ms
+    logger.log(
+        logging.WARNING if slow else logging.INFO,
+        "%s%s [%s] %s %.1fms, %d queries in %.1fms",
+        "Slow request: " if slow else "",
+        request_line,
+        endpoint,
+        status_code,
+        total_ms,
+        queries,
+        query_ms,
+    )
@@ -0,0 +1,120 @@
+"""
+Prometheus Metrics
+
+Request counts and latency by route and status code, in-flight requests,
+database pool usage and product cache lookups for GET /metrics.
+
+Under gunicorn every worker is a separate process, so set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before starting it. Each
+worker then writes its samples there and /metrics adds them up across
+workers. gunicorn.conf.py cleans up after workers that exit.
+"""
+import os
+import time
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from service.models import db, product_cache
+from service.common.pooling import pool_status
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests", ["method", "route", "status"]
+)
+LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being served", multiprocess_mode="livesum"
+)
+POOL = Gauge(
+    "db_pool_connections",
+    "Database connections by state",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+CACHE = Counter(
+    "product_cache_lookups_total", "Product cache lookups", ["result"]
+)
+
+# the cache counts per process, these are the counts already added to CACHE
+_cache_seen = {"hits": 0, "misses": 0, "errors": 0}
+_CACHE_RESULTS = {"hits": "hit", "misses": "miss", "errors": "error"}
+_POOL_STATES = {"size": "size", "idle": "idle", "checked_out": "in_use", "overflow": "overflow"}
+
+
+def init_metrics(app):
+    """Installs the request hooks that record metrics for app"""
+    app.before_request(start_request)
+    app.after_request(record_request)
+    app.teardown_request(finish_request)
+
+
+def render():
+    """Returns the metrics in the Prometheus text format and its content type"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+######################################################################
+# Flask hooks
+######################################################################
+def start_request():
+    """Counts the request as in flight"""
+    g.metrics_start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+def record_request(response):
+    """Records the count and latency of the request"""
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    # the api prefix of "/" leaves its routes starting with "//"
+    route = "/" + request.url_rule.rule.lstrip("/") if request.url_rule else "unmatched"
+    labels = (request.method, route, str(response.status_code))
+    REQUESTS.labels(*labels).inc()
+    LATENCY.labels(*labels).observe(time.perf_counter() - start)
+    record_pool()
+    record_cache()
+    return response
+
+
+def finish_request(error=None):  # pylint: disable=unused-argument
+    """Takes the request out of flight, even when it raised"""
+    if g.pop("metrics_start", None) is not None:
+        IN_FLIGHT.dec()
+
+
+def record_pool():
+    """Samples the connection pool of the database engine"""
+    pool = pool_status(db.engine)
+    for key, state in _POOL_STATES.items():
+        if key in pool:
+            POOL.labels(state).set(pool[key])
+
+
+def record_cache():
+    """Adds the product cache lookups since the last request"""
+    for attribute, result in _CACHE_RESULTS.items():
+        count = getattr(product_cache, attribute)
+        seen = _cache_seen[attribute]
+        if count < seen:  # the cache was reconfigured and started counting again
+            seen = 0
+        if count > seen:
+            CACHE.labels(result).inc(count - seen)
+        _cache_seen[attribute] = count
@@ -0,0 +1,266 @@
+"""
+Schema Migrations
+
+Versioned schema changes for databases that already exist. db.create_all()
+only creates missing tables, so anything added to an existing table (an
+index, a column) is written here as a numbered migration. Each one is
+idempotent, runs once, and is recorded in the schema_version table.
+On Postgres upgrade() holds an advisory lock, so workers and pods started
+with DB_AUTO_MIGRATE at the same time take turns instead of racing.
+
+Usage: flask db-upgrade
+"""
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from service.common import search
+
+logger = logging.getLogger("flask.app")
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(255)),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+# pg_advisory_lock key held while upgrade() runs
+LOCK_KEY = 28200001
+# rows a backfill updates per statement, each batch commits on its own
+BACKFILL_BATCH = 5000
+
+
+def migration(version: int, description: str, transaction: bool = True):
+    """Registers a function as the migration for version
+
+    Args:
+        version (int): the schema version the migration brings the database to
+        description (str): what the migration does
+        transaction (bool): False for statements that cannot run inside a
+            transaction, like CREATE INDEX CONCURRENTLY on Postgres
+    """
+    def decorator(function):
+        MIGRATIONS.append((version, description, transaction, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+    return decorator
+
+
+def create_index(connection, name: str, table: str, columns):
+    """Creates an index if it is missing, without locking writes on Postgres"""
+    quote = connection.dialect.identifier_preparer.quote
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    drop_invalid_index(connection, name)
+    column_list = ", ".join(quote(column) for column in columns)
+    connection.execute(text(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {quote(table)} ({column_list})"))
+
+
+def drop_invalid_index(connection, name: str):
+    """Drops an index a failed CREATE INDEX CONCURRENTLY left INVALID, so IF NOT EXISTS builds it again"""
+    if connection.dialect.name != "postgresql":
+        return
+    invalid = connection.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    ), {"name": name}).first()
+    if invalid is not None:
+        logger.warning("Rebuilding invalid index %s", name)
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def add_column(connection, table: str, column: str, definition: str):
+    """Adds a column if it is missing"""
+    if column in {info["name"] for info in inspect(connection).get_columns(table)}:
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    connection.execute(text(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {definition}"))
+
+
+def backfill(connection, table: str, column: str, value, batch: int = BACKFILL_BATCH) -> int:
+    """Replaces the NULLs in a column with value a batch of rows at a time and returns the rows changed
+
+    Run outside a transaction, so each batch commits on its own and only
+    holds the row locks of its rows for as long as it takes
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    statement = text(
+        f"UPDATE {quote(table)} SET {quote(column)} = :value WHERE id IN "
+        f"(SELECT id FROM {quote(table)} WHERE {quote(column)} IS NULL LIMIT :batch)"
+    )
+    changed = 0
+    while True:
+        count = connection.execute(statement, {"value": value, "batch": batch}).rowcount
+        changed += count
+        if count < batch:
+            return changed
+
+
+@contextmanager
+def not_null(connection, table: str, column: str):
+    """Makes a column NOT NULL on Postgres once the with block has backfilled it
+
+    SET NOT NULL on its own scans the table under an ACCESS EXCLUSIVE lock.
+    Instead a NOT VALID check constraint stops new NULLs before the block
+    runs, VALIDATE CONSTRAINT then checks the existing rows while reads and
+    writes go on, and SET NOT NULL finds the valid constraint and skips its
+    scan. Other databases only run the block: SQLite can't change a column.
+    """
+    if connection.dialect.name != "postgresql":
+        yield
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    name = f"{table}_{column}_not_null"
+    exists = connection.execute(text("SELECT 1 FROM pg_constraint WHERE conname = :name"), {"name": name}).first()
+    if exists is None:
+        connection.execute(text(
+            f"ALTER TABLE {quote(table)} ADD CONSTRAINT {name} CHECK ({quote(column)} IS NOT NULL) NOT VALID"
+        ))
+    yield
+    connection.execute(text(f"ALTER TABLE {quote(table)} VALIDATE CONSTRAINT {name}"))
+    connection.execute(text(f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(column)} SET NOT NULL"))
+    # the column's own constraint replaces the check
+    connection.execute(text(f"ALTER TABLE {quote(table)} DROP CONSTRAINT IF EXISTS {name}"))
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+@migration(1, "Index the product filter columns", transaction=False)
+def add_filter_indexes(connection):
+    """Adds the btree indexes used by the category, name and price filters"""
+    create_index(connection, "ix_product_category", "product", ["category"])
+    create_index(connection, "ix_product_name", "product", ["name"])
+    create_index(connection, "ix_product_price", "product", ["price"])
+    create_index(connection, "ix_product_category_price", "product", ["category", "price"])
+
+
+@migration(2, "Version products and the catalog for ETags")
+def add_versions(connection):
+    """Adds the per-row version column and the catalog version counter"""
+    add_column(connection, "product", "version", "INTEGER NOT NULL DEFAULT 1")
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY, version BIGINT NOT NULL DEFAULT 0)"
+    ))
+
+
+@migration(3, "Full-text search and name prefix indexes", transaction=False)
+def add_search_indexes(connection):
+    """Adds the GIN index for full-text search and the prefix index for autocomplete"""
+    if connection.dialect.name != "postgresql":
+        # other databases search with the in-process index in service/common/search.py
+        return
+    for name, statement in search.SEARCH_INDEXES.items():
+        drop_invalid_index(connection, name)
+        connection.execute(text(statement.format(concurrently="CONCURRENTLY ")))
+
+
+@migration(4, "Summarize the catalog by category")
+def add_category_stats(connection):
+    """Adds the category_stats summary table and fills it from the existing Products"""
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS category_stats (category VARCHAR(63) PRIMARY KEY, "
+        "count BIGINT NOT NULL DEFAULT 0, price_total BIGINT NOT NULL DEFAULT 0, price_min INTEGER, "
+        "price_max INTEGER, like_total BIGINT NOT NULL DEFAULT 0)"
+    ))
+    # create_all() may have made the table empty, so it is rebuilt either way
+    connection.execute(text("DELETE FROM category_stats"))
+    connection.execute(text(
+        "INSERT INTO category_stats (category, count, price_total, price_min, price_max, like_total) "
+        "SELECT COALESCE(category, ''), COUNT(*), COALESCE(SUM(price), 0), MIN(price), MAX(price), "
+        "COALESCE(SUM(\"like\"), 0) FROM product GROUP BY COALESCE(category, '')"
+    ))
+
+
+@migration(5, "Index the like counts for GET /products/top", transaction=False)
+def add_like_indexes(connection):
+    """Adds the btree indexes the most liked leaderboards read in order"""
+    create_index(connection, "ix_product_like", "product", ["like"])
+    create_index(connection, "ix_product_category_like", "product", ["category", "like"])
+
+
+@migration(6, "Make the like counts NOT NULL", transaction=False)
+def like_not_null(connection):
+    """Sets missing like counts to 0, so lists sorted by like run on the like indexes
+
+    Runs in steps that each commit on their own, so the table stays
+    readable and writable on Postgres throughout
+    """
+    if connection.dialect.name == "postgresql":
+        # SQLite keeps the column as it is, the model no longer writes NULLs there
+        connection.execute(text('ALTER TABLE product ALTER COLUMN "like" SET DEFAULT 0'))
+    with not_null(connection, "product", "like"):
+        backfill(connection, "product", "like", 0)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def current_version(engine) -> int:
+    """Returns the highest migration applied to the database, 0 if none"""
+    schema_version.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        versions = connection.execute(select(schema_version.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+@contextmanager
+def upgrade_lock(engine):
+    """Lets one process at a time migrate a Postgres database
+
+    Other databases run without it: SQLite serializes writers itself.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+
+
+def upgrade(engine) -> list:
+    """Applies every migration newer than the database and returns their versions"""
+    schema_version.create(engine, checkfirst=True)
+    upgraded = []
+    with upgrade_lock(engine):
+        # read under the lock, a worker that waited finds the migrations already applied
+        with engine.connect() as connection:
+            applied = set(connection.execute(select(schema_version.c.version)).scalars())
+        for version, description, transaction, function in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s: %s", version, description)
+            if transaction:
+                with engine.begin() as connection:
+                    function(connection)
+            else:
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                    function(connection)
+            if _record(engine, version, description):
+                upgraded.append(version)
+    return upgraded
+
+
+def stamp(engine) -> list:
+    """Marks every migration as applied, for databases built by create_all()"""
+    schema_version.create(engine, checkfirst=True)
+    return [version for version, description, _, _ in MIGRATIONS if _record(engine, version, description)]
+
+
+def _record(engine, version: int, description: str) -> bool:
+    try:
+        with engine.begin() as connection:
+            connection.execute(schema_version.insert().values(version=version, description=description))
+    except IntegrityError:
+        # another worker applied the same migration first
+        return False
+    return True
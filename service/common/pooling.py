@@ -0,0 +1,68 @@
+"""
+Connection Pooling
+
+Builds the SQLAlchemy engine options for the configured database and
+reports how saturated the connection pool is. With DB_EXTERNAL_POOLER
+the service keeps no connections of its own (NullPool) and leaves pooling
+to something like PgBouncer, so per-connection settings are applied with
+SET LOCAL at the start of every transaction instead of at connect time.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+
+def engine_options(config) -> dict:
+    """Returns SQLALCHEMY_ENGINE_OPTIONS for the database in config"""
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite":
+        # SQLite picks its own pool class and has no server side to protect
+        return {}
+    if config["DB_EXTERNAL_POOLER"]:
+        return {"poolclass": NullPool}
+    options = {
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    if config["DB_STATEMENT_TIMEOUT_MS"] and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"}
+    return options
+
+
+def init_engine(engine, config):
+    """Applies the transaction level settings to engine when an external pooler is used"""
+    timeout = config["DB_STATEMENT_TIMEOUT_MS"]
+    if config["DB_EXTERNAL_POOLER"] and timeout and engine.dialect.name == "postgresql":
+        event.listen(engine, "begin", statement_timeout(timeout))
+
+
+def statement_timeout(timeout_ms):
+    """Returns a begin listener that limits every statement of the transaction to timeout_ms"""
+    def set_local_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+    return set_local_timeout
+
+
+def pool_status(engine) -> dict:
+    """Returns the connection counts of the pool and how close it is to its limit"""
+    pool = engine.pool
+    status = {"class": type(pool).__name__}
+    if not hasattr(pool, "checkedout") or not hasattr(pool, "overflow"):
+        return status
+    size = pool.size()
+    checked_out = pool.checkedout()
+    max_overflow = pool._max_overflow  # pylint: disable=protected-access
+    # a negative max_overflow lets the pool grow without a limit
+    limit = size + max_overflow if max_overflow >= 0 else None
+    status.update(
+        size=size,
+        checked_out=checked_out,
+        idle=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+        limit=limit,
+        saturation=round(checked_out / limit, 3) if limit else None,
+    )
+    return status
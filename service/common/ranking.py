@@ -0,0 +1,101 @@
+"""
+Product Ranking
+
+In-process leaderboards of the most liked Products, one for the whole
+catalog and one per category, so GET /products/top reads the first n
+entries of a sorted list instead of querying the database.
+
+Each board holds the top `size` Products of its category, loaded from the
+(category, like) index. Likes only ever go up, so a like can move a
+Product up its boards or push it into one, but never makes a board wrong:
+the like endpoint applies them as they happen. Any other write clears the
+boards, and every board is reloaded after `ttl` seconds so likes handled by
+other workers show up too.
+"""
+import bisect
+import threading
+import time
+
+
+class Board:
+    """The top Products of one category ordered by likes, then id"""
+
+    def __init__(self, products, size: int):
+        self.size = size
+        # every Product of the category is on the board when it is not full
+        self.complete = len(products) < size
+        self.products = {product["id"]: product for product in products}
+        self.entries = sorted(self._entry(product) for product in products)
+        self.loaded_at = time.monotonic()
+
+    @staticmethod
+    def _entry(product) -> tuple:
+        return (-(product["like"] or 0), product["id"])
+
+    def top(self, n: int) -> list:
+        """Returns the first n Products"""
+        return [self.products[product_id] for _, product_id in self.entries[:n]]
+
+    def liked(self, product):
+        """Moves a Product up to its new like count, onto the board if it now makes the cut"""
+        old = self.products.get(product["id"])
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries, self._entry(old))]
+        elif not self.complete and (not self.entries or self._entry(product) > self.entries[-1]):
+            return
+        bisect.insort(self.entries, self._entry(product))
+        self.products[product["id"]] = product
+        if len(self.entries) > self.size:
+            _, evicted = self.entries.pop()
+            del self.products[evicted]
+            self.complete = False
+
+
+class Ranking:
+    """The most liked Products overall (category None) and per category"""
+
+    def __init__(self, size: int = 100, ttl: float = 5):
+        self.size = size
+        self.ttl = ttl
+        self.boards = {}
+        self._lock = threading.Lock()
+
+    def configure(self, size: int, ttl: float):
+        """Changes the board size and lifetime, dropping every board"""
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self.boards.clear()
+
+    def top(self, n: int, category, load) -> list:
+        """Returns the n most liked Products of category (None for all of them)
+
+        load(category, limit) returns the serialized top limit Products from the
+        database, it is called when the board is missing, expired or too short
+        """
+        with self._lock:
+            board = self.boards.get(category)
+            if board is not None and not self._usable(board, n):
+                board = None
+            if board is None:
+                board = Board(load(category, max(n, self.size)), max(n, self.size))
+                self.boards[category] = board
+            return board.top(n)
+
+    def liked(self, product):
+        """Applies a like to the boards of the whole catalog and of the Product's category"""
+        with self._lock:
+            for category in {None, product["category"]}:
+                board = self.boards.get(category)
+                if board is not None:
+                    board.liked(dict(product))
+
+    def clear(self):
+        """Drops every board, for writes that can move Products down or out"""
+        with self._lock:
+            self.boards.clear()
+
+    def _usable(self, board, n) -> bool:
+        if time.monotonic() - board.loaded_at > self.ttl:
+            return False
+        return board.complete or n <= len(board.entries)
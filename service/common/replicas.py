@@ -0,0 +1,149 @@
+"""
+Read Replicas
+
+A Flask-SQLAlchemy session that sends marked reads to read replicas and
+everything else to the primary. Queries opt in with
+execution_options(replica=True), see Product.replica_query().
+
+Only GET, HEAD and OPTIONS requests read from replicas, so an update
+reads the row it is about to change from the primary. A read also stays
+on the primary once the session has written, so it sees its own writes.
+A request that wrote gives its client a cookie that keeps the client's
+reads on the primary for DB_REPLICA_STALENESS seconds, which is how far
+behind the replicas are allowed to be. Other clients keep using the
+replicas. A request reads from one replica throughout, so an ETag checked
+first describes the rows read after it.
+
+That only holds for the client that wrote, so reads whose results go into
+a cache shared with other clients run on the primary inside primary_reads().
+"""
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql import Select
+
+REPLICA_BIND = "replica{}"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+# cookie holding the time until which the client that wrote reads from the primary
+PRIMARY_COOKIE = "primary_until"
+# requests can share an app context and its session, so a request's writes are noted on the request
+WROTE = "service.wrote_primary"
+# the replica a request reads from, kept so all its reads see one snapshot
+REPLICA = "service.replica"
+
+
+def replica_binds(config) -> dict:
+    """Returns the SQLALCHEMY_BINDS of the replicas in DATABASE_REPLICA_URIS"""
+    uris = [uri.strip() for uri in config["DATABASE_REPLICA_URIS"].split(",") if uri.strip()]
+    return {REPLICA_BIND.format(index): uri for index, uri in enumerate(uris)}
+
+
+class ReplicaRouter:
+    """Picks the replica for a read, or None when it must go to the primary"""
+
+    def __init__(self):
+        self.staleness = 0.0
+        self.binds = []
+        self._next = itertools.cycle([None])
+        self._lock = threading.Lock()
+
+    def configure(self, binds, staleness: float):
+        """Sets the replica bind keys and how stale their data may be"""
+        self.binds = list(binds)
+        self.staleness = staleness
+        self._next = itertools.cycle(self.binds or [None])
+
+    def pick(self):
+        """Returns the bind key of the next replica, or None for the primary"""
+        if not self.binds or client_wrote_recently():
+            return None
+        with self._lock:
+            return next(self._next)
+
+
+router = ReplicaRouter()
+
+
+def init_replicas(app):
+    """Installs the response hook that keeps the reads of a client that wrote on the primary"""
+    app.after_request(remember_write)
+
+
+def remember_write(response):
+    """Gives the client of a request that wrote the cookie read by client_wrote_recently()"""
+    if request.environ.get(WROTE) and router.binds and router.staleness > 0:
+        response.set_cookie(
+            PRIMARY_COOKIE, f"{time.time() + router.staleness:.3f}",
+            max_age=math.ceil(router.staleness), httponly=True, samesite="Lax",
+        )
+    return response
+
+
+def client_wrote_recently() -> bool:
+    """Returns True when the client of the current request wrote less than DB_REPLICA_STALENESS seconds ago"""
+    if not has_request_context():
+        return False
+    try:
+        return time.time() < float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        return False
+
+
+def request_replica():
+    """Returns the bind key the current request reads from, picked on its first replica read"""
+    if not has_request_context():
+        return router.pick()
+    if REPLICA not in request.environ:
+        request.environ[REPLICA] = router.pick()
+    return request.environ[REPLICA]
+
+
+@contextmanager
+def primary_reads(session):
+    """Runs the replica reads of session on the primary inside the with block"""
+    previous = session.info.get("primary", False)
+    session.info["primary"] = True
+    try:
+        yield
+    finally:
+        session.info["primary"] = previous
+
+
+class RoutingSession(SignallingSession):
+    """Session that runs replica reads on a replica while it has not written"""
+
+    def wrote(self) -> bool:
+        """Returns True when the current request, or the session outside a request, has written"""
+        if has_request_context():
+            return bool(request.environ.get(WROTE))
+        return bool(self.info.get("wrote"))
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):  # pylint: disable=arguments-differ
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            if has_request_context():
+                request.environ[WROTE] = True
+            else:
+                self.info["wrote"] = True
+        elif (
+            clause is not None
+            and clause.get_execution_options().get("replica")
+            and not self.wrote()
+            and not self.info.get("primary")
+            and (not has_request_context() or request.method in SAFE_METHODS)
+        ):
+            bind_key = request_replica()
+            if bind_key is not None:
+                return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension that uses the RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
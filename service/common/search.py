@@ -0,0 +1,100 @@
+"""
+Product Search
+
+The SQL behind full-text search and name autocomplete on Postgres, and an
+in-process inverted index that answers the same questions on databases
+without full-text search (SQLite in development and tests).
+
+The index is rebuilt from the product table whenever the catalog version
+has moved on, so it never serves results from before a write.
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+# the index expression and the queries must match exactly for Postgres to use the index
+SEARCH_VECTOR = "to_tsvector('english', coalesce(product.name, '') || ' ' || coalesce(product.description, ''))"
+SEARCH_INDEXES = {
+    "ix_product_search":
+        f"CREATE INDEX {{concurrently}}IF NOT EXISTS ix_product_search ON product USING GIN ({SEARCH_VECTOR})",
+    "ix_product_name_prefix":
+        "CREATE INDEX {concurrently}IF NOT EXISTS ix_product_name_prefix ON product (lower(name) text_pattern_ops)",
+}
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text) -> list:
+    """Splits text into lower case words"""
+    return TOKEN.findall(text.lower()) if text else []
+
+
+def escape_like(prefix: str) -> str:
+    """Escapes the LIKE wildcards in prefix with backslashes"""
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SearchIndex:
+    """Inverted index over the name and description of every Product"""
+
+    def __init__(self):
+        self.version = None
+        self.postings = {}
+        self.names = []
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, version, load):
+        """Rebuilds the index from load() unless it is already at version
+
+        load returns (id, name, description) for every Product
+        """
+        if self.version == version:
+            return
+        with self._lock:
+            if self.version == version:
+                return
+            postings = defaultdict(dict)
+            names = set()
+            size = 0
+            for product_id, name, description in load():
+                size += 1
+                for word, count in Counter(tokenize(name) + tokenize(description)).items():
+                    postings[word][product_id] = count
+                if name:
+                    names.add((name.lower(), name))
+            self.postings, self.names, self.size = dict(postings), sorted(names), size
+            self.version = version
+
+    def search(self, text: str, limit: int) -> list:
+        """Returns the ids of up to limit Products with every word of text, best match first, all of them for None"""
+        words = set(tokenize(text))
+        if not words or any(word not in self.postings for word in words):
+            return []
+        postings = [self.postings[word] for word in words]
+        scores = {}
+        for product_id in set.intersection(*(set(posting) for posting in postings)):
+            # tf-idf, rare words count for more than common ones
+            scores[product_id] = sum(
+                posting[product_id] * math.log(1 + self.size / len(posting)) for posting in postings
+            )
+        if limit is None:
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        else:
+            # only the first limit need ordering
+            ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in ranked]
+
+    def suggest(self, prefix: str, limit: int) -> list:
+        """Returns up to limit distinct names starting with prefix, ignoring case"""
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.names, (prefix,))
+        suggestions = []
+        for key, name in self.names[start:]:
+            if not key.startswith(prefix) or len(suggestions) >= limit:
+                break
+            suggestions.append(name)
+        return suggestions
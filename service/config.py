@@ -12,5 +12,93 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool of every worker, size workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# below the max_connections of Postgres. DB_POOL_RECYCLE is in seconds, -1 never.
+# DB_EXTERNAL_POOLER=true keeps no pool (NullPool) for PgBouncer and friends and
+# sets the statement timeout per transaction. 0 means no statement timeout.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+DB_EXTERNAL_POOLER = os.getenv("DB_EXTERNAL_POOLER", "false").lower() == "true"
+
+# Comma separated read replicas for GET requests. A client's reads stay on the
+# primary for DB_REPLICA_STALENESS seconds after its write, the lag the replicas may have.
+DATABASE_REPLICA_URIS = os.getenv("DATABASE_REPLICA_URIS", "")
+DB_REPLICA_STALENESS = float(os.getenv("DB_REPLICA_STALENESS", "2"))
+
+# Apply pending schema migrations at startup instead of with "flask db-upgrade"
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() == "true"
+
+# Keyset pagination for GET /products
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# List Products from column tuples encoded straight to JSON bytes instead of
+# marshalling ORM instances. JSON_ENCODER is "auto", "orjson" or "json".
+FAST_SERIALIZATION = os.getenv("FAST_SERIALIZATION", "true").lower() == "true"
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto")
+
+# Rows fetched per round-trip by GET /products/export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Rows per multi-row INSERT used by POST /products/bulk
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+
+# Coalesce likes and write them every N milliseconds, 0 writes each like directly
+LIKE_FLUSH_INTERVAL_MS = int(os.getenv("LIKE_FLUSH_INTERVAL_MS", "0"))
+# Journal buffered likes to SQLite files in this directory so they survive a
+# restart, and flush on the request once the oldest is LIKE_MAX_LAG_MS old
+LIKE_JOURNAL_DIR = os.getenv("LIKE_JOURNAL_DIR", "")
+LIKE_MAX_LAG_MS = int(os.getenv("LIKE_MAX_LAG_MS", "0"))
+
+# Cache of serialized Products and filtered lists, "memory" is per process and
+# "redis" is shared by every worker through CACHE_URL. Size 0 disables memory.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "60"))
+# in memory, list pages (up to PAGE_SIZE_MAX Products each) are kept in their own smaller LRU
+LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", "32"))
+
+# Requests taking this long are logged as warnings, 0 turns it off. A SELECT
+# run N_PLUS_ONE_THRESHOLD times in one request is logged as a possible N+1.
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+
+# GET /products/stats reads the per-category summary table, false aggregates every Product
+STATS_FROM_SUMMARY = os.getenv("STATS_FROM_SUMMARY", "true").lower() == "true"
+
+# GET /products/top returns TOP_N_DEFAULT Products unless n is given. TOP_RANKING
+# keeps the TOP_RANKING_SIZE most liked of each category in memory, updated by
+# likes and reloaded after TOP_RANKING_TTL seconds to pick up other workers' likes
+TOP_N_DEFAULT = int(os.getenv("TOP_N_DEFAULT", "10"))
+TOP_RANKING = os.getenv("TOP_RANKING", "false").lower() == "true"
+TOP_RANKING_SIZE = int(os.getenv("TOP_RANKING_SIZE", "100"))
+TOP_RANKING_TTL = float(os.getenv("TOP_RANKING_TTL", "5"))
+
+# Response compression negotiated through Accept-Encoding, best first from
+# COMPRESSION_ENCODINGS (br needs brotli, zstd needs zstandard). Bodies under
+# COMPRESSION_MIN_SIZE bytes are sent as they are
+COMPRESSION = os.getenv("COMPRESSION", "true").lower() == "true"
+COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL_GZIP = int(os.getenv("COMPRESSION_LEVEL_GZIP", "6"))
+COMPRESSION_LEVEL_BR = int(os.getenv("COMPRESSION_LEVEL_BR", "4"))
+COMPRESSION_LEVEL_ZSTD = int(os.getenv("COMPRESSION_LEVEL_ZSTD", "3"))
+# compressed bodies kept per process, by ETag and encoding
+COMPRESSION_CACHE_SIZE = int(os.getenv("COMPRESSION_CACHE_SIZE", "256"))
+
+# Responses to POST /products and likes sent with an Idempotency-Key are replayed
+# to retries for IDEMPOTENCY_TTL seconds. "redis" shares them between workers
+# through CACHE_URL, every worker also keeps IDEMPOTENCY_CACHE_SIZE of its own.
+# A running request holds its key for at most IDEMPOTENCY_LOCK_TTL seconds
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", CACHE_BACKEND)
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LOCK_TTL = float(os.getenv("IDEMPOTENCY_LOCK_TTL", "30"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
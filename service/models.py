@@ -4,9 +4,14 @@ Models for Product
 All of the models are stored in this module
 """
 import logging
+from collections import Counter
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import CheckConstraint
+from sqlalchemy import DDL, CheckConstraint, and_, bindparam, case, event, false, func, literal_column, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.exc import StaleDataError
+from service.common import migrations, pooling, ranking, search
+from service.common.replicas import RoutingSQLAlchemy, primary_reads, replica_binds, router
+from service.common.cache import Cache, create_backend, create_list_backend
 
 logger = logging.getLogger("flask.app")
 
@@ -14,35 +19,288 @@ logger = logging.getLogger("flask.app")
 # test 3
 # test new cluster 3
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Serialized Products keyed by id, the backend is picked from the config in init_db()
+product_cache = Cache()
+
+# Keys GET /products can sort by
+SORT_KEYS = ("id", "name", "price", "like", "category")
+
+# Product fields summarized by CategoryStats, and the columns of the stats
+STATS_FIELDS = ["price", "category", "like"]
+STATS_COLUMNS = ["category", "count", "price_total", "price_min", "price_max", "like_total"]
+
+# Full-text search for databases without it, kept in step with the catalog version
+search_index = search.SearchIndex()
+
+# Ranked matches checked against the other filters of a search per query, see Product.search
+SEARCH_WINDOW = 500
+
+# Most liked Products per category for GET /products/top when TOP_RANKING is on
+top_ranking = ranking.Ranking()
+
+# Keys GET /products/top can rank by
+TOP_KEYS = ("like", "price")
+
+# INSERT statements that take ON CONFLICT DO UPDATE, by dialect
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
 
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Product.init_db(app)
 
+
+def upsert(table, values: dict, changes):
+    """Returns an INSERT of values that updates the row with the same primary key instead
+
+    changes is called with the row that was not inserted (excluded) and
+    returns the new values of the existing row, so concurrent first writes
+    of a row can't both try to insert it
+    """
+    statement = UPSERT_INSERTS[db.engine.dialect.name](table).values(values)
+    return statement.on_conflict_do_update(index_elements=list(table.primary_key), set_=changes(statement.excluded))
+
+
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
     pass
 
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
     pass
 
+
+class DataConflictError(Exception):
+    """ Used when a Product was changed by another request while being updated """
+
+    pass
+
+
+class CatalogVersion(db.Model):
+    """
+    Single row counter bumped in the same transaction as every Product write
+    but a like, so a list page cached by any worker is not served after one
+    """
+
+    __tablename__ = "catalog_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def current(cls) -> int:
+        """Returns the current version of the catalog"""
+        return db.session.query(cls.version).filter(cls.id == 1).scalar() or 0
+
+    @classmethod
+    def stamp_query(cls):
+        """Returns the SELECT of the catalog version and its total likes
+
+        Likes leave the version alone but only ever add to the total, so
+        together the two change with every write. They are read in one
+        statement so both come from the same snapshot
+        """
+        likes = select(func.sum(CategoryStats.like_total)).scalar_subquery()
+        version = select(cls.version).where(cls.id == 1).scalar_subquery()
+        return select(func.coalesce(version, 0), func.coalesce(likes, 0))
+
+    @classmethod
+    def stamp(cls) -> tuple:
+        """Returns (version, likes) of stamp_query(), from a replica when the request may use one"""
+        return tuple(db.session.execute(cls.stamp_query().execution_options(replica=True)).one())
+
+    @classmethod
+    def bump(cls):
+        """Increments the catalog version inside the current transaction"""
+        table = cls.__table__
+        db.session.execute(upsert(table, {"id": 1, "version": 1}, lambda excluded: {"version": table.c.version + 1}))
+
+
+class CategoryStats(db.Model):
+    """
+    Per-category summary of the catalog, changed in the same transaction as
+    every Product write so the stats read one row per category instead of
+    every Product. Products without a category are summarized under ''
+
+    Likes are summarized too. With LIKE_FLUSH_INTERVAL_MS a flush adds the
+    likes of a whole batch to each category row at once
+    """
+
+    __tablename__ = "category_stats"
+
+    category = db.Column(db.String(63), primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    price_total = db.Column(db.BigInteger, nullable=False, default=0)
+    price_min = db.Column(db.Integer)
+    price_max = db.Column(db.Integer)
+    like_total = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @staticmethod
+    def key(category) -> str:
+        """Returns the summary key of a category"""
+        return category or ""
+
+    @staticmethod
+    def _matches(key):
+        """Returns the Product filter for the category summarized under key"""
+        if key == "":
+            return or_(Product.category.is_(None), Product.category == "")
+        return Product.category == key
+
+    @classmethod
+    def summary(cls) -> list:
+        """Returns (category, count, price_total, price_min, price_max, like_total) per category"""
+        columns = [getattr(cls, column) for column in STATS_COLUMNS]
+        query = cls.query.with_entities(*columns).execution_options(replica=True)
+        return [tuple(row) for row in query.order_by(cls.category)]
+
+    @classmethod
+    def record(cls, key, count=0, price_total=0, price_min=None, price_max=None, like_total=0):
+        """Adds to the summary of a category inside the current transaction
+
+        price_min and price_max only widen the range, so they are given for
+        added Products. Removing one calls settle() to narrow it again
+        """
+        table = cls.__table__
+
+        def changes(excluded):
+            values = {
+                "count": table.c.count + excluded.count,
+                "price_total": table.c.price_total + excluded.price_total,
+                "like_total": table.c.like_total + excluded.like_total,
+            }
+            if price_min is not None:
+                values["price_min"] = case(
+                    (or_(table.c.price_min.is_(None), table.c.price_min > excluded.price_min), excluded.price_min),
+                    else_=table.c.price_min,
+                )
+            if price_max is not None:
+                values["price_max"] = case(
+                    (or_(table.c.price_max.is_(None), table.c.price_max < excluded.price_max), excluded.price_max),
+                    else_=table.c.price_max,
+                )
+            return values
+
+        values = {"category": key, "count": count, "price_total": price_total, "price_min": price_min,
+                  "price_max": price_max, "like_total": like_total}
+        db.session.execute(upsert(table, values, changes))
+
+    @classmethod
+    def liked(cls, deltas: dict):
+        """Adds likes, keyed by product id, to the summaries of their categories inside the current transaction
+
+        Runs after the like counts were updated, whose row locks keep the
+        categories from changing until the commit. The summaries are updated
+        in category order so concurrent flushes lock them in the same order
+        """
+        totals = Counter()
+        query = Product.query.order_by(None).with_entities(Product.id, Product.category)
+        for product_id, category in query.filter(Product.id.in_(list(deltas))):
+            totals[cls.key(category)] += deltas[product_id]
+        if not totals:
+            return
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.category == bindparam("key"))
+            .values(like_total=table.c.like_total + bindparam("delta"))
+        )
+        db.session.execute(statement, [{"key": key, "delta": delta} for key, delta in sorted(totals.items())])
+
+    @classmethod
+    def added(cls, products):
+        """Records new Products, given as dictionaries with a category and price"""
+        for key, (count, prices, likes) in cls._group(products).items():
+            cls.record(key, count, sum(prices), min(prices), max(prices), likes)
+
+    @classmethod
+    def removed(cls, products):
+        """Records removed Products, given as dictionaries with a category and price"""
+        for key, (count, prices, likes) in cls._group(products).items():
+            cls.record(key, -count, -sum(prices), like_total=-likes)
+            cls.settle(key)
+
+    @classmethod
+    def settle(cls, key):
+        """Recomputes the price range of a category from the (category, price) index, dropping it when empty"""
+        table = cls.__table__
+        db.session.execute(table.delete().where(table.c.category == key, table.c.count <= 0))
+        prices = Product.query.with_entities(Product.price).filter(cls._matches(key)).order_by(None)
+        db.session.execute(table.update().where(table.c.category == key).values(
+            price_min=prices.with_entities(func.min(Product.price)).scalar_subquery(),
+            price_max=prices.with_entities(func.max(Product.price)).scalar_subquery(),
+        ))
+
+    @classmethod
+    def refresh(cls, keys):
+        """Recomputes the summaries of the given categories from their Products"""
+        keys = set(keys)
+        if not keys:
+            return
+        table = cls.__table__
+        key = func.coalesce(Product.category, "")
+        aggregates = (
+            Product.query.order_by(None)
+            .with_entities(
+                key, func.count(Product.id), func.coalesce(func.sum(Product.price), 0),
+                func.min(Product.price), func.max(Product.price), func.coalesce(func.sum(Product.like), 0),
+            )
+            .filter(key.in_(keys))
+            .group_by(key)
+        )
+        db.session.execute(table.delete().where(table.c.category.in_(keys)))
+        db.session.execute(table.insert().from_select(
+            STATS_COLUMNS, aggregates.statement
+        ))
+
+    @classmethod
+    def keys_of(cls, query) -> set:
+        """Returns the summary keys of the categories of the Products matched by query"""
+        return {cls.key(category) for category, in query.order_by(None).with_entities(Product.category).distinct()}
+
+    @classmethod
+    def _group(cls, products) -> dict:
+        """Returns [count, prices, likes] per summary key"""
+        groups = {}
+        for product in products:
+            group = groups.setdefault(cls.key(product["category"]), [0, [], 0])
+            group[0] += 1
+            group[1].append(product["price"])
+            group[2] += product["like"] or 0
+        return groups
+
+
 class Product(db.Model):
     """
     Class that represents a Product
     """
 
     app = None
+    # the LikeBuffer whose unflushed likes are added to serialized Products, set by the routes
+    like_buffer = None
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
-    price = db.Column(db.Integer, nullable=False, default=60)
+    name = db.Column(db.String(63), index=True)
+    price = db.Column(db.Integer, nullable=False, default=60, index=True)
     description = db.Column(db.String(256))
-    like = db.Column(db.Integer, default=0)
-    category = db.Column(db.String(63))
+    like = db.Column(db.Integer, nullable=False, default=0)
+    category = db.Column(db.String(63), index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Indexes added to existing databases by service/common/migrations.py
+    __table_args__ = (
+        db.Index("ix_product_category_price", "category", "price"),
+        db.Index("ix_product_like", "like"),
+        db.Index("ix_product_category_like", "category", "like"),
+    )
+    # every ORM update checks and increments the version (optimistic locking)
+    __mapper_args__ = {"version_id_col": version}
+
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
 
@@ -51,34 +309,284 @@ class Product(db.Model):
         Creates a Product to the database
         """
         logger.info("Creating:%s", self.name)
-        logger.info("Creating like count:%s",self.like)
+        logger.info("Creating like count:%s", self.like)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
+        db.session.flush()
+        CategoryStats.added([self.serialize(STATS_FIELDS)])
+        CatalogVersion.bump()
         db.session.commit()
+        product_cache.invalidate("lists")
+        top_ranking.clear()
 
     def update(self):
         """
         Updates a Product to the database
         """
+        # the summarized fields as saved, read before loading any attribute flushes the changes
+        with db.session.no_autoflush:
+            product_id = self.id
+            saved = Product.query.with_entities(*(getattr(Product, field) for field in STATS_FIELDS))
+            saved = saved.filter(Product.id == product_id).first()
         logger.info("Saving %s", self.name)
         logger.info("like count is %s", self.like)
-        db.session.commit()
+        try:
+            db.session.flush()
+            changed = self.serialize(STATS_FIELDS)
+            if saved is not None and dict(saved._mapping) != changed:
+                CategoryStats.removed([dict(saved._mapping)])
+                CategoryStats.added([changed])
+            CatalogVersion.bump()
+            db.session.commit()
+        except StaleDataError as error:
+            db.session.rollback()
+            raise DataConflictError(f"Product with id '{product_id}' was changed by another request") from error
+        product_cache.delete(_cache_key(product_id))
+        top_ranking.clear()
 
     def delete(self):
         """ Removes a Product from the data store """
         logger.info("Deleting %s", self.name)
+        product_id = self.id
+        removed = self.serialize(STATS_FIELDS)
         db.session.delete(self)
+        db.session.flush()
+        CategoryStats.removed([removed])
+        CatalogVersion.bump()
         db.session.commit()
+        product_cache.delete(_cache_key(product_id))
+        top_ranking.clear()
+
+    @classmethod
+    def bulk_create(cls, products: list, chunk_size: int = 500) -> int:
+        """Creates many Products in one transaction
+
+        Rows are written with multi-row INSERT statements of chunk_size rows
+        each and committed once at the end, so either all of them are saved or
+        none are
+
+        :param products: the deserialized Products to save
+        :type products: list
+        :param chunk_size: the number of rows per INSERT statement
+        :type chunk_size: int
+        :return: the number of Products created
+        :rtype: int
+
+        """
+        logger.info("Bulk creating %s Products in chunks of %s", len(products), chunk_size)
+        rows = []
+        for product in products:
+            # the rows have no id yet, so no buffered likes either
+            row = product.serialize(pending_likes=False)
+            row.pop("id")
+            row.pop("version")
+            if row["like"] is None:
+                row["like"] = 0
+            rows.append(row)
+        try:
+            for start in range(0, len(rows), chunk_size):
+                db.session.execute(cls.__table__.insert().values(rows[start:start + chunk_size]))
+            CategoryStats.added(rows)
+            CatalogVersion.bump()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        product_cache.invalidate("lists")
+        top_ranking.clear()
+        return len(rows)
+
+    @classmethod
+    def bulk_delete(cls, query=None) -> int:
+        """Deletes every Product matched by query with a single DELETE statement
+
+        :param query: an optional filtered query, e.g. from find_by_category
+        :return: the number of Products deleted
+        :rtype: int
+
+        """
+        if query is None:
+            query = cls.query
+        categories = CategoryStats.keys_of(query)
+        count = query.order_by(None).delete(synchronize_session=False)
+        CategoryStats.refresh(categories)
+        CatalogVersion.bump()
+        db.session.commit()
+        product_cache.clear()
+        top_ranking.clear()
+        logger.info("Deleted %s Products", count)
+        return count
+
+    @classmethod
+    def delete_by_id(cls, product_id: int) -> int:
+        """Deletes the Product with the given id without loading it first"""
+        logger.info("Deleting Product with id %s", product_id)
+        query = cls.query.filter(cls.id == product_id)
+        removed = [dict(row._mapping) for row in query.with_entities(*(getattr(cls, f) for f in STATS_FIELDS))]
+        count = query.delete(synchronize_session=False)
+        CategoryStats.removed(removed)
+        CatalogVersion.bump()
+        db.session.commit()
+        product_cache.delete(_cache_key(product_id))
+        top_ranking.clear()
+        return count
+
+    @classmethod
+    def bulk_update(cls, changes: dict, query=None) -> int:
+        """Applies changes to every Product matched by query with a single UPDATE statement
+
+        :param changes: the new values keyed by attribute name
+        :type changes: dict
+        :param query: an optional filtered query, e.g. from find_by_category
+        :return: the number of Products updated
+        :rtype: int
+
+        """
+        values = cls.validate_changes(changes)
+        if query is None:
+            query = cls.query
+        categories = CategoryStats.keys_of(query) if set(values) & set(STATS_FIELDS) else set()
+        count = query.order_by(None).update(dict(values, version=cls.version + 1), synchronize_session=False)
+        if categories and "category" in values:
+            categories.add(CategoryStats.key(values["category"]))
+        CategoryStats.refresh(categories)
+        CatalogVersion.bump()
+        db.session.commit()
+        product_cache.clear()
+        top_ranking.clear()
+        logger.info("Updated %s Products with %s", count, values)
+        return count
+
+    @staticmethod
+    def validate_changes(data) -> dict:
+        """Validates a partial Product used for bulk updates
+
+        Only name, category, description and price may be changed, the like
+        count is owned by the like endpoint
+
+        Args:
+            data (dict): A dictionary with the attributes to change
+        """
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError("Invalid changes: body must be a non-empty JSON object")
+        checks = {
+            "price": _checked_price,
+            "name": _checked_name,
+            "category": _checked_text,
+            "description": _checked_text,
+        }
+        values = {}
+        for key, value in data.items():
+            if key not in checks:
+                raise DataValidationError(f"Invalid changes: [{key}] cannot be bulk updated")
+            values[key] = checks[key](key, value)
+        return values
+
+    @classmethod
+    def increment_like(cls, product_id: int, amount: int = 1):
+        """Atomically adds amount to the like count of a Product
+
+        The increment runs as one UPDATE ... SET like = like + amount in the
+        database, returning the new row where the dialect supports RETURNING,
+        so concurrent likes are never lost
+
+        :param product_id: the id of the Product to like
+        :type product_id: int
+        :param amount: the number of likes to add
+        :type amount: int
+        :return: the serialized Product after the increment, or None if not found
+        :rtype: dict
+
+        """
+        logger.info("Incrementing like count of %s by %s", product_id, amount)
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == product_id)
+            .values(like=func.coalesce(table.c.like, 0) + amount, version=table.c.version + 1)
+        )
+        if db.engine.dialect.full_returning:
+            row = db.session.execute(statement.returning(*table.c)).first()
+        else:
+            result = db.session.execute(statement)
+            row = None
+            if result.rowcount:
+                row = db.session.execute(table.select().where(table.c.id == product_id)).first()
+        if row:
+            CategoryStats.liked({row.id: amount})
+        db.session.commit()
+        # cached lists have their like counts replaced when they are read, see routes.with_current_likes()
+        product_cache.delete(_cache_key(product_id), lists=False)
+        return dict(row._mapping) if row else None
+
+    @classmethod
+    def increment_likes(cls, deltas: dict) -> int:
+        """Adds many like counts in one transaction with a batched UPDATE
+
+        :param deltas: the number of likes to add keyed by product id
+        :type deltas: dict
+        :return: the number of like deltas written
+        :rtype: int
+
+        """
+        if not deltas:
+            return 0
+        logger.info("Flushing likes for %s Products", len(deltas))
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("product_id"))
+            .values(like=func.coalesce(table.c.like, 0) + bindparam("delta"), version=table.c.version + 1)
+        )
+        # in id order so concurrent flushes lock the rows in the same order
+        params = [{"product_id": product_id, "delta": delta} for product_id, delta in sorted(deltas.items())]
+        try:
+            db.session.execute(statement, params)
+            CategoryStats.liked(deltas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        product_cache.delete(*deltas, lists=False)
+        return len(params)
+
+    def serialize(self, fields=None, pending_likes=True):
+        """Serializes a Product into a dictionary, with only the given fields if there are any
+
+        The like count includes the likes still in the like buffer unless
+        pending_likes is False, which gives the row as it is in the database
+        """
+        if fields is not None:
+            # other attributes may not be loaded, see load_only() in routes.list_products
+            message = {field: getattr(self, field) for field in fields}
+        else:
+            message = self._serialize_all()
+        if pending_likes:
+            self.add_pending_likes([message])
+        return message
 
-    def serialize(self):
-        """Serializes a Product into a dictionary"""
+    @classmethod
+    def add_pending_likes(cls, messages) -> list:
+        """Adds the buffered likes of each serialized Product to its like count, in place"""
+        buffer = cls.like_buffer
+        if buffer is None or not buffer.enabled:
+            return messages
+        for message in messages:
+            if "like" in message and message.get("id") is not None:
+                pending = buffer.pending(message["id"])
+                if pending:
+                    message["like"] = (message["like"] or 0) + pending
+        return messages
+
+    def _serialize_all(self):
         return {
             "id": self.id,
             "name": self.name,
             "price": self.price,
             "description": self.description,
             "like": self.like,
-            "category": self.category
+            "category": self.category,
+            "version": self.version
         }
 
     def deserialize(self, data):
@@ -95,7 +603,7 @@ class Product(db.Model):
             # Check the validity of the price attribute
             price = data.get("price")
 
-            like = data.get("like",0)
+            like = data.get("like", 0)
 
             if isinstance(like, int) or (isinstance(like, str) and like.isdigit()):
                 self.like = int(like)
@@ -105,13 +613,13 @@ class Product(db.Model):
                     + str(type(data["like"]))
                 )
             if int(like) >= 0:
-                self.like= int(like)
+                self.like = int(like)
             else:
                 raise DataValidationError(
                     "Invalid value for price. Price should be a non-negative value"
                 )
 
-            if isinstance(price, int) or (price and price.isdigit()):
+            if isinstance(price, int) or (isinstance(price, str) and price.isdigit()):
                 self.price = int(price)
             else:
                 raise DataValidationError(
@@ -130,8 +638,8 @@ class Product(db.Model):
                 raise DataValidationError(
                     "Invalid value for name. Name length should between 1 - 20 characters."
                 )
-        # except AttributeError as error:
-        #     raise DataValidationError("Invalid attribute: " + error.args[0]) from error
+        except (AttributeError, ValueError) as error:
+            raise DataValidationError("Invalid product: " + str(error)) from error
         except KeyError as error:
             raise DataValidationError("Invalid product: missing " + error.args[0]) from error
         except TypeError as error:
@@ -145,16 +653,336 @@ class Product(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        # pool settings depend on the database, which tests change after loading the config
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = pooling.engine_options(app.config)
+        app.config["SQLALCHEMY_BINDS"] = replica_binds(app.config)
+        router.configure(app.config["SQLALCHEMY_BINDS"], app.config["DB_REPLICA_STALENESS"])
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        pooling.init_engine(db.engine, app.config)
         db.create_all()  # make our sqlalchemy tables
+        product_cache.configure(create_backend(app.config), create_list_backend(app.config))
+        top_ranking.configure(app.config["TOP_RANKING_SIZE"], app.config["TOP_RANKING_TTL"])
+        if app.config.get("DB_AUTO_MIGRATE"):
+            migrations.upgrade(db.engine)
 
     @classmethod
     def all(cls):
         """ Returns all of the Products in the database """
         logger.info("Processing all Products")
-        return cls.query.all()
+        return cls.replica_query().all()
+
+    @classmethod
+    def stats(cls, group_by: str = None, from_summary: bool = True):
+        """Returns the count, price min/max/avg and total likes of the catalog
+
+        :param group_by: "category" for a list with the stats of each category
+        :param from_summary: read the CategoryStats rows (one per category)
+            instead of aggregating every Product
+        :return: the stats of the catalog, or a list of them per category
+        :rtype: dict or list
+
+        """
+        if from_summary:
+            rows = CategoryStats.summary()
+        else:
+            key = func.coalesce(cls.category, "")
+            query = cls.replica_query().order_by(None).with_entities(
+                key, func.count(cls.id), func.coalesce(func.sum(cls.price), 0),
+                func.min(cls.price), func.max(cls.price), func.coalesce(func.sum(cls.like), 0),
+            )
+            rows = query.group_by(key).order_by(key).all()
+        groups = [dict(zip(STATS_COLUMNS, row)) for row in rows]
+        if group_by is None:
+            prices = [group["price_min"] for group in groups if group["price_min"] is not None]
+            prices += [group["price_max"] for group in groups if group["price_max"] is not None]
+            groups = [{
+                "count": sum(group["count"] for group in groups),
+                "price_total": sum(group["price_total"] for group in groups),
+                "price_min": min(prices, default=None),
+                "price_max": max(prices, default=None),
+                "like_total": sum(group["like_total"] for group in groups),
+            }]
+        for group in groups:
+            group["price_avg"] = round(group["price_total"] / group["count"], 2) if group["count"] else None
+        return groups if group_by else groups[0]
+
+    @classmethod
+    def top(cls, by: str, n: int, category: str = None):
+        """Returns the query for the n Products with the highest by, ties going to the oldest
+
+        Runs on the (like), (price) and (category, ...) indexes
+
+        :param by: one of TOP_KEYS
+        :param n: the number of Products
+        :param category: only rank the Products of this category
+        :return: the query for the top Products
+        :rtype: Query
+
+        """
+        if by not in TOP_KEYS:
+            raise DataValidationError(f"Cannot rank Products by '{by}'")
+        column = getattr(cls, by)
+        query = cls.replica_query().filter(column.isnot(None))
+        if category is not None:
+            query = query.filter(cls.category == category)
+        return query.order_by(column.desc(), cls.id).limit(n)
+
+    @classmethod
+    def search_in_database(cls) -> bool:
+        """Returns True when the database does the full-text search, False for search_index"""
+        return db.engine.dialect.name == "postgresql"
+
+    @classmethod
+    def search(cls, text: str, limit: int, query=None):
+        """Returns the query for up to limit Products matching text, best match first
+
+        :param text: the words to look for in the name and description
+        :type text: str
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param query: an optional query to search in, e.g. from build_query
+        :type query: Query
+
+        :return: a query of the matching Products ordered by rank
+        :rtype: Query
+
+        """
+        logger.info("Processing search for %s ...", text)
+        if query is None:
+            query = cls.replica_query()
+        query = query.order_by(None)
+        if cls.search_in_database():
+            vector = literal_column(search.SEARCH_VECTOR)
+            words = func.plainto_tsquery("english", text)
+            return (
+                query.filter(vector.op("@@")(words))
+                .order_by(func.ts_rank(vector, words).desc(), cls.id)
+                .limit(limit)
+            )
+        search_index.refresh(CatalogVersion.current(), lambda: db.session.query(cls.id, cls.name, cls.description))
+        if query.whereclause is None:
+            ids = search_index.search(text, limit)
+        else:
+            ids = cls._first_passing(query, search_index.search(text, None), limit)
+        if not ids:
+            return query.filter(false())
+        rank = case({product_id: position for position, product_id in enumerate(ids)}, value=cls.id)
+        return query.filter(cls.id.in_(ids)).order_by(rank)
+
+    @classmethod
+    def _first_passing(cls, query, ranked: list, limit: int) -> list:
+        """Returns the first limit ids of ranked that query's filters keep
+
+        The filters may leave out some of the best matches, so the ranking is
+        checked SEARCH_WINDOW ids at a time until limit of them pass
+        """
+        ids = []
+        for start in range(0, len(ranked), SEARCH_WINDOW):
+            window = ranked[start:start + SEARCH_WINDOW]
+            passing = {row[0] for row in query.with_entities(cls.id).filter(cls.id.in_(window))}
+            ids += [product_id for product_id in window if product_id in passing]
+            if len(ids) >= limit:
+                break
+        return ids[:limit]
+
+    @classmethod
+    def suggest(cls, prefix: str, limit: int) -> list:
+        """Returns up to limit distinct Product names starting with prefix, ignoring case
+
+        :param prefix: the start of the name typed so far
+        :type prefix: str
+        :param limit: the maximum number of names to return
+        :type limit: int
+
+        :return: the names in alphabetical order
+        :rtype: list
+
+        """
+        logger.info("Processing suggestions for %s ...", prefix)
+        if cls.search_in_database():
+            pattern = search.escape_like(prefix.lower()) + "%"
+            query = (
+                db.session.query(cls.name)
+                .execution_options(replica=True)
+                .filter(func.lower(cls.name).like(pattern, escape="\\"))
+                .distinct()
+                .order_by(cls.name)
+                .limit(limit)
+            )
+            return [name for (name,) in query]
+        search_index.refresh(CatalogVersion.current(), lambda: db.session.query(cls.id, cls.name, cls.description))
+        return search_index.suggest(prefix, limit)
+
+    @classmethod
+    def replica_query(cls):
+        """Returns a query that may be answered by a read replica"""
+        return cls.query.execution_options(replica=True)
+
+    @classmethod
+    def paginate(cls, limit: int, after_id: int = None, query=None) -> list:
+        """Returns one page of Products ordered by id (keyset pagination)
+
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param after_id: only Products with an id greater than this are returned
+        :type after_id: int
+        :param query: an optional filtered query, e.g. from find_by_category
+        :return: a collection of at most limit Products
+        :rtype: list
+
+        """
+        logger.info("Processing page of %s Products after id %s ...", limit, after_id)
+        return cls.page_query(limit, after_id, query).all()
+
+    @classmethod
+    def page_query(cls, limit: int, after_id: int = None, query=None, sort=None, after_keys=None):
+        """Returns the query for one page of Products, see paginate()
+
+        :param sort: (key, descending) pairs from parse_sort() to order by before the id
+        :param after_keys: the sort_values() of the last Product of the previous page
+
+        """
+        query = cls.sort_query(query, sort)
+        if after_id is not None:
+            query = query.filter(cls._after(sort or [], after_keys or [], after_id))
+        return query.limit(limit)
+
+    @classmethod
+    def build_query(cls, category=None, name=None, price_range=None, min_like=None, max_like=None):
+        """Returns the query for the Products matching every filter given
+
+        :param category: the category to match
+        :param name: the name to match
+        :param price_range: the (lowest, highest) price to match, both included
+        :param min_like: the lowest like count to match
+        :param max_like: the highest like count to match
+
+        :return: a query of the matching Products, in no particular order
+        :rtype: Query
+
+        """
+        query = cls.replica_query()
+        if category is not None:
+            query = query.filter(cls.category == category)
+        if name is not None:
+            query = query.filter(cls.name == name)
+        if price_range is not None:
+            query = query.filter(cls.price >= price_range[0], cls.price <= price_range[1])
+        if min_like is not None:
+            query = query.filter(cls.like >= min_like)
+        if max_like is not None:
+            query = query.filter(cls.like <= max_like)
+        return query
+
+    @classmethod
+    def parse_sort(cls, sort: str) -> list:
+        """Parses a sort order like "price,-like" into (key, descending) pairs
+
+        :raises DataValidationError: for unknown or repeated keys, or id before another key
+
+        """
+        keys = []
+        for part in (sort or "").split(","):
+            part = part.strip()
+            key = part.lstrip("-")
+            if key not in SORT_KEYS:
+                raise DataValidationError(f"Invalid sort key: '{part}', use {', '.join(SORT_KEYS)}")
+            if key in dict(keys):
+                raise DataValidationError(f"Sort key '{key}' is repeated")
+            if "id" in dict(keys):
+                raise DataValidationError("Sort key 'id' is unique, it can only be the last one")
+            keys.append((key, part.startswith("-")))
+        return keys
+
+    @classmethod
+    def sort_query(cls, query=None, sort=None):
+        """Orders query by the sort keys from parse_sort(), then by id
+
+        NULLs sort after every value, and so first when descending, which is
+        the order of the btree indexes the sort runs on
+        """
+        if query is None:
+            query = cls.replica_query()
+        order = []
+        for column, descending in cls._sort_columns(sort):
+            if column.nullable:
+                order.append(column.desc().nulls_first() if descending else column.asc().nulls_last())
+            else:
+                order.append(column.desc() if descending else column)
+        if not sort or sort[-1][0] != "id":
+            # id breaks ties so every page boundary is exact
+            order.append(cls.id)
+        return query.order_by(None).order_by(*order)
+
+    @staticmethod
+    def sort_values(message: dict, sort) -> list:
+        """Returns the values a serialized Product sorts by, for the cursor of the next page"""
+        return [message[key] for key, _ in sort or []]
+
+    @classmethod
+    def _sort_columns(cls, sort) -> list:
+        """Returns (column, descending) for each sort key, the columns are not wrapped so indexes apply"""
+        return [(cls.__table__.c[key], descending) for key, descending in sort or []]
+
+    @classmethod
+    def _after(cls, sort, after_keys, after_id):
+        """Returns the condition for the rows after (after_keys, after_id) in the sort order"""
+        terms = [
+            (column, descending, value)
+            for (column, descending), value in zip(cls._sort_columns(sort), after_keys)
+        ]
+        if not sort or sort[-1][0] != "id":
+            terms.append((cls.__table__.c.id, False, after_id))
+        conditions = []
+        for index, (column, descending, value) in enumerate(terms):
+            equal = [
+                earlier.is_(None) if earlier_value is None else earlier == earlier_value
+                for earlier, _, earlier_value in terms[:index]
+            ]
+            conditions.append(and_(*equal, _beyond(column, descending, value)))
+        return or_(*conditions)
+
+    @classmethod
+    def serialize_query(cls, query=None, fields=None, pending_likes=True) -> list:
+        """Serializes the Products matched by query straight from column tuples
+
+        This skips building ORM instances, which is most of the cost of
+        listing Products. The dictionaries match Product.serialize()
+
+        :param query: an optional filtered query, e.g. from find_by_category
+        :param fields: the only columns to select, all of them if None
+        :param pending_likes: add the likes still in the like buffer, like serialize()
+        :return: a list of serialized Products
+        :rtype: list
+
+        """
+        if query is None:
+            query = cls.replica_query()
+        columns = [column for column in cls.__table__.columns if fields is None or column.key in fields]
+        keys = [column.key for column in columns]
+        messages = [dict(zip(keys, row)) for row in query.with_entities(*columns)]
+        return cls.add_pending_likes(messages) if pending_likes else messages
+
+    @classmethod
+    def stream(cls, query=None, batch_size: int = 1000):
+        """Returns an iterator over Products ordered by id
+
+        Rows are fetched batch_size at a time through a server-side cursor,
+        so memory use stays constant however large the catalog grows
+
+        :param query: an optional filtered query, e.g. from find_by_category
+        :param batch_size: the number of rows fetched per round-trip
+        :type batch_size: int
+        :return: an iterator of Products
+
+        """
+        logger.info("Processing stream of Products in batches of %s ...", batch_size)
+        if query is None:
+            query = cls.replica_query()
+        query = query.order_by(None).order_by(cls.id)
+        return query.execution_options(stream_results=True).yield_per(batch_size)
 
     @classmethod
     def find(cls, product_id: int):
@@ -169,7 +997,54 @@ class Product(db.Model):
         """
         logger.info("Processing lookup for id %s ...", product_id)
 
-        return cls.query.get(product_id)
+        return db.session.get(cls, product_id, execution_options={"replica": True})
+
+    @classmethod
+    def find_serialized(cls, product_id: int):
+        """Finds a Product by it's ID through the read-through cache
+
+        :param product_id: the id of the Product to find
+        :type product_id: int
+
+        :return: the serialized Product with the product_id, or None if not found
+        :rtype: dict
+
+        """
+        key = _cache_key(product_id)
+        if key is None:
+            return None
+
+        def load():
+            # the cache is shared, so it is filled from the primary
+            with primary_reads(db.session):
+                product = cls.find(key)
+                return product.serialize(pending_likes=False) if product else None
+
+        # the cache holds the rows as saved, the buffered likes are added to a copy
+        message = product_cache.fetch(key, load)
+        return cls.add_pending_likes([dict(message)])[0] if message else None
+
+    @classmethod
+    def find_many_serialized(cls, product_ids) -> list:
+        """Finds many Products by id, from the cache first and then with one IN query
+
+        :param product_ids: the ids of the Products to find
+        :type product_ids: list
+
+        :return: the serialized Products in the order of product_ids, None for each one not found
+        :rtype: list
+
+        """
+        keys = [_cache_key(product_id) for product_id in product_ids]
+
+        def load(missing):
+            with primary_reads(db.session):
+                query = cls.replica_query().filter(cls.id.in_(missing))
+                return {product["id"]: product for product in cls.serialize_query(query, pending_likes=False)}
+
+        wanted = [key for key in keys if key is not None]
+        found = product_cache.fetch_many(wanted, load) if wanted else {}
+        return [cls.add_pending_likes([dict(found[key])])[0] if key in found else None for key in keys]
 
     @classmethod
     def find_or_404(cls, product_id: int):
@@ -197,7 +1072,7 @@ class Product(db.Model):
 
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.replica_query().filter(cls.name == name).order_by(cls.id)
 
     @classmethod
     def find_by_price_range(cls, lower_price: int, higher_price: int) -> list:
@@ -212,7 +1087,7 @@ class Product(db.Model):
 
         """
         logger.info("Processing price range query from %s to %s ...", lower_price, higher_price)
-        return cls.query.filter(cls.price >= lower_price, cls.price <= higher_price)
+        return cls.replica_query().filter(cls.price >= lower_price, cls.price <= higher_price).order_by(cls.id)
 
     @classmethod    
     def find_by_category(cls, category: str) -> list:
@@ -224,7 +1099,7 @@ class Product(db.Model):
         """
         
         logger.info("Processing name query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        return cls.replica_query().filter(cls.category == category).order_by(cls.id)
 
     # @classmethod
     # def find_by_price(cls, low: int, high: int) -> list:
@@ -237,3 +1112,55 @@ class Product(db.Model):
 
     #     logger.info("Processing price query for price range between %i", low)
     #     return cls.query.filter(cls.price_range == (low, high))
+
+
+# Postgres databases built by create_all() get the search indexes migration 3 adds to old ones
+for _statement in search.SEARCH_INDEXES.values():
+    event.listen(
+        Product.__table__,
+        "after_create",
+        DDL(_statement.format(concurrently="")).execute_if(dialect="postgresql"),
+    )
+
+
+def _checked_price(key, value):
+    """Returns a valid bulk change of the price as an int"""
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise DataValidationError(f"Invalid type for integer [{key}]: " + str(type(value)))
+    if value < 0:
+        raise DataValidationError("Invalid value for price. Price should be a non-negative value")
+    return value
+
+
+def _checked_name(key, value):  # pylint: disable=unused-argument
+    """Returns a valid bulk change of the name"""
+    if not isinstance(value, str) or not 0 < len(value) <= 20:
+        raise DataValidationError("Invalid value for name. Name length should between 1 - 20 characters.")
+    return value
+
+
+def _checked_text(key, value):
+    """Returns a valid bulk change of an optional string"""
+    if value is not None and not isinstance(value, str):
+        raise DataValidationError(f"Invalid type for string [{key}]: " + str(type(value)))
+    return value
+
+
+def _beyond(column, descending: bool, value):
+    """Returns the condition for the values of column after value in the order of sort_query()"""
+    if value is None:
+        # NULLs are last, or first when descending
+        return column.isnot(None) if descending else false()
+    if descending:
+        return column < value
+    return or_(column > value, column.is_(None)) if column.nullable else column > value
+
+
+def _cache_key(product_id):
+    """Normalizes a product id from the URL into a cache key, None if it is not a number"""
+    try:
+        return int(product_id)
+    except (TypeError, ValueError):
+        return None
@@ -1,29 +1,52 @@
 """
 Product Service
 Paths -- RESTful:
-GET /products - Returns a list all of the Products
+GET /metrics - Returns the service metrics for Prometheus
+GET /products - Returns a list all of the Products (paged with ?limit=&cursor=)
+    filtered by any of ?category=&name=&price_range=100_200&min_like=&max_like=
+    and sorted with ?sort=price,-like
+    with only some fields with ?fields=id,name (also GET /products/{id})
 GET /products/{id} - Returns the Product with a given id number
 POST /products - creates a new Product record in the database
 PUT /products/{id} - updates a Product record in the database
 DELETE /products/{id} - deletes a Product record in the database
+GET /products?q=words - Returns the Products best matching a full-text search
+GET /products/suggest?prefix=ip - Returns the Product names starting with a prefix
+GET /products/stats?group_by=category - Returns the counts, prices and likes (per category)
+GET /products/top?by=like&n=10&category= - Returns the most liked Products
+GET /products?ids=1,2,3 - Returns the Products with those ids in order (also POST /products/lookup)
+GET /products/export - Streams all of the Products as newline-delimited JSON
+POST /products/bulk - creates many Product records from a JSON array or NDJSON
+PATCH /products - updates every Product matching the query filters
+DELETE /products - deletes every Product matching the query filters
 """
 
 # import sys
-import secrets
+import base64
+import hashlib
+import json
 # import logging
-from functools import wraps
 # from flask_restx import Api, Resource, fields, reqparse, inputs
 # from flask import jsonify, request, url_for, abort,make_response
 # from service.models import Product
 # from service.common import status  # HTTP Status Codes
 # from . import app, api # Import Flask application
 
-from flask import jsonify, request, url_for, make_response, abort
-from service.models import Product
+from flask import jsonify, request, abort, has_app_context, Response, stream_with_context
+from service.models import db, Product, CatalogVersion, DataValidationError, product_cache, top_ranking, TOP_KEYS
 from service.common import status  # HTTP Status Codes
-from flask_restx import Api, Resource, fields, reqparse, inputs
+from service.common.encoders import get_encoder
+from service.common.idempotency import idempotent
+from service.common.instrumentation import timer
+from service.common.like_buffer import LikeBuffer
+from service.common.pooling import pool_status
+from service.common.replicas import primary_reads
+from service.common import metrics as service_metrics
+from flask_restx import Api, Resource, fields, reqparse, inputs, marshal
+from sqlalchemy.orm import load_only
 from . import app  # Import Flask application
-from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
+
 
 ######################################################################
 # GET HEALTH CHECK
@@ -31,7 +54,23 @@ from werkzeug.exceptions import NotFound
 @app.route("/health")
 def healthcheck():
     """Let them know our heart is still beating"""
-    return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
+    return (
+        jsonify(
+            status=200, message="Healthy", cache=product_cache.stats(), pool=pool_status(db.engine),
+            likes=like_buffer.stats(),
+        ),
+        status.HTTP_200_OK,
+    )
+
+
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Exposes the service metrics in the Prometheus text format"""
+    data, content_type = service_metrics.render()
+    return Response(data, content_type=content_type)
 
 
 ######################################################################
@@ -83,14 +122,154 @@ product_model = api.inherit(
     {
         'id': fields.Integer(readOnly=True,
                             description='The unique id assigned internally by service'),
+        'version': fields.Integer(readOnly=True,
+                                  description='Incremented on every change, the ETag is built from it'),
     }
 )
 
+lookup_model = api.model('ProductLookup', {
+    'ids': fields.List(fields.Integer, required=True, description='The ids of the Products to return, in order'),
+})
+
+stats_model = api.model('ProductStats', {
+    'category': fields.String(description='The category, only when grouped by category'),
+    'count': fields.Integer(description='The number of Products'),
+    'price_min': fields.Integer(description='The lowest price'),
+    'price_max': fields.Integer(description='The highest price'),
+    'price_avg': fields.Float(description='The average price'),
+    'price_total': fields.Integer(description='The sum of the prices'),
+    'like_total': fields.Integer(description='The sum of the likes'),
+})
+
+
 # query string arguments
-product_args = reqparse.RequestParser()
-product_args.add_argument('name', type=str, location='args', required=False, help='List Products by name')
-product_args.add_argument('category', type=str, location='args', required=False, help='List Products by category')
-product_args.add_argument('price_range', type=str, location='args', required=False, help='List Products by price range')
+def price_range(value):
+    """Parses a price range like 100_200 into [100, 200]"""
+    try:
+        low, high = (int(price) for price in value.split("_"))
+    except ValueError:
+        raise ValueError(f"price_range must be two prices like 100_200, not '{value}'") from None
+    if low < 0 or low > high:
+        raise ValueError(f"price_range must go from a lower to a higher price, not '{value}'")
+    return [low, high]
+
+
+price_range.__schema__ = {"type": "string", "pattern": r"^\d+_\d+$", "example": "100_200"}
+
+
+def sort_order(value):
+    """Checks a sort order like price,-like"""
+    try:
+        Product.parse_sort(value)
+    except DataValidationError as error:
+        raise ValueError(str(error)) from None
+    return value
+
+
+sort_order.__schema__ = {"type": "string", "example": "price,-like"}
+
+
+def id_list(value):
+    """Parses a comma separated list of Product ids like 1,2,3"""
+    try:
+        product_ids = [int(part) for part in value.split(",")]
+    except ValueError:
+        raise ValueError(f"ids must be comma separated numbers, not '{value}'") from None
+    return product_ids
+
+
+id_list.__schema__ = {"type": "string", "example": "1,2,3"}
+
+# the fields of a serialized Product, in order
+PRODUCT_FIELDS = [column.key for column in Product.__table__.columns]
+
+
+def field_list(value):
+    """Parses a comma separated list of Product fields like id,name,price"""
+    names = {name.strip() for name in value.strip("{}").split(",") if name.strip()}
+    if not names or names - set(PRODUCT_FIELDS):
+        raise ValueError(f"fields must be some of {','.join(PRODUCT_FIELDS)}, not '{value}'")
+    return [field for field in PRODUCT_FIELDS if field in names]
+
+
+field_list.__schema__ = {"type": "string", "example": "id,name,price"}
+
+# the build_query() filters of filter_args
+FILTERS = ("category", "name", "price_range", "min_like", "max_like")
+
+filter_args = reqparse.RequestParser()
+filter_args.add_argument('name', type=str, location='args', required=False, help='List Products by name')
+filter_args.add_argument('category', type=str, location='args', required=False, help='List Products by category')
+filter_args.add_argument('price_range', type=price_range, location='args', required=False,
+                         help='List Products by price range, like 100_200')
+filter_args.add_argument('min_like', type=inputs.natural, location='args', required=False,
+                         help='List Products with at least this many likes')
+filter_args.add_argument('max_like', type=inputs.natural, location='args', required=False,
+                         help='List Products with at most this many likes')
+
+bulk_args = filter_args.copy()
+bulk_args.add_argument('all', type=inputs.boolean, location='args', required=False, default=False,
+                       help='Set to true to change every Product when no filter is given')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=field_list, location='args', required=False,
+                         help='Comma separated fields to return, e.g. id,name,price (or an X-Fields header)')
+
+product_args = filter_args.copy()
+product_args.add_argument('fields', type=field_list, location='args', required=False,
+                          help='Comma separated fields to return, e.g. id,name,price (or an X-Fields header)')
+product_args.add_argument('limit', type=inputs.positive, location='args', required=False,
+                          help='Maximum number of Products per page')
+product_args.add_argument('cursor', type=str, location='args', required=False,
+                          help='Opaque cursor from the "next" link of the previous page')
+product_args.add_argument('sort', type=sort_order, location='args', required=False,
+                          help='Comma separated keys to sort by, - for descending, e.g. price,-like. '
+                               'Products without a name or category come last ascending')
+product_args.add_argument('q', type=str, location='args', required=False,
+                          help='Search the name and description, best matches first (up to limit)')
+product_args.add_argument('ids', type=id_list, location='args', required=False,
+                          help='Comma separated ids to look up, in order, instead of listing')
+
+suggest_args = reqparse.RequestParser()
+suggest_args.add_argument('prefix', type=str, location='args', required=True,
+                          help='The start of the Product name typed so far')
+suggest_args.add_argument('limit', type=inputs.positive, location='args', required=False,
+                          help='Maximum number of names')
+
+stats_args = reqparse.RequestParser()
+stats_args.add_argument('group_by', type=str, location='args', required=False, choices=('category',),
+                        help='Return the stats of each category instead of the whole catalog')
+
+top_args = reqparse.RequestParser()
+top_args.add_argument('by', type=str, location='args', required=False, default='like', choices=TOP_KEYS,
+                      help='Rank by the like count or the price')
+top_args.add_argument('n', type=inputs.positive, location='args', required=False,
+                      help='Number of Products to return')
+top_args.add_argument('category', type=str, location='args', required=False,
+                      help='Only rank the Products of this category')
+
+
+def flush_likes(deltas):
+    """Writes buffered likes, called from the LikeBuffer thread or a liking request past LIKE_MAX_LAG_MS"""
+    if has_app_context():
+        # a nested context would share the request's session and remove it when popped
+        Product.increment_likes(deltas)
+        return
+    with app.app_context():
+        Product.increment_likes(deltas)
+
+
+# names returned by GET /products/suggest without a limit
+SUGGEST_LIMIT = 10
+
+# likes are written directly unless LIKE_FLUSH_INTERVAL_MS is set
+like_buffer = LikeBuffer(
+    flush_likes,
+    app.config["LIKE_FLUSH_INTERVAL_MS"],
+    app.config["LIKE_JOURNAL_DIR"] or None,
+    app.config["LIKE_MAX_LAG_MS"],
+)
+Product.like_buffer = like_buffer
 
 
 ######################################################################
@@ -99,47 +278,103 @@ product_args.add_argument('price_range', type=str, location='args', required=Fal
 @api.route('/products', strict_slashes=False)
 class ProductCollection(Resource):
 
-
     ######################################################################
     # LIST ALL PRODUCTS
     ######################################################################
     
     @api.doc('list_products')
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.response(200, 'Success', [product_model])
+    @api.response(304, 'The catalog has not changed since the ETag in If-None-Match')
     def get(self):
         """Returns all of the Products"""
         app.logger.info("Request for Product list")
-        products = []
-
-        category = request.args.get("category")
-        name = request.args.get("name")
-        price_range = request.args.get("price_range")
-
-        if category:
-            app.logger.info("Find by category: %s", category)
-            products = Product.find_by_category(category)
-        elif name:
-            app.logger.info("Find by name: %s", name)
-            products = Product.find_by_name(name)
-        elif price_range:
-            app.logger.info("Find by price range: %s", price_range)
-            low, high = price_range.split("_")
-            products = Product.find_by_price_range(int(low), int(high))
+        args = product_args.parse_args()
+        args["fields"] = requested_fields(args)
+        if args["ids"] is not None:
+            if any(args[key] is not None for key in ("limit", "cursor", "sort", "q") + FILTERS):
+                raise DataValidationError("ids cannot be combined with paging, sorting, search or filters")
+            return lookup_products(args["ids"], args["fields"])
+        bounded = is_bounded(args)
+        if bounded:
+            # the cached pages are loaded from the primary, so is the stamp they are checked against
+            with primary_reads(db.session):
+                version, likes = CatalogVersion.stamp()
+        else:
+            version, likes = CatalogVersion.stamp()
+        etag = list_etag(args, [version, likes, like_buffer.stamp()])
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        if bounded:
+            # filtered and paged lists are bounded so they are shared through the cache
+            key = list_cache_key(version, args, likes if depends_on_likes(args) else None)
+            page = product_cache.fetch(key, lambda: load_list(args), namespace="lists")
+            results = with_current_likes(page["results"])
         else:
             app.logger.info("Find all")
-            products = Product.all()
+            page = list_products(args)
+            results = with_pending_likes(page["results"])
+        page = dict(page, results=project(results, args["fields"]))
+
+        headers = {"ETag": quote_etag(etag), "Vary": "X-Fields"}
+        if page["next"] is not None:
+            headers["Link"] = f'<{next_page_url(page["next"])}>; rel="next"'
+        app.logger.info("[%s] Products returned", len(page["results"]))
+        if app.config["FAST_SERIALIZATION"]:
+            # the rows already have the product_model fields, skip marshalling them again
+            encode = get_encoder(app.config["JSON_ENCODER"])
+            with timer("encode"):
+                body = encode(page["results"])
+            return Response(body, mimetype="application/json", headers=headers)
+        with timer("marshal"):
+            results = marshal(page["results"], product_model, mask=field_mask(args["fields"]))
+        return results, status.HTTP_200_OK, headers
+
+    ######################################################################
+    # UPDATE ALL MATCHING PRODUCTS
+    ######################################################################
+    @api.doc('bulk_update_products', security='apikey')
+    @api.response(400, 'The posted changes were not valid')
+    @api.expect(bulk_args, create_model, validate=False)
+    def patch(self):
+        """
+        Update all matching Products
+        This endpoint applies the posted fields to every Product matching the filters
+        """
+        app.logger.info("Request to bulk update products")
+        check_content_type("application/json")
+        query = bulk_query()
+        count = Product.bulk_update(request.get_json(), query)
+        app.logger.info("[%s] Products updated", count)
+        return {"updated": count}, status.HTTP_200_OK
 
-        results = [product.serialize() for product in products]
-        app.logger.info("[%s] Products returned", len(results))
-        return results, status.HTTP_200_OK
+    ######################################################################
+    # DELETE ALL MATCHING PRODUCTS
+    ######################################################################
+    @api.doc('bulk_delete_products', security='apikey')
+    @api.response(400, 'No filter was given without all=true, or an argument is unknown')
+    @api.expect(bulk_args, validate=True)
+    def delete(self):
+        """
+        Delete all matching Products
+        This endpoint deletes every Product matching the filters, or all of them with all=true
+        """
+        app.logger.info("Request to bulk delete products")
+        query = bulk_query()
+        count = Product.bulk_delete(query)
+        app.logger.info("[%s] Products deleted", count)
+        return {"deleted": count}, status.HTTP_200_OK
 
     ######################################################################
     # ADD A NEW PRODUCT
     ######################################################################
     
+    @idempotent
     @api.doc('create_products', security='apikey')
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'A request with the same Idempotency-Key is still in progress')
+    @api.param('Idempotency-Key', 'Replays the stored response to a retried request', _in='header')
     @api.expect(create_model)
     @api.marshal_with(product_model, code=201)
     # @app.route("/products", methods=["POST"])
@@ -157,9 +392,183 @@ class ProductCollection(Resource):
         message = product.serialize()
         location_url = api.url_for(ProductResource, product_id =product.id, _external=True)
         app.logger.info("Product with ID [%s] created.", product.id)
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        return message, status.HTTP_201_CREATED, {"Location": location_url, "ETag": quote_etag(product_etag(message))}
+
+
+######################################################################
+#  PATH: /products/bulk
+######################################################################
+@api.route('/products/bulk')
+class ProductBulk(Resource):
+    """Creates many Products in a single transaction"""
+
+    @api.doc('bulk_create_products', security='apikey')
+    @api.response(400, 'None of the posted Products were valid')
+    @api.expect([create_model])
+    def post(self):
+        """
+        Creates many Products
+        This endpoint accepts a JSON array or newline-delimited JSON of Products
+        and reports the ones that could not be created
+        """
+        app.logger.info("Request to bulk create products")
+        check_content_type("application/json", "application/x-ndjson")
+        if request.mimetype == "application/json":
+            items = request.get_json()
+            if not isinstance(items, list):
+                raise DataValidationError("Invalid request: body must be a JSON array of Products")
+            items = enumerate(items)
+        else:
+            items = read_ndjson(request.stream)
+
+        products = []
+        errors = []
+        for index, item in items:
+            try:
+                if isinstance(item, ValueError):
+                    raise DataValidationError(f"Invalid JSON: {item}")
+                if not isinstance(item, dict):
+                    raise DataValidationError("Invalid product: must be a JSON object")
+                products.append(Product().deserialize(item))
+            except DataValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+
+        created = Product.bulk_create(products, app.config["BULK_CHUNK_SIZE"])
+        app.logger.info("[%s] Products created, [%s] rejected", created, len(errors))
+        code = status.HTTP_400_BAD_REQUEST if errors and not created else status.HTTP_201_CREATED
+        return {"created": created, "errors": errors}, code
+
+
+######################################################################
+#  PATH: /products/lookup
+######################################################################
+@api.route('/products/lookup')
+class ProductLookup(Resource):
+    """Looks up many Products by id at once"""
+
+    @api.doc('lookup_products')
+    @api.expect(fields_args, lookup_model, validate=False)
+    @api.response(400, 'The posted ids were not valid')
+    def post(self):
+        """
+        Look up Products by id
+        This endpoint returns the Products with the posted ids in the same order,
+        with {"id": ..., "found": false} for the ones that do not exist
+        """
+        check_content_type("application/json")
+        data = request.get_json()
+        product_ids = data.get("ids") if isinstance(data, dict) else None
+        if not isinstance(product_ids, list) or not all(
+            isinstance(product_id, int) and not isinstance(product_id, bool) for product_id in product_ids
+        ):
+            raise DataValidationError("Invalid request: body must be a JSON object with a list of ids")
+        return lookup_products(product_ids, requested_fields(fields_args.parse_args()))
+
+
+######################################################################
+#  PATH: /products/export
+######################################################################
+@api.route('/products/export')
+class ProductExport(Resource):
+    """Streams the Product catalog without building it in memory"""
+
+    @api.doc('export_products')
+    @api.expect(filter_args, validate=True)
+    @api.produces(['application/x-ndjson'])
+    def get(self):
+        """
+        Export the Products
+        This endpoint streams every Product as one JSON document per line
+        """
+        app.logger.info("Request to export Products")
+        query = filter_products(filter_args.parse_args())
+        batch_size = app.config["EXPORT_BATCH_SIZE"]
+        products = Product.stream(query, batch_size)
+
+        def generate():
+            lines = []
+            for product in products:
+                lines.append(json.dumps(product.serialize()))
+                if len(lines) == batch_size:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if lines:
+                yield "\n".join(lines) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+######################################################################
+#  PATH: /products/suggest
+######################################################################
+@api.route('/products/suggest')
+class ProductSuggest(Resource):
+    """Autocompletes Product names"""
+
+    @api.doc('suggest_products')
+    @api.expect(suggest_args, validate=True)
+    def get(self):
+        """
+        Suggest Product names
+        This endpoint returns the distinct Product names starting with a prefix
+        """
+        args = suggest_args.parse_args()
+        app.logger.info("Request for suggestions for %s", args["prefix"])
+        limit = min(args["limit"] or SUGGEST_LIMIT, app.config["PAGE_SIZE_MAX"])
+        return Product.suggest(args["prefix"], limit), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/top
+######################################################################
+@api.route('/products/top')
+class ProductTop(Resource):
+    """Leaderboard of the most liked (or most expensive) Products"""
+
+    @api.doc('top_products')
+    @api.expect(top_args, validate=True)
+    @api.response(200, 'Success', [product_model])
+    def get(self):
+        """
+        Top Products
+        This endpoint returns the n Products with the most likes (or the highest price)
+        """
+        args = top_args.parse_args()
+        n = min(args["n"] or app.config["TOP_N_DEFAULT"], app.config["PAGE_SIZE_MAX"])
+        app.logger.info("Request for the top %s Products by %s in %s", n, args["by"], args["category"])
+        if args["by"] == "like" and app.config["TOP_RANKING"]:
+            products = top_ranking.top(n, args["category"], top_products)
+        else:
+            products = Product.serialize_query(Product.top(args["by"], n, args["category"]))
+        return marshal(products, product_model), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /products/stats
+######################################################################
+@api.route('/products/stats')
+class ProductStats(Resource):
+    """Summarizes the Product catalog"""
+
+    @api.doc('product_stats')
+    @api.expect(stats_args, validate=True)
+    @api.response(200, 'Success', stats_model)
+    @api.response(304, 'The stats have not changed since the ETag in If-None-Match')
+    def get(self):
+        """
+        Product statistics
+        This endpoint returns the count, price range and average and total likes
+        of the catalog, or of each category with group_by=category
+        """
+        args = stats_args.parse_args()
+        app.logger.info("Request for Product stats grouped by %s", args["group_by"])
+        # the stats leave out buffered likes, so the database stamp is all they depend on
+        etag = list_etag(dict(args, stats=True), CatalogVersion.stamp())
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        stats = Product.stats(args["group_by"], app.config["STATS_FROM_SUMMARY"])
+        return stats, status.HTTP_200_OK, {"ETag": quote_etag(etag)}
+
 
 ######################################################################
 #  PATH: /products/{id}
@@ -180,8 +589,10 @@ class ProductResource(Resource):
     ######################################################################
     
     @api.doc('get_products')
+    @api.expect(fields_args, validate=True)
+    @api.response(200, 'Success', product_model)
+    @api.response(304, 'The Product has not changed since the ETag in If-None-Match')
     @api.response(404, 'Product not found')
-    @api.marshal_with(product_model)
     # @app.route("/products/<int:product_id>", methods=["GET"])
     def get(self, product_id):
         """
@@ -189,12 +600,16 @@ class ProductResource(Resource):
         This endpoint will return a Product based on it's id
         """
         app.logger.info("Request for product with id: %s", product_id)
-        product = Product.find(product_id)
-        if not product:
+        fields = requested_fields(fields_args.parse_args())
+        message = Product.find_serialized(product_id)
+        if not message:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
-        app.logger.info("Returning product: %s", product.name)
-        return product.serialize(), status.HTTP_200_OK
-
+        etag = product_etag(message, fields)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        app.logger.info("Returning product: %s", message["name"])
+        headers = {"ETag": quote_etag(etag), "Vary": "X-Fields"}
+        return marshal(message, product_model, mask=field_mask(fields)), status.HTTP_200_OK, headers
 
     ######################################################################
     # DELETE A PRODUCT
@@ -212,19 +627,18 @@ class ProductResource(Resource):
 
         app.logger.info("Request to delete product with id: %s", product_id)
 
-        product = Product.find(product_id)
-        if product:
-            product.delete()
-        app.logger.info("Product with ID [%s] delete complete.", product_id) 
+        Product.delete_by_id(product_id)
+        app.logger.info("Product with ID [%s] delete complete.", product_id)
         return "", status.HTTP_204_NO_CONTENT
 
-
     ######################################################################
     # UPDATE AN EXISTING PRODUCT
     ######################################################################
     @api.doc('update_products', security='apikey')
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted Product data was not valid')
+    @api.response(409, 'The Product was changed by another request')
+    @api.response(412, 'The Product has changed since the ETag in If-Match')
     @api.expect(product_model)
     @api.marshal_with(product_model)
     # @token_required
@@ -240,6 +654,9 @@ class ProductResource(Resource):
         product = Product.find(product_id)
         if not product:
             abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        # compressed responses carry the weak form of the same tag, see common/compression.py
+        if request.if_match and not request.if_match.contains_weak(product_etag(product.serialize())):
+            abort(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product_id}' has changed.")
         origin_like = product.like
         product.deserialize(request.get_json())
         product.id = product_id
@@ -247,7 +664,8 @@ class ProductResource(Resource):
         product.update()
 
         app.logger.info("Product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        message = product.serialize()
+        return message, status.HTTP_200_OK, {"ETag": quote_etag(product_etag(message))}
 
 
 ######################################################################
@@ -260,21 +678,32 @@ class LikeResource(Resource):
     ######################################################################
     # LIKE A PRODUCT
     ######################################################################
+    @idempotent
     @api.doc('like_products')
+    @api.response(409, 'A request with the same Idempotency-Key is still in progress')
+    @api.param('Idempotency-Key', 'Replays the stored response to a retried like', _in='header')
     # @api.response(404, 'Product not found')
     # @api.response(409, 'The Product is not available for purchase')
     # @app.route("/products/<int:product_id>/like", methods=["PUT"])
     def put(self, product_id):
         """Like a Product makes it Likes Count Increment 1"""
-        product = Product.find(product_id)
-        if not product:
-            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
         app.logger.info("Request to like product with id: %s", product_id)
-        app.logger.info("Request to like product with like count: %s", product.like)
-        product.like += 1
-        product.update()
-        return product.serialize(), status.HTTP_200_OK
-    
+        if like_buffer.enabled:
+            product = Product.find(product_id)
+            if not product:
+                abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+            # serialized first, adding the like may flush and commit the session
+            message = product.serialize()
+            like_buffer.add(product.id)
+            message["like"] += 1
+        else:
+            message = Product.increment_like(product_id)
+            if not message:
+                abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        if app.config["TOP_RANKING"]:
+            top_ranking.liked(message)
+        app.logger.info("Product with ID [%s] like count: %s", product_id, message["like"])
+        return message, status.HTTP_200_OK
 
 
 ######################################################################
@@ -286,22 +715,274 @@ def init_db():
     """ Initializes the SQLAlchemy app """
     global app
     Product.init_db(app)
+    if like_buffer.journal_dir:
+        # take over the likes a previous worker left in its journal
+        like_buffer.start()
+
+
+def top_products(category, limit):
+    """Loads the limit most liked Products of category for the in-memory ranking"""
+    return Product.serialize_query(Product.top("like", limit, category))
+
+
+def filter_products(args):
+    """Returns the query for the Products matching every filter in args"""
+    filters = {key: args[key] for key in FILTERS if args.get(key) is not None}
+    app.logger.info("Find by %s", filters or "nothing")
+    return Product.build_query(**filters)
+
+
+def bulk_query():
+    """Returns the query of a bulk update or delete, which must be filtered or name all=true
+
+    Unknown arguments are rejected because a misspelled filter would otherwise
+    match every Product
+    """
+    unknown = set(request.args) - {argument.name for argument in bulk_args.args}
+    if unknown:
+        raise DataValidationError(f"Unknown query arguments: {', '.join(sorted(unknown))}")
+    args = bulk_args.parse_args()
+    if not args["all"] and all(args[key] is None for key in FILTERS):
+        raise DataValidationError("Give at least one filter, or all=true to change every Product")
+    return filter_products(args)
+
+
+def list_products(args):
+    """Returns one page of serialized Products and the cursor of the next page
+
+    The Products have the fetched_fields() as saved, without the buffered
+    likes, so the page can be cached
+    """
+    query, limit = list_query(args)
+    fetch = fetched_fields(args)
+    with timer("serialize"):
+        if app.config["FAST_SERIALIZATION"]:
+            results = Product.serialize_query(query, fetch, pending_likes=False)
+        else:
+            if fetch is not None:
+                query = query.options(load_only(*(getattr(Product, field) for field in fetch)))
+            results = [product.serialize(fetch, pending_likes=False) for product in query]
+    return page_of(results, limit, args)
+
+
+def load_list(args):
+    """Loads a list page for the cache from the primary, so other workers never get a lagging replica's rows"""
+    with primary_reads(db.session):
+        return list_products(args)
+
+
+def with_pending_likes(results):
+    """Returns serialized Products with their buffered likes, copied so a cached page stays as saved"""
+    if not like_buffer.enabled:
+        return results
+    return Product.add_pending_likes([dict(result) for result in results])
+
+
+def with_current_likes(results):
+    """Returns the Products of a cached page with the like counts they have now, copied so the page stays as saved
+
+    Likes don't invalidate cached lists, so the counts are taken from the
+    product cache, which every like does invalidate, with the buffered likes
+    """
+    if not results or "like" not in results[0]:
+        return results
+    current = Product.find_many_serialized([result["id"] for result in results])
+    return [
+        dict(result, like=product["like"]) if product else dict(result)
+        for result, product in zip(results, current)
+    ]
+
+
+def depends_on_likes(args):
+    """Returns True when the like counts decide which Products args list, or in what order"""
+    if args["min_like"] is not None or args["max_like"] is not None:
+        return True
+    return bool(args["sort"]) and "like" in dict(Product.parse_sort(args["sort"]))
+
+
+def lookup_products(product_ids, fields=None):
+    """Returns the Products with product_ids in order, and markers for the missing ones"""
+    if len(product_ids) > app.config["PAGE_SIZE_MAX"]:
+        raise DataValidationError(f"Cannot look up more than {app.config['PAGE_SIZE_MAX']} ids at once")
+    app.logger.info("Request to look up %s Products", len(product_ids))
+    products = Product.find_many_serialized(product_ids)
+    results = [
+        project([product], fields)[0] if product else {"id": product_id, "found": False}
+        for product_id, product in zip(product_ids, products)
+    ]
+    if app.config["FAST_SERIALIZATION"]:
+        encode = get_encoder(app.config["JSON_ENCODER"])
+        with timer("encode"):
+            body = encode(results)
+        return Response(body, mimetype="application/json", headers={"Vary": "X-Fields"})
+    return results, status.HTTP_200_OK, {"Vary": "X-Fields"}
+
+
+def is_bounded(args):
+    """Returns True when args limit the list to a page or a filtered part of the catalog"""
+    return bool(args["limit"] or args["cursor"] or args["q"] or any(args.get(key) is not None for key in FILTERS))
+
+
+def requested_fields(args):
+    """Returns the fields asked for with ?fields= or an X-Fields mask, None for all of them"""
+    if args.get("fields"):
+        return args["fields"]
+    mask = request.headers.get("X-Fields")
+    if not mask:
+        return None
+    try:
+        return field_list(mask)
+    except ValueError as error:
+        raise DataValidationError(str(error)) from error
+
+
+def fetched_fields(args):
+    """Returns the fields to select for args, the requested ones plus what paging needs"""
+    if not args.get("fields"):
+        return None
+    needed = set(args["fields"]) | {"id"}
+    if args["sort"]:
+        needed.update(key for key, _ in Product.parse_sort(args["sort"]))
+    return [field for field in PRODUCT_FIELDS if field in needed]
+
+
+def project(results, fields):
+    """Trims serialized Products down to fields, None keeps them whole"""
+    if fields is None:
+        return results
+    return [{field: result[field] for field in fields} for result in results]
+
+
+def field_mask(fields):
+    """Returns the flask-restx mask for fields, None for all of them"""
+    return "{%s}" % ",".join(fields) if fields else None
+
+
+def list_query(args):
+    """Returns the query for the Products listed by args and the page size, None when not paged"""
+    query = filter_products(args)
+    if args["q"]:
+        if args["cursor"] or args["sort"]:
+            raise DataValidationError("A search returns its best matches at once, it can't take a cursor or sort")
+        limit = min(args["limit"] or app.config["PAGE_SIZE_DEFAULT"], app.config["PAGE_SIZE_MAX"])
+        return Product.search(args["q"], limit, query), None
+    sort = Product.parse_sort(args["sort"]) if args["sort"] else []
+    if not (args["limit"] or args["cursor"]):
+        return Product.sort_query(query, sort), None
+    limit = min(args["limit"] or app.config["PAGE_SIZE_DEFAULT"], app.config["PAGE_SIZE_MAX"])
+    after_id, after_keys = decode_cursor(args["cursor"], len(sort)) if args["cursor"] else (None, None)
+    # fetch one extra row to find out if there is a next page
+    return Product.page_query(limit + 1, after_id, query, sort, after_keys), limit
+
+
+def page_of(results, limit, args):
+    """Trims the extra row fetched by list_query() off results and makes the cursor of the next page"""
+    cursor = None
+    if limit is not None and len(results) > limit:
+        results = results[:limit]
+        sort = Product.parse_sort(args["sort"]) if args["sort"] else []
+        cursor = encode_cursor(results[-1]["id"], Product.sort_values(results[-1], sort))
+    return {"results": results, "next": cursor}
+
+
+def list_cache_key(version, args, likes=None):
+    """Returns the cache key for the list query in args at a catalog version, and like total when given"""
+    if likes is not None:
+        return f"list:{version}.{likes}:{args_digest(args)}"
+    return f"list:{version}:{args_digest(args)}"
+
+
+def args_digest(args):
+    """Returns a stable digest of parsed query args"""
+    return hashlib.sha1(json.dumps(args, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_ndjson(stream):
+    """Yields (index, item) for each line of NDJSON, item is the ValueError for bad lines"""
+    index = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except ValueError as error:
+            yield index, error
+        index += 1
+
+
+def product_etag(message, fields=None):
+    """Returns the strong entity tag (unquoted) of a serialized Product, or of its fields"""
+    etag = f'{message["id"]}-{message["version"]}'
+    buffer = Product.like_buffer
+    if buffer is not None and buffer.enabled and buffer.pending(message["id"]):
+        # buffered likes change the like count without a new version
+        etag += f'-p{buffer.pending(message["id"])}'
+    if fields:
+        return f'{etag}-{args_digest(fields)[:8]}'
+    return etag
+
+
+def list_etag(args, stamp):
+    """Returns the strong entity tag (unquoted) of a list, a digest of its query args and the catalog stamp
+
+    The stamp is the catalog version and its like total from
+    CatalogVersion.stamp(), plus the like buffer's stamp where buffered likes
+    are served. It changes with every write, so a matching If-None-Match is
+    answered before the list is read
+    """
+    return f'l{args_digest([args, list(stamp)])[:32]}'
+
+
+def not_modified(etag):
+    """Builds an empty 304 response for a matching If-None-Match"""
+    app.logger.info("Not modified: %s", etag)
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": quote_etag(etag)})
+
+
+def encode_cursor(product_id, keys=None):
+    """Encodes the last id of a page, and the values it sorts by, into an opaque cursor"""
+    position = {"id": product_id}
+    if keys:
+        position["keys"] = keys
+    token = json.dumps(position).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, key_count=0):
+    """Decodes an opaque cursor back into the last id of a page and the key_count values it sorts by"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+        keys = position.get("keys", [])
+        if not isinstance(keys, list) or len(keys) != key_count:
+            raise ValueError("the cursor is for another sort order")
+        return int(position["id"]), keys
+    except (ValueError, TypeError, KeyError, AttributeError) as error:
+        raise DataValidationError(f"Invalid cursor: {cursor}") from error
+
+
+def next_page_url(cursor):
+    """Builds the link to the page at cursor keeping the other query args"""
+    params = request.args.to_dict()
+    params["cursor"] = cursor
+    return api.url_for(ProductCollection, _external=True, **params)
 
 
-def check_content_type(content_type):
+def check_content_type(*content_types):
     """Checks that the media type is correct"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
     )
@@ -0,0 +1,125 @@
+"""
+Fake Redis server
+
+An in-process stand-in that speaks enough of the Redis protocol for the
+cache backend (PING, AUTH, SELECT, GET, MGET, SET with PX/EX/NX, DEL,
+INCR and FLUSHDB), so tests can exercise the shared cache without a
+real server.
+"""
+import socketserver
+import threading
+import time
+
+
+class Status(str):
+    """A simple string reply such as +OK"""
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """Threaded TCP server holding one in-memory key space"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, FakeRedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+        self._thread = None
+
+    @property
+    def url(self):
+        """The redis:// url clients should connect to"""
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        """Serves requests on a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.01,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the listening socket"""
+        self.shutdown()
+        self.server_close()
+
+    def run(self, args):
+        """Executes one command against the key space"""
+        command = args[0].upper()
+        self.commands.append(command)
+        with self.lock:
+            if command in ("PING", "AUTH", "SELECT"):
+                return Status("PONG" if command == "PING" else "OK")
+            if command == "GET":
+                return self._get(args[1])
+            if command == "MGET":
+                return [self._get(key) for key in args[1:]]
+            if command == "SET":
+                return self._set(args[1], args[2], [arg.upper() for arg in args[3:]], args[3:])
+            if command == "DEL":
+                return sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+            if command == "INCR":
+                value = int(self._get(args[1]) or 0) + 1
+                self.data[args[1]] = (str(value), None)
+                return value
+            if command == "FLUSHDB":
+                self.data.clear()
+                return Status("OK")
+        return ValueError(f"ERR unknown command '{command}'")
+
+    def _get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _set(self, key, value, options, raw):
+        if "NX" in options and self._get(key) is not None:
+            return None
+        expires = None
+        if "PX" in options:
+            expires = time.monotonic() + int(raw[options.index("PX") + 1]) / 1000
+        elif "EX" in options:
+            expires = time.monotonic() + int(raw[options.index("EX") + 1])
+        self.data[key] = (value, expires)
+        return Status("OK")
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Reads commands from one client connection and writes the replies"""
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            self.wfile.write(_encode_reply(self.server.run(args)))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+
+def _encode_reply(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode_reply(item) for item in reply)
+    if isinstance(reply, Status):
+        return b"+%s\r\n" % reply.encode()
+    data = reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
@@ -0,0 +1,261 @@
+"""
+Test cases for the Cache
+"""
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service.common.cache import Cache, CacheError, LRUCache, RedisBackend, create_backend, create_list_backend
+from tests.fake_redis import FakeRedisServer
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(TestCase):
+    """LRU Cache Tests"""
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        self.assertEqual(cache.get(2, "missing"), "missing")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["size"], 1)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+        self.assertEqual(cache.get(1), "a")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "c")
+
+    def test_expire(self):
+        """It should expire entries after the ttl"""
+        cache = LRUCache(maxsize=2, ttl=10)
+        with patch("service.common.cache.time.monotonic", return_value=100):
+            cache.set(1, "a")
+        with patch("service.common.cache.time.monotonic", return_value=105):
+            self.assertEqual(cache.get(1), "a")
+        with patch("service.common.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_add_many(self):
+        """It should only add the missing keys"""
+        cache = LRUCache()
+        cache.set(1, "a")
+        self.assertEqual(cache.add_many({1: "x", 2: "b"}), [False, True])
+        self.assertEqual(cache.get_many([1, 2]), ["a", "b"])
+
+    def test_delete_and_clear(self):
+        """It should invalidate entries"""
+        cache = LRUCache()
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.set(3, "c")
+        cache.delete(1, 4)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), "b")
+        cache.clear()
+        self.assertIsNone(cache.get(2))
+
+    def test_disabled(self):
+        """It should not cache anything with a size of 0"""
+        cache = LRUCache(maxsize=5)
+        cache.set(1, "a")
+        cache.configure(0, 60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, "a")
+        self.assertIsNone(cache.get(1))
+
+
+######################################################################
+#  R E D I S   B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestRedisBackend(TestCase):
+    """Redis Backend Tests against the fake server"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.server = FakeRedisServer().start()
+        self.backend = RedisBackend(self.server.url, ttl=60)
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.server.stop()
+
+    def test_get_and_set(self):
+        """It should store JSON values on the server"""
+        self.assertIsNone(self.backend.get("a"))
+        self.backend.set("a", {"id": 1, "name": "iPhone"})
+        self.assertEqual(self.backend.get("a"), {"id": 1, "name": "iPhone"})
+        self.assertEqual(self.backend.get_many(["a", "b"]), [{"id": 1, "name": "iPhone"}, None])
+        self.backend.delete("a")
+        self.assertIsNone(self.backend.get("a"))
+
+    def test_set_many(self):
+        """It should pipeline many SETs in one round trip"""
+        self.backend.set_many({"a": 1, "b": {"id": 2}})
+        self.assertEqual(self.backend.get_many(["a", "b", "c"]), [1, {"id": 2}, None])
+        self.assertEqual(self.backend.execute_many([("SET", "c", "3"), ("GET", "c")]), ["OK", "3"])
+
+    def test_add(self):
+        """It should only add missing keys"""
+        self.assertTrue(self.backend.add("a", "first"))
+        self.assertFalse(self.backend.add("a", "second"))
+        self.assertEqual(self.backend.get("a"), "first")
+        self.assertEqual(self.backend.add_many({"a": "third", "b": "first"}, ttl=60), [False, True])
+        self.assertEqual(self.backend.get_many(["a", "b"]), ["first", "first"])
+
+    def test_expire(self):
+        """It should let the server expire entries"""
+        self.backend.set("a", 1, ttl=0.001)
+        time.sleep(0.01)
+        self.assertIsNone(self.backend.get("a"))
+
+    def test_reconnect(self):
+        """It should reconnect after the connection drops"""
+        self.backend.set("a", 1)
+        self.backend._socket.close()  # pylint: disable=protected-access
+        self.assertEqual(self.backend.get("a"), 1)
+
+    def test_unavailable(self):
+        """It should raise a CacheError when the server is down"""
+        self.server.stop()
+        backend = RedisBackend(self.server.url)
+        self.assertRaises(CacheError, backend.get, "a")
+
+    def test_create_backend(self):
+        """It should build the backend named in the config"""
+        backend = create_backend({"CACHE_BACKEND": "redis", "CACHE_URL": self.server.url})
+        self.assertIsInstance(backend, RedisBackend)
+        self.assertIsInstance(create_backend({}), LRUCache)
+        self.assertIsNone(create_list_backend({"CACHE_BACKEND": "redis"}))
+        self.assertEqual(create_list_backend({"LIST_CACHE_SIZE": 4}).maxsize, 4)
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(TestCase):
+    """Version stamped Cache Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.server = FakeRedisServer().start()
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.server.stop()
+
+    def test_read_through(self):
+        """It should only call the loader on a miss"""
+        cache = Cache(LRUCache())
+        loader = MagicMock(return_value={"id": 1})
+        self.assertEqual(cache.fetch(1, loader), {"id": 1})
+        self.assertEqual(cache.fetch(1, loader), {"id": 1})
+        loader.assert_called_once()
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_fetch_many(self):
+        """It should load only the misses, with one call"""
+        for backend in (LRUCache(), RedisBackend(self.server.url)):
+            cache = Cache(backend)
+            cache.fetch(1, lambda: "one")
+            loader = MagicMock(side_effect=lambda keys: {key: f"loaded {key}" for key in keys if key != 3})
+            self.assertEqual(cache.fetch_many([2, 1, 3, 2], loader), {1: "one", 2: "loaded 2"})
+            loader.assert_called_once_with([2, 3])
+            self.assertEqual(cache.fetch_many([1, 2], loader), {1: "one", 2: "loaded 2"})
+            self.assertEqual(loader.call_count, 1)
+            cache.delete(2)
+            self.assertEqual(cache.fetch_many([1, 2], lambda keys: {2: "new"}), {1: "one", 2: "new"})
+
+    def test_do_not_cache_none(self):
+        """It should not cache a missing value"""
+        cache = Cache(LRUCache())
+        loader = MagicMock(return_value=None)
+        cache.fetch(1, loader)
+        cache.fetch(1, loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_shared_between_workers(self):
+        """It should share entries and invalidations between processes"""
+        worker_a = Cache(RedisBackend(self.server.url))
+        worker_b = Cache(RedisBackend(self.server.url))
+        worker_a.fetch(1, lambda: "old")
+        worker_a.fetch("list:x", lambda: ["old"], namespace="lists")
+        self.assertEqual(worker_b.fetch(1, lambda: "new"), "old")
+        self.assertEqual(worker_b.fetch("list:x", lambda: ["new"], namespace="lists"), ["old"])
+        worker_b.delete(1)
+        self.assertEqual(worker_a.fetch(1, lambda: "new"), "new")
+        self.assertEqual(worker_a.fetch("list:x", lambda: ["new"], namespace="lists"), ["new"])
+        # a like only changes the Product, the lists stay
+        worker_b.delete(1, lists=False)
+        self.assertEqual(worker_a.fetch(1, lambda: "liked"), "liked")
+        self.assertEqual(worker_a.fetch("list:x", lambda: ["liked"], namespace="lists"), ["new"])
+
+    def test_clear(self):
+        """It should invalidate every namespace with a new version"""
+        cache = Cache(RedisBackend(self.server.url))
+        cache.fetch(1, lambda: "old")
+        cache.fetch("list:x", lambda: ["old"], namespace="lists")
+        cache.clear()
+        self.assertEqual(cache.fetch(1, lambda: "new"), "new")
+        self.assertEqual(cache.fetch("list:x", lambda: ["new"], namespace="lists"), ["new"])
+
+    def test_stale_load(self):
+        """It should not serve a value loaded across an invalidation"""
+        cache = Cache(LRUCache())
+
+        def loader():
+            cache.clear()  # a write lands while the database is read
+            return "old"
+
+        self.assertEqual(cache.fetch(1, loader), "old")
+        self.assertEqual(cache.fetch(1, lambda: "new"), "new")
+
+    def test_stale_load_of_one_key(self):
+        """It should not serve a Product loaded across a write to that Product"""
+        for backend in (LRUCache(), RedisBackend(self.server.url)):
+            cache = Cache(backend)
+            cache.fetch(2, lambda: "other")
+
+            def loader():
+                cache.delete(1)  # the Product is written while it is read
+                return "old"
+
+            self.assertEqual(cache.fetch(1, loader), "old")
+            self.assertEqual(cache.fetch(1, lambda: "new"), "new")
+            self.assertEqual(cache.fetch(2, lambda: "reloaded"), "other")
+
+    def test_list_backend(self):
+        """It should keep lists in their own backend"""
+        products, lists = LRUCache(), LRUCache(maxsize=1)
+        cache = Cache(products, list_backend=lists)
+        cache.fetch(1, lambda: "one")
+        cache.fetch("list:a", lambda: ["a"], namespace="lists")
+        cache.fetch("list:b", lambda: ["b"], namespace="lists")
+        # the second list evicted the first, the Product is untouched
+        self.assertEqual(cache.fetch("list:a", lambda: ["a2"], namespace="lists"), ["a2"])
+        self.assertEqual(cache.fetch(1, lambda: "reloaded"), "one")
+        self.assertEqual(cache.stats()["lists"]["maxsize"], 1)
+        cache.delete(1)
+        self.assertEqual(cache.fetch("list:a", lambda: ["a3"], namespace="lists"), ["a3"])
+
+    def test_backend_down(self):
+        """It should fall back to the loader when the backend is down"""
+        cache = Cache(RedisBackend(self.server.url))
+        self.server.stop()
+        self.assertEqual(cache.fetch(1, lambda: "value"), "value")
+        self.assertEqual(cache.fetch_many([1, 2], lambda keys: {key: key for key in keys}), {1: 1, 2: 2})
+        cache.delete(1)
+        self.assertGreater(cache.stats()["errors"], 0)
@@ -4,7 +4,7 @@ CLI Command Extensions for Flask
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import create_db
+from service.common.cli_commands import create_db, db_upgrade
 import os
 
 class TestFlaskCLI(TestCase):
@@ -20,3 +20,15 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(create_db)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.migrations')
+    @patch('service.common.cli_commands.db')
+    def test_db_upgrade(self, db_mock, migrations_mock):
+        """It should call the db-upgrade command"""
+        migrations_mock.upgrade.return_value = [1]
+        migrations_mock.current_version.return_value = 1
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("schema version 1", result.output)
+        migrations_mock.upgrade.assert_called_once_with(db_mock.engine)
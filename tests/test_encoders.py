@@ -0,0 +1,35 @@
+"""
+Test cases for the JSON encoders
+"""
+import json
+from unittest import TestCase
+from service.common import encoders
+
+
+class TestEncoders(TestCase):
+    """Tests for the pluggable JSON encoders"""
+
+    def test_encoders_round_trip(self):
+        """It should encode the same data with every encoder"""
+        data = [{"id": 1, "name": "Pen", "price": 1.5, "description": None}]
+        for name in encoders.ENCODERS:
+            encoded = encoders.get_encoder(name)(data)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(json.loads(encoded), data)
+
+    def test_auto_encoder(self):
+        """It should pick orjson when it is installed"""
+        expected = "orjson" if encoders.orjson is not None else "json"
+        self.assertIs(encoders.get_encoder(), encoders.ENCODERS[expected])
+
+    def test_register_encoder(self):
+        """It should use a registered encoder"""
+        encoders.register_encoder("test", lambda data: b"[]")
+        try:
+            self.assertEqual(encoders.get_encoder("test")([1]), b"[]")
+        finally:
+            del encoders.ENCODERS["test"]
+
+    def test_unknown_encoder(self):
+        """It should not find an unknown encoder"""
+        self.assertRaises(ValueError, encoders.get_encoder, "yaml")
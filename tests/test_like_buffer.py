@@ -0,0 +1,209 @@
+"""
+Test cases for the Like Buffer
+"""
+import glob
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service.common.like_buffer import LikeBuffer
+
+
+######################################################################
+#  L I K E   B U F F E R   T E S T   C A S E S
+######################################################################
+class TestLikeBuffer(TestCase):
+    """Like Buffer Tests"""
+
+    def test_disabled_by_default(self):
+        """It should be disabled without an interval"""
+        buffer = LikeBuffer(MagicMock())
+        self.assertFalse(buffer.enabled)
+        buffer.add(1)
+        self.assertIsNone(buffer._thread)  # pylint: disable=protected-access
+
+    def test_coalesce_likes(self):
+        """It should coalesce likes per product into one flush"""
+        flush = MagicMock()
+        buffer = LikeBuffer(flush, interval_ms=60000)
+        for _ in range(5):
+            buffer.add(1)
+        buffer.add("2", 3)
+        self.assertEqual(buffer.pending(1), 5)
+        self.assertEqual(buffer.pending(2), 3)
+        self.assertEqual(buffer.flush(), 2)
+        flush.assert_called_once_with({1: 5, 2: 3})
+        self.assertEqual(buffer.pending(1), 0)
+        self.assertEqual(buffer.flush(), 0)
+        buffer.stop()
+
+    def test_failed_flush_is_retried(self):
+        """It should keep the likes when a flush fails"""
+        flush = MagicMock(side_effect=[Exception("database down"), None])
+        buffer = LikeBuffer(flush, interval_ms=60000)
+        buffer.add(1, 2)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.pending(1), 2)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.pending(1), 0)
+        buffer.stop()
+
+    def test_pending_while_flushing(self):
+        """It should count the likes being flushed until they are written"""
+        buffer = LikeBuffer(MagicMock(), interval_ms=60000)
+        buffer._flush = lambda deltas: self.assertEqual(buffer.pending(1), 2)  # pylint: disable=protected-access
+        buffer.add(1, 2)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.pending(1), 0)
+        buffer.stop()
+
+    def test_background_errors(self):
+        """It should keep the background thread going when a step fails"""
+        flush = MagicMock()
+        buffer = LikeBuffer(flush, interval_ms=10)
+        with patch("service.common.like_buffer.RECOVERY_INTERVAL", 0), \
+                patch.object(buffer, "recover", side_effect=sqlite3.OperationalError("no such table: likes")):
+            buffer.add(7)
+            time.sleep(0.05)
+            buffer.add(8)
+            deadline = time.time() + 5
+            while flush.call_count < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        buffer.stop()
+        self.assertEqual(flush.call_count, 2)
+
+    def test_background_flush(self):
+        """It should flush on the background thread"""
+        flush = MagicMock()
+        buffer = LikeBuffer(flush, interval_ms=10)
+        buffer.add(7)
+        deadline = time.time() + 5
+        while not flush.called and time.time() < deadline:
+            time.sleep(0.01)
+        buffer.stop()
+        flush.assert_called_once_with({7: 1})
+
+    def test_max_lag(self):
+        """It should flush on the request once the oldest like is too old"""
+        flush = MagicMock()
+        buffer = LikeBuffer(flush, interval_ms=60000, max_lag_ms=5)
+        buffer.add(1)
+        flush.assert_not_called()
+        self.assertGreaterEqual(buffer.lag_ms(), 0)
+        time.sleep(0.01)
+        buffer.add(1)
+        flush.assert_called_once_with({1: 2})
+        self.assertEqual(buffer.stats(), {"products": 0, "likes": 0, "lag_ms": 0.0, "journal": False})
+        buffer.stop()
+
+
+######################################################################
+#  L I K E   J O U R N A L   T E S T   C A S E S
+######################################################################
+class TestLikeJournal(TestCase):
+    """Durable Like Journal Tests"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _journals(self):
+        return glob.glob(os.path.join(self.directory, "likes-*.db"))
+
+    def test_journal_until_flushed(self):
+        """It should keep likes in the journal until they are flushed"""
+        flush = MagicMock(side_effect=[Exception("database down"), None])
+        buffer = LikeBuffer(flush, interval_ms=60000, journal_dir=self.directory)
+        buffer.add(1)
+        buffer.add(2, 3)
+        self.assertTrue(buffer.stats()["journal"])
+        journal = self._journals()[0]
+
+        def journaled():
+            with sqlite3.connect(journal) as connection:
+                return dict(connection.execute("SELECT product_id, sum(amount) FROM likes GROUP BY product_id"))
+
+        self.assertEqual(journaled(), {1: 1, 2: 3})
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(journaled(), {1: 1, 2: 3})
+        buffer.add(1)
+        self.assertEqual(buffer.flush(), 2)
+        flush.assert_called_with({1: 2, 2: 3})
+        self.assertEqual(journaled(), {})
+        buffer.stop()
+        self.assertEqual(self._journals(), [])
+
+    def test_one_flush_at_a_time(self):
+        """It should not acknowledge journaled likes that another flush is still writing"""
+        writing, failed = threading.Event(), threading.Event()
+        batches = []
+
+        def flush(deltas):
+            batches.append(deltas)
+            if len(batches) == 1:
+                writing.set()
+                failed.wait(5)
+                raise Exception("database down")
+
+        buffer = LikeBuffer(flush, interval_ms=60000, journal_dir=self.directory)
+        buffer.add(1)
+        first = threading.Thread(target=buffer.flush)
+        first.start()
+        writing.wait(5)
+        # a max lag flush on a request while the background thread is writing
+        buffer.add(2)
+        second = threading.Thread(target=buffer.flush)
+        second.start()
+        time.sleep(0.05)
+        self.assertEqual(batches, [{1: 1}])
+        failed.set()
+        first.join()
+        second.join()
+        self.assertEqual(batches, [{1: 1}, {1: 1, 2: 1}])
+        self.assertEqual(buffer.pending(1), 0)
+        buffer.stop()
+        self.assertEqual(self._journals(), [])
+
+    def test_recover_after_crash(self):
+        """It should adopt the likes of a worker that died before flushing"""
+        crashed = LikeBuffer(MagicMock(), interval_ms=60000, journal_dir=self.directory)
+        crashed.add(1, 2)
+        crashed.add(5)
+        # the worker dies: its lock is released but the journal stays
+        crashed._journal._lock_file.close()  # pylint: disable=protected-access
+        crashed._stop.set()  # pylint: disable=protected-access
+        flush = MagicMock()
+        buffer = LikeBuffer(flush, interval_ms=60000, journal_dir=self.directory)
+        buffer.add(5)
+        self.assertEqual(buffer.pending(1), 2)
+        self.assertEqual(buffer.pending(5), 2)
+        self.assertEqual(len(self._journals()), 1)
+        buffer.stop()
+        flush.assert_called_once_with({1: 2, 5: 2})
+
+    def test_journal_adopted_by_another_worker(self):
+        """It should skip a journal another worker adopted and removed"""
+        buffer = LikeBuffer(MagicMock(), interval_ms=60000, journal_dir=self.directory)
+        buffer.add(1)
+        gone = os.path.join(self.directory, "likes-gone.db")
+        with patch("service.common.like_buffer.glob.glob", return_value=[gone]):
+            self.assertEqual(buffer.recover(), 0)
+        self.assertFalse(os.path.exists(gone + ".lock"))
+        buffer.stop()
+
+    def test_live_journals_are_left_alone(self):
+        """It should not adopt the journal of a running worker"""
+        other = LikeBuffer(MagicMock(), interval_ms=60000, journal_dir=self.directory)
+        other.add(1)
+        buffer = LikeBuffer(MagicMock(), interval_ms=60000, journal_dir=self.directory)
+        buffer.add(2)
+        self.assertEqual(buffer.pending(1), 0)
+        self.assertEqual(buffer.recover(), 0)
+        other.stop()
+        buffer.stop()
@@ -0,0 +1,110 @@
+"""
+Test cases for Schema Migrations
+"""
+from contextlib import contextmanager
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from sqlalchemy import create_engine, inspect, text
+from service.common import migrations
+
+
+######################################################################
+#  M I G R A T I O N   T E S T   C A S E S
+######################################################################
+class TestMigrations(TestCase):
+    """Schema Migration Tests"""
+
+    def setUp(self):
+        """Runs before each test with a database from before the indexes"""
+        self.engine = create_engine("sqlite://")
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(63), price INTEGER NOT NULL, "
+                "description VARCHAR(256), \"like\" INTEGER, category VARCHAR(63))"
+            ))
+            connection.execute(text(
+                "INSERT INTO product (name, price, description, \"like\", category) "
+                "VALUES ('iPhone', 100, 'phone', 3, 'Electronic')"
+            ))
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.engine.dispose()
+
+    def test_upgrade(self):
+        """It should add the filter indexes to an existing table"""
+        self.assertEqual(migrations.current_version(self.engine), 0)
+        upgraded = migrations.upgrade(self.engine)
+        self.assertEqual(upgraded, [version for version, _, _, _ in migrations.MIGRATIONS])
+        indexes = {index["name"]: index["column_names"] for index in inspect(self.engine).get_indexes("product")}
+        self.assertEqual(indexes["ix_product_category"], ["category"])
+        self.assertEqual(indexes["ix_product_name"], ["name"])
+        self.assertEqual(indexes["ix_product_price"], ["price"])
+        self.assertEqual(indexes["ix_product_category_price"], ["category", "price"])
+        self.assertEqual(indexes["ix_product_like"], ["like"])
+        self.assertEqual(indexes["ix_product_category_like"], ["category", "like"])
+        columns = {column["name"] for column in inspect(self.engine).get_columns("product")}
+        self.assertIn("version", columns)
+        self.assertIn("catalog_version", inspect(self.engine).get_table_names())
+        self.assertEqual(migrations.current_version(self.engine), migrations.MIGRATIONS[-1][0])
+        # the data is still there
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(text("SELECT count(*), min(version) FROM product")).first(), (1, 1))
+            self.assertEqual(
+                connection.execute(text("SELECT category, count, price_total, like_total FROM category_stats")).all(),
+                [("Electronic", 1, 100, 3)],
+            )
+
+    def test_backfill(self):
+        """It should fill in NULLs a batch at a time"""
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO product (name, price, description, category) VALUES "
+                "('a', 1, 'x', 'toy'), ('b', 1, 'x', 'toy'), ('c', 1, 'x', 'toy'), ('d', 1, 'x', 'toy'), ('e', 1, 'x', 'toy')"
+            ))
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            with patch.object(connection, "execute", wraps=connection.execute) as execute:
+                self.assertEqual(migrations.backfill(connection, "product", "like", 0, batch=2), 5)
+            self.assertEqual(execute.call_count, 3)
+            self.assertEqual(connection.execute(text('SELECT "like" FROM product ORDER BY id')).scalars().all(),
+                             [3, 0, 0, 0, 0, 0])
+
+    def test_not_null_on_postgres(self):
+        """It should check the rows against a NOT VALID constraint before SET NOT NULL"""
+        connection = MagicMock()
+        connection.dialect.name = "postgresql"
+        connection.dialect.identifier_preparer.quote = lambda name: f'"{name}"'
+        connection.execute.return_value.first.return_value = None
+        with migrations.not_null(connection, "product", "like"):
+            connection.execute(text("BACKFILL"))
+        statements = [str(call.args[0]) for call in connection.execute.call_args_list]
+        self.assertEqual(statements[1:], [
+            'ALTER TABLE "product" ADD CONSTRAINT product_like_not_null CHECK ("like" IS NOT NULL) NOT VALID',
+            "BACKFILL",
+            'ALTER TABLE "product" VALIDATE CONSTRAINT product_like_not_null',
+            'ALTER TABLE "product" ALTER COLUMN "like" SET NOT NULL',
+            'ALTER TABLE "product" DROP CONSTRAINT IF EXISTS product_like_not_null',
+        ])
+
+    def test_upgrade_twice(self):
+        """It should not apply a migration twice"""
+        migrations.upgrade(self.engine)
+        self.assertEqual(migrations.upgrade(self.engine), [])
+
+    def test_upgrade_after_waiting(self):
+        """It should skip the migrations another worker applied while it waited for the lock"""
+        @contextmanager
+        def other_worker_first(engine):
+            migrations.stamp(engine)
+            yield
+
+        with patch.object(migrations, "upgrade_lock", other_worker_first):
+            self.assertEqual(migrations.upgrade(self.engine), [])
+        self.assertEqual(inspect(self.engine).get_indexes("product"), [])
+
+    def test_stamp(self):
+        """It should mark all migrations as applied without running them"""
+        self.assertEqual(len(migrations.stamp(self.engine)), len(migrations.MIGRATIONS))
+        self.assertEqual(migrations.stamp(self.engine), [])
+        self.assertEqual(migrations.upgrade(self.engine), [])
+        self.assertEqual(inspect(self.engine).get_indexes("product"), [])
@@ -13,7 +13,10 @@ from unittest.mock import MagicMock, patch
 from requests import HTTPError, ConnectionError
 from sqlalchemy import null
 from werkzeug.exceptions import NotFound
-from service.models import Product, DataValidationError, db, DatabaseConnectionError
+from service.models import (
+    Product, CatalogVersion, CategoryStats, DataValidationError, DataConflictError, db, DatabaseConnectionError,
+    product_cache, search_index
+)
 from service import app
 from tests.factories import ProductFactory
 
@@ -47,6 +50,9 @@ class TestProductModel(unittest.TestCase):
         """This runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        product_cache.clear()
+        # the catalog version starts over with the tables, so the search index can't tell it is stale
+        search_index.version = None
 
     def tearDown(self):
         """ This runs after each test """
@@ -275,3 +281,306 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(products[0].description, "test")
         self.assertEqual(products[0].price, 2000)
         
+    def test_bulk_create_products(self):
+        """ It should Create many products in one transaction """
+        products = ProductFactory.create_batch(7)
+        created = Product.bulk_create(products, chunk_size=3)
+        self.assertEqual(created, 7)
+        found = Product.all()
+        self.assertEqual(len(found), 7)
+        self.assertEqual(sorted(p.name for p in found), sorted(p.name for p in products))
+
+    def test_bulk_delete_products(self):
+        """ It should Delete all products matched by a query """
+        Product(name="Macbook Pro", category="laptop", description="test", price=2000).create()
+        Product(name="Think Pad", category="laptop", description="test", price=1800).create()
+        Product(name="iPhone", category="phone", description="test", price=900).create()
+        self.assertEqual(Product.bulk_delete(Product.find_by_category("laptop")), 2)
+        self.assertEqual([p.name for p in Product.all()], ["iPhone"])
+        self.assertEqual(Product.bulk_delete(), 1)
+        self.assertEqual(Product.all(), [])
+
+    def test_delete_by_id(self):
+        """ It should Delete a product by id """
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        self.assertEqual(Product.delete_by_id(product_id), 1)
+        self.assertEqual(Product.delete_by_id(product_id), 0)
+        self.assertEqual(Product.all(), [])
+
+    def test_bulk_update_products(self):
+        """ It should Update all products matched by a query """
+        Product(name="Macbook Pro", category="laptop", description="test", price=2000).create()
+        Product(name="iPhone", category="phone", description="test", price=900).create()
+        count = Product.bulk_update({"price": "100", "description": "sale"}, Product.find_by_category("laptop"))
+        self.assertEqual(count, 1)
+        product = Product.find_by_category("laptop")[0]
+        self.assertEqual(product.price, 100)
+        self.assertEqual(product.description, "sale")
+        self.assertEqual(Product.find_by_category("phone")[0].price, 900)
+
+    def test_bulk_update_bad_changes(self):
+        """ It should not Update products with invalid changes """
+        self.assertRaises(DataValidationError, Product.bulk_update, [])
+        self.assertRaises(DataValidationError, Product.bulk_update, {"price": True})
+        self.assertRaises(DataValidationError, Product.bulk_update, {"id": 5})
+        self.assertRaises(DataValidationError, Product.bulk_update, {"name": "a" * 21})
+
+    def test_increment_like(self):
+        """ It should atomically Increment the like count of a product """
+        product = ProductFactory()
+        product.create()
+        product_id, original_like = product.id, product.like
+        data = Product.increment_like(product_id)
+        self.assertEqual(data["id"], product_id)
+        self.assertEqual(data["like"], original_like + 1)
+        data = Product.increment_like(product_id, 5)
+        self.assertEqual(data["like"], original_like + 6)
+        self.assertEqual(Product.find(product_id).like, original_like + 6)
+        self.assertIsNone(Product.increment_like(0))
+
+    def test_increment_likes(self):
+        """ It should Increment the like counts of many products at once """
+        products = ProductFactory.create_batch(3)
+        Product.bulk_create(products)
+        found = Product.all()
+        likes = {p.id: p.like for p in found}
+        deltas = {found[0].id: 3, found[2].id: 1, 0: 5}
+        self.assertEqual(Product.increment_likes(deltas), 3)
+        self.assertEqual(Product.increment_likes({}), 0)
+        for product in Product.all():
+            self.assertEqual(product.like, likes[product.id] + deltas.get(product.id, 0))
+
+    def test_find_serialized(self):
+        """ It should Find a serialized product through the cache """
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        self.assertEqual(Product.find_serialized(product_id), product.serialize())
+        hits = product_cache.hits
+        self.assertEqual(Product.find_serialized(product_id)["id"], product_id)
+        self.assertEqual(product_cache.hits, hits + 1)
+        product.price = 999
+        product.update()
+        self.assertEqual(Product.find_serialized(str(product_id))["price"], 999)
+        self.assertEqual(product_cache.hits, hits + 1)
+        self.assertIsNone(Product.find_serialized(0))
+        self.assertIsNone(Product.find_serialized("abc"))
+
+    def test_version_and_catalog_version(self):
+        """ It should version every change to a product and to the catalog """
+        self.assertEqual(CatalogVersion.current(), 0)
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        self.assertEqual(product.version, 1)
+        self.assertEqual(CatalogVersion.current(), 1)
+        product.price = 1
+        product.update()
+        self.assertEqual(product.version, 2)
+        self.assertEqual(CatalogVersion.current(), 2)
+        # likes version the product only
+        self.assertEqual(Product.increment_like(product_id)["version"], 3)
+        Product.increment_likes({product_id: 2})
+        self.assertEqual(CatalogVersion.current(), 2)
+        Product.bulk_update({"price": 5})
+        self.assertEqual(Product.find(product_id).version, 5)
+        self.assertEqual(CatalogVersion.current(), 3)
+        Product.delete_by_id(product_id)
+        self.assertEqual(CatalogVersion.current(), 4)
+
+    def test_concurrent_update(self):
+        """ It should not Update a product changed by someone else """
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.version, 1)
+        # another request changes the row after we read it
+        db.session.execute(Product.__table__.update().values(version=Product.version + 1))
+        product.price = 1
+        self.assertRaises(DataConflictError, product.update)
+
+    def test_serialize_query(self):
+        """ It should serialize products from column tuples like serialize() """
+        for product in ProductFactory.create_batch(3):
+            product.create()
+        expected = [product.serialize() for product in Product.query.order_by(Product.id)]
+        self.assertEqual(Product.serialize_query(Product.query.order_by(Product.id)), expected)
+        page = Product.serialize_query(Product.page_query(2, after_id=expected[0]["id"]))
+        self.assertEqual(page, expected[1:3])
+
+    def test_serialize_fields(self):
+        """ It should serialize only the requested fields """
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.serialize(["id", "name"]), {"id": product.id, "name": product.name})
+        rows = Product.serialize_query(Product.query, ["id", "price"])
+        self.assertEqual(rows, [{"id": product.id, "price": product.price}])
+
+    def test_category_stats(self):
+        """ It should keep the category summary in step with every write """
+        def check():
+            self.assertEqual(Product.stats("category"), Product.stats("category", from_summary=False))
+            self.assertEqual(Product.stats(), Product.stats(from_summary=False))
+
+        phone = Product(name="iPhone", category="phone", description="", price=900, like=2)
+        phone.create()
+        Product(name="Pixel", category="phone", description="", price=700, like=1).create()
+        Product(name="Kettle", category=None, description="", price=30).create()
+        self.assertEqual(Product.stats("category"), [
+            {"category": "", "count": 1, "price_total": 30, "price_min": 30, "price_max": 30,
+             "like_total": 0, "price_avg": 30.0},
+            {"category": "phone", "count": 2, "price_total": 1600, "price_min": 700, "price_max": 900,
+             "like_total": 3, "price_avg": 800.0},
+        ])
+        self.assertEqual(Product.stats(), {"count": 3, "price_total": 1630, "price_min": 30, "price_max": 900,
+                                           "like_total": 3, "price_avg": 543.33})
+        check()
+        # the most expensive phone gets cheaper, then moves to another category
+        phone.price = 500
+        phone.update()
+        check()
+        phone.category = "tablet"
+        phone.update()
+        check()
+        Product.increment_like(phone.id, 3)
+        Product.increment_likes({phone.id: 2, 0: 5})
+        check()
+        Product.bulk_create([Product(name="Pad", category="tablet", description="", price=300, like=0)])
+        check()
+        Product.bulk_update({"category": "phone", "price": 100}, Product.query.filter(Product.name == "Pad"))
+        check()
+        Product.delete_by_id(phone.id)
+        check()
+        Product.find_by_name("Kettle")[0].delete()
+        check()
+        self.assertEqual([group["category"] for group in Product.stats("category")], ["phone"])
+        Product.bulk_delete()
+        self.assertEqual(CategoryStats.query.count(), 0)
+        self.assertEqual(Product.stats(), {"count": 0, "price_total": 0, "price_min": None, "price_max": None,
+                                           "like_total": 0, "price_avg": None})
+
+    def test_category_stats_record(self):
+        """ It should add to a summary whether or not its row exists, and add likes to it """
+        CategoryStats.record("book", 1, 30, 30, 30)
+        CategoryStats.record("book", 1, 20, 20, 20, 4)
+        db.session.commit()
+        self.assertEqual(CategoryStats.summary(), [("book", 2, 50, 20, 30, 4)])
+        product = Product(name="Novel", category="book", description="", price=10, like=1)
+        product.create()
+        other = Product(name="Pan", category=None, description="", price=10, like=0)
+        other.create()
+        Product.increment_like(str(product.id), 2)
+        Product.increment_likes({other.id: 1, product.id: 3, 0: 5})
+        self.assertEqual(CategoryStats.summary(), [("", 1, 10, 10, 10, 1), ("book", 3, 60, 10, 30, 10)])
+        # the stats read the summary alone
+        with patch.object(Product, "replica_query", side_effect=AssertionError):
+            self.assertEqual(Product.stats()["like_total"], 11)
+
+    def test_top(self):
+        """ It should rank products by likes or price, ties going to the oldest """
+        for name, category, price, like in [("A", "phone", 900, 3), ("B", "phone", 700, 9),
+                                            ("C", "book", 30, 9), ("D", "book", 20, 1)]:
+            Product(name=name, category=category, description="", price=price, like=like).create()
+        self.assertEqual([p.name for p in Product.top("like", 3)], ["B", "C", "A"])
+        self.assertEqual([p.name for p in Product.top("like", 5, "book")], ["C", "D"])
+        self.assertEqual([p.name for p in Product.top("price", 1)], ["A"])
+        self.assertRaises(DataValidationError, Product.top, "name", 1)
+
+    def test_find_many_serialized(self):
+        """ It should find many products in order through the cache """
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.create()
+        ids = [products[2].id, 0, products[0].id, "bogus", products[2].id]
+        expected = [products[2].serialize(), None, products[0].serialize(), None, products[2].serialize()]
+        self.assertEqual(Product.find_many_serialized(ids), expected)
+        # a second lookup is answered by the cache
+        with patch.object(Product, "serialize_query", side_effect=AssertionError):
+            self.assertEqual(Product.find_many_serialized([ids[0], ids[2]]), [expected[0], expected[2]])
+
+    def test_search(self):
+        """ It should find products by the words in their name and description """
+        Product(name="iPhone", category="phone", description="red phone", price=900).create()
+        Product(name="Pixel", category="phone", description="phone", price=700).create()
+        Product(name="Red Kettle", category="kitchen", description="kettle", price=30).create()
+        self.assertEqual([p.name for p in Product.search("phone", 10)], ["iPhone", "Pixel"])
+        self.assertEqual([p.name for p in Product.search("red", 10)], ["iPhone", "Red Kettle"])
+        self.assertEqual([p.name for p in Product.search("red", 1)], ["iPhone"])
+        self.assertEqual(Product.search("watch", 10).all(), [])
+        # a write is visible to the next search
+        Product(name="Watch", category="watch", description="", price=300).create()
+        self.assertEqual([p.name for p in Product.search("watch", 10)], ["Watch"])
+
+    def test_search_window(self):
+        """ It should only put the ranked window of matches into the search query """
+        for name in ("iPhone", "Pixel", "Galaxy"):
+            Product(name=name, category="phone", description="phone", price=900).create()
+        Product(name="Case", category="case", description="phone", price=20).create()
+        with patch.object(search_index, "search", wraps=search_index.search) as search:
+            self.assertEqual(len(Product.search("phone", 2).all()), 2)
+        search.assert_called_once_with("phone", 2)
+        # the other filters are checked a window at a time until enough matches pass
+        with patch("service.models.SEARCH_WINDOW", 1):
+            cases = Product.search("phone", 2, Product.query.filter(Product.category == "case"))
+            self.assertEqual([p.name for p in cases], ["Case"])
+
+    def test_suggest(self):
+        """ It should autocomplete product names """
+        Product(name="iPhone", category="phone", description="", price=900).create()
+        Product(name="iPhone", category="phone", description="", price=800).create()
+        Product(name="iPad", category="tablet", description="", price=500).create()
+        self.assertEqual(Product.suggest("IP", 10), ["iPad", "iPhone"])
+        self.assertEqual(Product.suggest("iph", 10), ["iPhone"])
+        self.assertEqual(Product.suggest("x", 10), [])
+
+    def test_build_query(self):
+        """ It should AND every filter it is given """
+        Product(name="iPhone", category="phone", description="", price=900, like=10).create()
+        Product(name="iPhone", category="phone", description="", price=300, like=2).create()
+        Product(name="Pixel", category="phone", description="", price=700, like=5).create()
+        Product(name="iPhone", category="case", description="", price=20, like=50).create()
+        self.assertEqual(Product.build_query().count(), 4)
+        self.assertEqual(Product.build_query(name="iPhone", category="phone").count(), 2)
+        self.assertEqual(Product.build_query(category="phone", price_range=[500, 1000]).count(), 2)
+        self.assertEqual(Product.build_query(min_like=5, max_like=10).count(), 2)
+        self.assertEqual(
+            [p.price for p in Product.build_query(name="iPhone", min_like=5, price_range=[0, 100])], [20]
+        )
+
+    def test_parse_sort(self):
+        """ It should parse sort orders and reject bad ones """
+        self.assertEqual(Product.parse_sort("price,-like"), [("price", False), ("like", True)])
+        self.assertEqual(Product.parse_sort("-id"), [("id", True)])
+        self.assertRaises(DataValidationError, Product.parse_sort, "weight")
+        self.assertRaises(DataValidationError, Product.parse_sort, "price,-price")
+        self.assertRaises(DataValidationError, Product.parse_sort, "id,price")
+        self.assertRaises(DataValidationError, Product.parse_sort, "price,")
+
+    def test_page_query_sorted(self):
+        """ It should page through products in sort order with keyset cursors """
+        for _ in range(12):
+            product = ProductFactory()
+            product.category = None if product.category == "Toy" else product.category
+            product.create()
+        Product(name="Nameless", category=None, description="", price=10, like=0).create()
+        for sort_order in ["price,-like", "-name,price", "category,-id", "-category,like", "like"]:
+            sort = Product.parse_sort(sort_order)
+            expected = [p.id for p in Product.sort_query(Product.build_query(), sort)]
+            seen = []
+            after_id = after_keys = None
+            while True:
+                page = Product.page_query(5, after_id, Product.build_query(), sort, after_keys).all()
+                seen.extend(p.id for p in page)
+                if len(page) < 5:
+                    break
+                after_id = page[-1].id
+                after_keys = Product.sort_values(page[-1].serialize(), sort)
+            self.assertEqual(seen, expected, sort_order)
+            self.assertEqual(sorted(seen), sorted(p.id for p in Product.all()))
+        # NULLs sort last, and first when descending
+        categories = [p.category for p in Product.sort_query(Product.build_query(), Product.parse_sort("category"))]
+        self.assertIsNone(categories[-1])
+        self.assertEqual(categories, sorted(categories, key=lambda category: (category is None, category or "")))
+        categories = [p.category for p in Product.sort_query(Product.build_query(), Product.parse_sort("-category"))]
+        self.assertIsNone(categories[0])
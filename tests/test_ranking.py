@@ -0,0 +1,62 @@
+"""
+Test cases for the in-process Product ranking
+"""
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service.common.ranking import Board, Ranking
+
+
+def product(product_id, like, category="phone"):
+    """Returns a serialized Product"""
+    return {"id": product_id, "like": like, "category": category}
+
+
+class TestRanking(TestCase):
+    """Ranking Tests"""
+
+    def test_board_order(self):
+        """It should order Products by likes then id"""
+        board = Board([product(1, 5), product(2, 9), product(3, 5)], size=10)
+        self.assertTrue(board.complete)
+        self.assertEqual([p["id"] for p in board.top(10)], [2, 1, 3])
+        self.assertEqual([p["id"] for p in board.top(1)], [2])
+
+    def test_board_liked(self):
+        """It should move liked Products up and onto a full board"""
+        board = Board([product(1, 9), product(2, 5)], size=2)
+        self.assertFalse(board.complete)
+        board.liked(product(2, 10))
+        self.assertEqual([p["id"] for p in board.top(2)], [2, 1])
+        # not enough likes to make the cut
+        board.liked(product(3, 8))
+        self.assertEqual([p["id"] for p in board.top(2)], [2, 1])
+        board.liked(product(3, 11))
+        self.assertEqual([(p["id"], p["like"]) for p in board.top(2)], [(3, 11), (2, 10)])
+        self.assertNotIn(1, board.products)
+
+    def test_top_loads_boards(self):
+        """It should load a board once and reload it when it expires or is too short"""
+        load = MagicMock(side_effect=lambda category, limit: [product(i, 10 - i) for i in range(1, 4)][:limit])
+        ranking = Ranking(size=2, ttl=60)
+        self.assertEqual([p["id"] for p in ranking.top(2, "phone", load)], [1, 2])
+        self.assertEqual([p["id"] for p in ranking.top(1, "phone", load)], [1])
+        load.assert_called_once_with("phone", 2)
+        ranking.top(3, "phone", load)
+        load.assert_called_with("phone", 3)
+        with patch("service.common.ranking.time.monotonic", return_value=10 ** 9):
+            ranking.top(1, "phone", load)
+        self.assertEqual(load.call_count, 3)
+        ranking.clear()
+        ranking.top(1, "phone", load)
+        self.assertEqual(load.call_count, 4)
+
+    def test_liked_updates_boards(self):
+        """It should apply likes to the catalog and category boards"""
+        boards = {None: [product(1, 9, "phone"), product(2, 5, "book")], "book": [product(2, 5, "book")]}
+        ranking = Ranking(size=10, ttl=60)
+        load = lambda category, limit: boards[category]  # noqa: E731
+        ranking.top(2, None, load)
+        ranking.top(2, "book", load)
+        ranking.liked(product(2, 12, "book"))
+        self.assertEqual([p["id"] for p in ranking.top(2, None, load)], [2, 1])
+        self.assertEqual(ranking.top(1, "book", load), [product(2, 12, "book")])
@@ -9,14 +9,17 @@ from crypt import methods
 import os
 import logging
 import json
+import time
 import unittest
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 from flask import url_for
 from service import app
-from service.models import db, init_db, Product
+from service.models import db, init_db, Product, CategoryStats, product_cache, top_ranking
 from service.common import status  # HTTP Status Codes
+from service.common.like_buffer import LikeBuffer
+from service.routes import flush_likes
 from tests.factories import ProductFactory
 from urllib.parse import quote_plus
 
@@ -51,7 +54,9 @@ class TestProductServer(TestCase):
         """Runs before each test"""
         self.client = app.test_client()
         db.session.query(Product).delete()  # clean up the last tests
+        db.session.query(CategoryStats).delete()
         db.session.commit()
+        product_cache.clear()
 
     def tearDown(self):
         """ This runs after each test """
@@ -94,6 +99,9 @@ class TestProductServer(TestCase):
         data = response.get_json()
         self.assertEqual(data["status"], 200)
         self.assertEqual(data["message"], "Healthy")
+        self.assertIn("hits", data["cache"])
+        self.assertIn("misses", data["cache"])
+        self.assertIn("class", data["pool"])
 
     def test_get_product(self):
         """It should Get a single Product"""
@@ -105,6 +113,69 @@ class TestProductServer(TestCase):
         self.assertEqual(data["name"], test_product.name)
         self.assertEqual(data["price"], test_product.price)
 
+    def test_get_product_cached(self):
+        """It should Get a Product from the cache until it changes"""
+        test_product = self._create_products(1)[0]
+        hits = product_cache.stats()["hits"]
+        for _ in range(3):
+            response = self.client.get(f"{BASE_URL}/{test_product.id}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(product_cache.stats()["hits"], hits + 2)
+
+        new_product = response.get_json()
+        new_product["price"] = 123
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=new_product)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["price"], 123)
+
+        response = self.client.put(f"{BASE_URL}/{test_product.id}/like")
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["like"], test_product.like + 1)
+
+        response = self.client.delete(f"{BASE_URL}/{test_product.id}")
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_bad_id(self):
+        """It should not Get a Product with an id that is not a number"""
+        response = self.client.get(f"{BASE_URL}/abc")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_etag(self):
+        """It should return 304 for a Product that has not changed"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data, b"")
+
+        response = self.client.put(f"{BASE_URL}/{test_product.id}/like")
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_update_product_if_match(self):
+        """It should only Update a Product whose ETag matches If-Match"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        new_product = response.get_json()
+        new_product["price"] = 100
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=new_product, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["version"], new_product["version"] + 1)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        new_product["price"] = 200
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=new_product, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["price"], 100)
+
     def test_get_product_not_found(self):
         """It should not Get a Product thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -235,6 +306,103 @@ class TestProductServer(TestCase):
         response = self.client.post(BASE_URL)
         self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_bulk_create_products(self):
+        """It should Create many Products from a JSON array"""
+        payload = [ProductFactory().serialize() for _ in range(7)]
+        with patch.dict(app.config, {"BULK_CHUNK_SIZE": 3}):
+            response = self.client.post(f"{BASE_URL}/bulk", json=payload)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(data["created"], 7)
+        self.assertEqual(data["errors"], [])
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 7)
+
+    def test_bulk_create_products_ndjson(self):
+        """It should Create many Products from NDJSON and report bad items"""
+        lines = [json.dumps(ProductFactory().serialize()) for _ in range(3)]
+        bad_product = ProductFactory().serialize()
+        bad_product["price"] = -1
+        lines.insert(1, json.dumps(bad_product))
+        lines.append("{not json")
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data="\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 4])
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_bulk_create_products_all_invalid(self):
+        """It should not Create Products when every item is invalid"""
+        float_price = dict(ProductFactory().serialize(), price=9.5)
+        response = self.client.post(f"{BASE_URL}/bulk", json=[{}, "product", float_price])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error["index"] for error in response.get_json()["errors"]], [0, 1, 2])
+        response = self.client.post(f"{BASE_URL}/bulk", json={})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/bulk", data="[]", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_bulk_delete_products_by_category(self):
+        """It should Delete all Products in a category"""
+        test_products = self._create_products(10)
+        category = test_products[0].category
+        cat_count = len([product for product in test_products if product.category == category])
+        response = self.client.delete(BASE_URL, query_string={"category": category})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["deleted"], cat_count)
+        response = self.client.get(BASE_URL)
+        data = response.get_json()
+        self.assertEqual(len(data), 10 - cat_count)
+        for product in data:
+            self.assertNotEqual(product["category"], category)
+
+    def test_bulk_delete_all_products(self):
+        """It should Delete all of the Products"""
+        self._create_products(3)
+        response = self.client.delete(BASE_URL, query_string={"all": "true"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["deleted"], 3)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.get_json(), [])
+
+    def test_bulk_delete_products_unfiltered(self):
+        """It should not Delete every Product without a filter or all=true"""
+        test_products = self._create_products(3)
+        for query_string in ({}, {"categroy": test_products[0].category}, {"all": "false"},
+                             {"category": test_products[0].category, "limit": 1}):
+            response = self.client.delete(BASE_URL, query_string=query_string)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        response = self.client.patch(BASE_URL, query_string={"categroy": "other"}, json={"price": 75})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+
+    def test_bulk_update_products_by_category(self):
+        """It should Update the price of all Products in a category"""
+        test_products = self._create_products(10)
+        category = test_products[0].category
+        cat_count = len([product for product in test_products if product.category == category])
+        response = self.client.patch(BASE_URL, query_string={"category": category}, json={"price": 75})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["updated"], cat_count)
+        response = self.client.get(BASE_URL)
+        for product in response.get_json():
+            if product["category"] == category:
+                self.assertEqual(product["price"], 75)
+            else:
+                self.assertNotEqual(product["price"], 75)
+
+    def test_bulk_update_products_bad_data(self):
+        """It should not Update Products with invalid changes"""
+        self._create_products(2)
+        for changes in ({}, {"price": -1}, {"price": "abc"}, {"like": 5}, {"name": ""}, {"category": 5}):
+            response = self.client.patch(BASE_URL, query_string={"all": "true"}, json=changes)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, changes)
+        response = self.client.patch(BASE_URL, data="{}", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
 # ----------------------------------------------------------
 # TEST QUERY
@@ -280,6 +448,342 @@ class TestProductServer(TestCase):
         for data in datas:
             self.assertTrue(data["price"] >= int(low_range) and data["price"] <= int(up_range))
    
+    def test_get_product_list_etag(self):
+        """It should return 304 for a list when the catalog has not changed"""
+        test_products = self._create_products(3)
+        response = self.client.get(BASE_URL)
+        etag = response.headers["ETag"]
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # the tag is checked before the list is queried or read from the cache
+        page_etag = self.client.get(BASE_URL, query_string={"limit": 2}).headers["ETag"]
+        with patch("service.routes.list_query", side_effect=AssertionError("list queried for a 304")), \
+                patch.object(product_cache, "fetch", side_effect=AssertionError("list fetched for a 304")):
+            response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            response = self.client.get(BASE_URL, query_string={"limit": 2}, headers={"If-None-Match": page_etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # the same catalog filtered differently is a different list
+        response = self.client.get(BASE_URL, query_string={"limit": 1}, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for change in (
+            lambda: self.client.put(f"{BASE_URL}/{test_products[0].id}/like"),
+            lambda: self.client.patch(BASE_URL, query_string={"all": "true"}, json={"price": 1}),
+            lambda: self.client.post(BASE_URL, json=ProductFactory().serialize()),
+            lambda: self.client.delete(f"{BASE_URL}/{test_products[1].id}"),
+        ):
+            change()
+            response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response.headers["ETag"]
+
+    def test_get_product_list_marshalled(self):
+        """It should Get the same list with fast serialization turned off"""
+        self._create_products(3)
+        fast = self.client.get(f"{BASE_URL}?limit=10").get_json()
+        app.config["FAST_SERIALIZATION"] = False
+        try:
+            product_cache.clear()
+            response = self.client.get(f"{BASE_URL}?limit=10")
+        finally:
+            app.config["FAST_SERIALIZATION"] = True
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), fast)
+
+    def test_get_product_list_paginated(self):
+        """It should page through Products with limit and cursor"""
+        self._create_products(5)
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(product["id"] for product in data)
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_get_products_by_category_paginated(self):
+        """It should page through Products filtered by category"""
+        test_products = self._create_products(10)
+        category = test_products[0].category
+        cat_count = len([product for product in test_products if product.category == category])
+        response = self.client.get(BASE_URL, query_string={"category": category, "limit": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 1)
+        seen = 1
+        while "Link" in response.headers:
+            link = response.headers["Link"]
+            self.assertIn("category=", link)
+            response = self.client.get(link[1:link.index(">")])
+            for data in response.get_json():
+                self.assertEqual(data["category"], category)
+                seen += 1
+        self.assertEqual(seen, cat_count)
+
+    def test_get_products_by_category_cached(self):
+        """It should serve filtered lists from the cache until the catalog changes"""
+        test_products = self._create_products(4)
+        category = test_products[0].category
+        response = self.client.get(BASE_URL, query_string={"category": category})
+        first = response.get_json()
+        hits = product_cache.stats()["hits"]
+        response = self.client.get(BASE_URL, query_string={"category": category})
+        self.assertEqual(response.get_json(), first)
+        # the page, and the like count of each of its Products
+        self.assertEqual(product_cache.stats()["hits"], hits + 1 + len(first))
+
+        new_product = ProductFactory(category=category)
+        response = self.client.post(BASE_URL, json=new_product.serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(BASE_URL, query_string={"category": category})
+        self.assertEqual(len(response.get_json()), len(first) + 1)
+
+        response = self.client.put(f"{BASE_URL}/{first[0]['id']}/like")
+        # a like keeps the cached page and only changes its like count
+        with patch("service.routes.load_list", side_effect=AssertionError("list reloaded after a like")):
+            response = self.client.get(BASE_URL, query_string={"category": category})
+        self.assertEqual(response.get_json()[0]["like"], first[0]["like"] + 1)
+
+    def test_get_products_by_likes_cached(self):
+        """It should reload cached lists that are sorted or filtered by likes after a like"""
+        for name, like in [("Mug", 5), ("Kettle", 3), ("Toaster", 1)]:
+            self.client.post(BASE_URL, json=ProductFactory(name=name, like=like).serialize())
+        query = {"sort": "-like", "limit": 10}
+        response = self.client.get(BASE_URL, query_string=query)
+        self.assertEqual([data["name"] for data in response.get_json()], ["Mug", "Kettle", "Toaster"])
+        toaster = response.get_json()[2]
+        for _ in range(5):
+            self.client.put(f"{BASE_URL}/{toaster['id']}/like")
+        response = self.client.get(BASE_URL, query_string=query)
+        self.assertEqual([data["name"] for data in response.get_json()], ["Toaster", "Mug", "Kettle"])
+        response = self.client.get(BASE_URL, query_string={"min_like": 4})
+        self.assertEqual(sorted(data["name"] for data in response.get_json()), ["Mug", "Toaster"])
+        kettle = self.client.get(BASE_URL, query_string={"name": "Kettle"}).get_json()[0]
+        self.client.put(f"{BASE_URL}/{kettle['id']}/like")
+        response = self.client.get(BASE_URL, query_string={"min_like": 4})
+        self.assertEqual(sorted(data["name"] for data in response.get_json()), ["Kettle", "Mug", "Toaster"])
+
+    def test_get_product_list_bad_cursor(self):
+        """It should not Get a list of Products with a bad cursor"""
+        response = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_products_by_many_filters(self):
+        """It should AND every filter of the query"""
+        for name, category, price, like in [
+            ("iPhone", "phone", 900, 10), ("iPhone", "phone", 300, 2), ("iPhone", "case", 20, 50), ("Pixel", "phone", 700, 5)
+        ]:
+            self.client.post(BASE_URL, json=ProductFactory(name=name, category=category, price=price, like=like).serialize())
+        response = self.client.get(f"{BASE_URL}?name=iPhone&category=phone&price_range=100_1000&sort=-price")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["price"] for p in response.get_json()], [900, 300])
+        response = self.client.get(f"{BASE_URL}?min_like=5&max_like=10&sort=like")
+        self.assertEqual([p["like"] for p in response.get_json()], [5, 10])
+
+    def test_get_products_sorted_paginated(self):
+        """It should page through sorted Products with cursors"""
+        self._create_products(7)
+        expected = sorted(self.client.get(BASE_URL).get_json(), key=lambda p: (p["price"], -p["like"], p["id"]))
+        seen = []
+        url = f"{BASE_URL}?sort=price,-like&limit=3"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in response.get_json())
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual(seen, [product["id"] for product in expected])
+
+    def test_get_products_fields(self):
+        """It should return only the requested fields of Products"""
+        self._create_products(5)
+        response = self.client.get(f"{BASE_URL}?fields=name,id")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([list(p) for p in response.get_json()], [["id", "name"]] * 5)
+        self.assertIn("X-Fields", response.headers["Vary"])
+        full = self.client.get(BASE_URL)
+        self.assertNotEqual(response.headers["ETag"], full.headers["ETag"])
+        # sort keys and cursors still work when they are not returned
+        expected = sorted(full.get_json(), key=lambda p: (p["price"], p["id"]))
+        response = self.client.get(f"{BASE_URL}?fields=name&sort=price&limit=3")
+        self.assertEqual(response.get_json(), [{"name": p["name"]} for p in expected[:3]])
+        link = response.headers["Link"]
+        response = self.client.get(link[1:link.index(">")])
+        self.assertEqual(response.get_json(), [{"name": p["name"]} for p in expected[3:]])
+        response = self.client.get(BASE_URL, headers={"X-Fields": "{id,price}"})
+        self.assertEqual([list(p) for p in response.get_json()], [["id", "price"]] * 5)
+        with patch.dict(app.config, {"FAST_SERIALIZATION": False}):
+            response = self.client.get(f"{BASE_URL}?fields=id,like")
+            self.assertEqual([list(p) for p in response.get_json()], [["id", "like"]] * 5)
+        for query in ["fields=weight", "fields=", "fields=id,,bogus"]:
+            response = self.client.get(f"{BASE_URL}?{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_get_product_fields(self):
+        """It should return only the requested fields of a Product"""
+        product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{product.id}?fields=id,name")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"id": product.id, "name": product.name})
+        etag = response.headers["ETag"]
+        self.assertNotEqual(etag, self.client.get(f"{BASE_URL}/{product.id}").headers["ETag"])
+        response = self.client.get(f"{BASE_URL}/{product.id}?fields=id,name", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(f"{BASE_URL}/{product.id}", headers={"X-Fields": "price"})
+        self.assertEqual(response.get_json(), {"price": product.price})
+        response = self.client.get(f"{BASE_URL}/{product.id}", headers={"X-Fields": "weight"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_products_bad_filters(self):
+        """It should reject malformed filters and sort orders with 400"""
+        for query in ["price_range=100", "price_range=a_b", "price_range=200_100", "sort=weight",
+                      "min_like=-1", "sort=price&cursor=" + "eyJpZCI6IDF9"]:
+            response = self.client.get(f"{BASE_URL}?{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_top_products(self):
+        """It should return the most liked Products with or without the ranking"""
+        for name, category, like in [("iPhone", "phone", 3), ("Pixel", "phone", 1), ("Kettle", "kitchen", 2)]:
+            self.client.post(BASE_URL, json=ProductFactory(name=name, category=category, like=like).serialize())
+        response = self.client.get(f"{BASE_URL}/top?n=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["name"] for p in response.get_json()], ["iPhone", "Kettle"])
+        response = self.client.get(f"{BASE_URL}/top?category=phone")
+        self.assertEqual([p["name"] for p in response.get_json()], ["iPhone", "Pixel"])
+        with patch.dict(app.config, {"TOP_RANKING": True, "LIKE_FLUSH_INTERVAL_MS": 0}):
+            top_ranking.clear()
+            self.assertEqual([p["name"] for p in self.client.get(f"{BASE_URL}/top?category=phone").get_json()],
+                             ["iPhone", "Pixel"])
+            pixel = self.client.get(f"{BASE_URL}?name=Pixel").get_json()[0]
+            for _ in range(3):
+                self.client.put(f"{BASE_URL}/{pixel['id']}/like")
+            with patch.object(Product, "top", side_effect=AssertionError):
+                response = self.client.get(f"{BASE_URL}/top?category=phone")
+            self.assertEqual([(p["name"], p["like"]) for p in response.get_json()], [("Pixel", 4), ("iPhone", 3)])
+            response = self.client.get(f"{BASE_URL}/top?n=1")
+            self.assertEqual([p["name"] for p in response.get_json()], ["Pixel"])
+            # other writes reload the ranking from the database
+            self.client.delete(f"{BASE_URL}/{pixel['id']}")
+            response = self.client.get(f"{BASE_URL}/top?category=phone")
+            self.assertEqual([p["name"] for p in response.get_json()], ["iPhone"])
+        response = self.client.get(f"{BASE_URL}/top?by=price&n=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/top?by=name")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_products(self):
+        """It should return Products by id in request order with not found markers"""
+        products = self._create_products(3)
+        ids = [products[2].id, 0, products[0].id]
+        response = self.client.get(f"{BASE_URL}?ids={','.join(map(str, ids))}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data], ids)
+        self.assertEqual(data[0]["name"], products[2].name)
+        self.assertEqual(data[1], {"id": 0, "found": False})
+        response = self.client.post(f"{BASE_URL}/lookup?fields=id,name", json={"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [{"id": products[2].id, "name": products[2].name},
+                                               {"id": 0, "found": False},
+                                               {"id": products[0].id, "name": products[0].name}])
+        with patch.dict(app.config, {"FAST_SERIALIZATION": False}):
+            self.assertEqual(self.client.get(f"{BASE_URL}?ids={products[1].id}").get_json()[0]["id"], products[1].id)
+        with patch.dict(app.config, {"PAGE_SIZE_MAX": 2}):
+            response = self.client.get(f"{BASE_URL}?ids=1,2,3")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for query in ["ids=a", "ids=1,,2", "ids=1&limit=2", "ids=1&category=phone"]:
+            response = self.client.get(f"{BASE_URL}?{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+        for body in [[1, 2], {"ids": "1,2"}, {"ids": [1, True]}]:
+            response = self.client.post(f"{BASE_URL}/lookup", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+
+    def test_product_stats(self):
+        """It should summarize the catalog and each category"""
+        for name, category, price, like in [("iPhone", "phone", 900, 3), ("Pixel", "phone", 700, 1),
+                                            ("Kettle", "kitchen", 30, 0)]:
+            self.client.post(BASE_URL, json=ProductFactory(name=name, category=category, price=price, like=like).serialize())
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": 3, "price_min": 30, "price_max": 900, "price_avg": 543.33,
+                                               "price_total": 1630, "like_total": 4})
+        response = self.client.get(f"{BASE_URL}/stats?group_by=category")
+        self.assertEqual([(g["category"], g["count"], g["price_avg"]) for g in response.get_json()],
+                         [("kitchen", 1, 30.0), ("phone", 2, 800.0)])
+        etag = response.headers["ETag"]
+        with patch.object(Product, "stats", side_effect=AssertionError("stats read for a 304")):
+            response = self.client.get(f"{BASE_URL}/stats?group_by=category", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.client.put(f"{BASE_URL}/{self.client.get(BASE_URL).get_json()[0]['id']}/like")
+        response = self.client.get(f"{BASE_URL}/stats?group_by=category", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sum(g["like_total"] for g in response.get_json()), 5)
+        with patch.dict(app.config, {"STATS_FROM_SUMMARY": False}):
+            self.assertEqual(self.client.get(f"{BASE_URL}/stats?group_by=category").get_json(), response.get_json())
+        response = self.client.get(f"{BASE_URL}/stats?group_by=name")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_products(self):
+        """It should search Products with q"""
+        for name, description in [("iPhone", "red phone"), ("Pixel", "phone"), ("Kettle", "red kettle")]:
+            product = ProductFactory(name=name, description=description)
+            self.client.post(BASE_URL, json=product.serialize())
+        response = self.client.get(f"{BASE_URL}?q=phone")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([p["name"] for p in response.get_json()], ["iPhone", "Pixel"])
+        response = self.client.get(f"{BASE_URL}?q=red+phone")
+        self.assertEqual([p["name"] for p in response.get_json()], ["iPhone"])
+        response = self.client.get(f"{BASE_URL}?q=phone&limit=1")
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertNotIn("Link", response.headers)
+        response = self.client.get(f"{BASE_URL}?q=phone&cursor=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_suggest_products(self):
+        """It should autocomplete Product names"""
+        for name in ["iPhone", "iPad", "Macbook"]:
+            self.client.post(BASE_URL, json=ProductFactory(name=name).serialize())
+        response = self.client.get(f"{BASE_URL}/suggest?prefix=ip")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), ["iPad", "iPhone"])
+        response = self.client.get(f"{BASE_URL}/suggest?prefix=i&limit=1")
+        self.assertEqual(response.get_json(), ["iPad"])
+        response = self.client.get(f"{BASE_URL}/suggest")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_products(self):
+        """It should Export all Products as newline-delimited JSON"""
+        test_products = self._create_products(5)
+        with patch.dict(app.config, {"EXPORT_BATCH_SIZE": 2}):
+            response = self.client.get(f"{BASE_URL}/export")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            self.assertTrue(response.is_streamed)
+            lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        ids = [json.loads(line)["id"] for line in lines]
+        self.assertEqual(ids, sorted(product.id for product in test_products))
+
+    def test_export_products_by_category(self):
+        """It should Export only the Products in a category"""
+        test_products = self._create_products(10)
+        category = test_products[0].category
+        cat_count = len([product for product in test_products if product.category == category])
+        response = self.client.get(f"{BASE_URL}/export", query_string={"category": category})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), cat_count)
+        for line in lines:
+            self.assertEqual(json.loads(line)["category"], category)
+
 # ----------------------------------------------------------
 # TEST ACTION
 # ----------------------------------------------------------
@@ -305,6 +809,66 @@ class TestProductServer(TestCase):
         logging.debug("Response data: %s", data)
         self.assertEqual(data["like"], old_like_count + 2)
     
+    def test_like_a_product_buffered(self):
+        """It should Like a Product through the write-behind buffer"""
+        product = self._create_products(1)[0]
+        buffer = LikeBuffer(flush_likes, interval_ms=60000)
+        with patch("service.routes.like_buffer", buffer), patch.object(Product, "like_buffer", buffer):
+            etag = self.client.get(f"{BASE_URL}/{product.id}").headers["ETag"]
+            # the page is cached before the likes
+            list_etag = self.client.get(f"{BASE_URL}?limit=10").headers["ETag"]
+            for count in range(1, 4):
+                response = self.client.put(f"{BASE_URL}/{product.id}/like")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.get_json()["like"], product.like + count)
+            # reads add the likes that are still buffered
+            response = self.client.get(f"{BASE_URL}/{product.id}", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["like"], product.like + 3)
+            self.assertEqual(self.client.get(f"{BASE_URL}?ids={product.id}").get_json()[0]["like"], product.like + 3)
+            self.assertEqual(self.client.get(BASE_URL).get_json()[0]["like"], product.like + 3)
+            response = self.client.get(f"{BASE_URL}?limit=10", headers={"If-None-Match": list_etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()[0]["like"], product.like + 3)
+            list_etag = response.headers["ETag"]
+            response = self.client.get(f"{BASE_URL}?limit=10", headers={"If-None-Match": list_etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.client.put(f"{BASE_URL}/{product.id}/like")
+            response = self.client.get(f"{BASE_URL}?limit=10", headers={"If-None-Match": list_etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()[0]["like"], product.like + 4)
+            self.assertEqual(self.client.get("/health").get_json()["likes"]["likes"], 4)
+            response = self.client.put(f"{BASE_URL}/0/like")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            buffer.stop()
+        response = self.client.get(f"{BASE_URL}/{product.id}")
+        self.assertEqual(response.get_json()["like"], product.like + 4)
+
+    def test_like_flushed_on_the_request(self):
+        """It should Like a Product when the request has to flush the buffered likes"""
+        product = self._create_products(1)[0]
+        buffer = LikeBuffer(flush_likes, interval_ms=60000, max_lag_ms=1)
+        with patch("service.routes.like_buffer", buffer), patch.object(Product, "like_buffer", buffer):
+            buffer.add(product.id)
+            time.sleep(0.01)
+            response = self.client.put(f"{BASE_URL}/{product.id}/like")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["like"], product.like + 2)
+            self.assertEqual(buffer.pending(product.id), 0)
+            buffer.stop()
+        self.assertEqual(self.client.get(f"{BASE_URL}/{product.id}").get_json()["like"], product.like + 2)
+
+    def test_bulk_create_with_buffered_likes(self):
+        """It should Create many Products while likes are buffered"""
+        buffer = LikeBuffer(flush_likes, interval_ms=60000)
+        with patch("service.routes.like_buffer", buffer), patch.object(Product, "like_buffer", buffer):
+            payload = [ProductFactory().serialize() for _ in range(3)]
+            response = self.client.post(f"{BASE_URL}/bulk", json=payload)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.get_json()["created"], 3)
+            buffer.stop()
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+
     def test_like_a_non_exist_product(self):
         """It not should Like a Product that is not exist"""
         response = self.client.put(f"{BASE_URL}/{324232}/like")
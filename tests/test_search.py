@@ -0,0 +1,52 @@
+"""
+Test cases for the in-process search index
+"""
+from unittest import TestCase
+from service.common.search import SearchIndex, escape_like, tokenize
+
+ROWS = [
+    (1, "iPhone", "red phone with a red case"),
+    (2, "iPad", "tablet"),
+    (3, "iPhone Mini", "small phone"),
+    (4, "Macbook", None),
+]
+
+
+class TestSearchIndex(TestCase):
+    """Search Index Tests"""
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.refresh(1, lambda: ROWS)
+
+    def test_tokenize(self):
+        """It should split text into lower case words"""
+        self.assertEqual(tokenize("Red-Phone, 2 cases"), ["red", "phone", "2", "cases"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_search(self):
+        """It should rank Products that have every word"""
+        self.assertEqual(self.index.search("phone", 10), [1, 3])
+        self.assertEqual(self.index.search("red PHONE", 10), [1])
+        self.assertEqual(self.index.search("iphone", 1), [1])
+        self.assertEqual(self.index.search("phone tablet", 10), [])
+        self.assertEqual(self.index.search("watch", 10), [])
+        self.assertEqual(self.index.search("  ", 10), [])
+
+    def test_suggest(self):
+        """It should autocomplete names ignoring case"""
+        self.assertEqual(self.index.suggest("ip", 10), ["iPad", "iPhone", "iPhone Mini"])
+        self.assertEqual(self.index.suggest("IPH", 1), ["iPhone"])
+        self.assertEqual(self.index.suggest("z", 10), [])
+
+    def test_refresh(self):
+        """It should only rebuild for a new version"""
+        self.index.refresh(1, lambda: [])
+        self.assertEqual(self.index.search("tablet", 10), [2])
+        self.index.refresh(2, lambda: [(5, "Watch", "")])
+        self.assertEqual(self.index.search("tablet", 10), [])
+        self.assertEqual(self.index.suggest("w", 10), ["Watch"])
+
+    def test_escape_like(self):
+        """It should escape the LIKE wildcards"""
+        self.assertEqual(escape_like("50%_off\\"), "50\\%\\_off\\\\")